@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of WeipanClient against a local fake server
+
+    python benchmarks/bench.py [-o results.json] [--baseline baseline.json]
+                               [--save-baseline] [--tolerance 0.25]
+                               [--max-entries 100000] [--transport pooled]
+                               [group ...]
+
+Groups are metadata, transfer, memory and tree, all by default. The fake
+server runs in its own process, so neither its CPU time nor its memory is
+counted for the client. Results are written as JSON. With --baseline the
+run exits with status 1 when a result is worse than the baseline by more
+than the tolerance, --save-baseline writes the results as the new baseline.
+Baselines depend on the machine, save one per CI runner. --transport
+selects the request.Transport of the clients, to compare backends.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from weipan import request, fakeserver
+
+# worse by this much more than the tolerance before a small value counts as a regression
+SLACK = {
+    'MB': 2.0,
+    'ms': 0.5
+}
+
+GROUPS = ['metadata', 'transfer', 'memory', 'tree']
+
+TRANSPORTS = {
+    'pooled': request.PooledTransport,
+    'simple': request.SimpleTransport
+}
+
+def populate(store, root, path, count, fanout=100):
+    """
+    Add a tree of `count` entries below path, every tenth entry a folder
+    """
+    empty = store.write_blob('')
+    store.create_folder(root, path)
+    folders = [path]
+    added = 0
+    while added < count:
+        parent = folders.pop(0)
+        for i in range(fanout):
+            if added >= count:
+                break
+            if i % 10 == 0:
+                entry = store.new_entry('%s/dir%d' % (parent, i), True)
+                folders.append(entry['path'])
+            else:
+                entry = store.new_entry('%s/file%d.txt' % (parent, i), False)
+                entry.update(empty)
+                entry['versions'] = [dict(empty, rev=entry['rev'], revision=entry['revision'], modified=entry['modified'])]
+            store.add(root, entry)
+            added += 1
+
+def serve(queue, stop, tree_size):
+    server = fakeserver.FakeWeipanServer()
+    if tree_size:
+        populate(server.store, 'sandbox', '/tree', tree_size)
+    server.start()
+    queue.put(server.url)
+    stop.wait()
+    server.stop()
+
+class ServerProcess:
+    """
+    A FakeWeipanServer in a child process, optionally with a synthetic tree at /tree
+    """
+
+    def __init__(self, options, tree_size=0):
+        self.transport = TRANSPORTS[options.transport]()
+        self.tree_size = tree_size
+        self.stop = multiprocessing.Event()
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(queue, self.stop, self.tree_size))
+        self.process.daemon = True
+        self.process.start()
+        self.url = queue.get(timeout=3600)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.transport.close()
+        self.stop.set()
+        self.process.join()
+
+    def client(self, **kwargs):
+        return fakeserver.fake_client(self.url, transport=self.transport, **kwargs)
+
+def result(value, unit, higher_is_better):
+    return {'value': round(value, 3), 'unit': unit, 'higher_is_better': higher_is_better}
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench_metadata(options, tmp_dir):
+    with ServerProcess(options) as server:
+        client = server.client()
+        client.create_folder('/bench')
+
+        latencies = []
+        started = time.time()
+        for i in range(options.requests):
+            t = time.time()
+            client.metadata('/bench')
+            latencies.append(time.time() - t)
+        elapsed = time.time() - started
+
+        pool = ThreadPool(options.workers)
+        concurrent_started = time.time()
+        try:
+            pool.map(lambda i: client.metadata('/bench'), range(options.requests))
+        finally:
+            pool.close()
+        concurrent_elapsed = time.time() - concurrent_started
+
+    return {
+        'metadata_serial_rps': result(options.requests / elapsed, 'req/s', True),
+        'metadata_latency_p50_ms': result(percentile(latencies, 0.5) * 1000, 'ms', False),
+        'metadata_latency_p99_ms': result(percentile(latencies, 0.99) * 1000, 'ms', False),
+        'metadata_concurrent_rps': result(options.requests / concurrent_elapsed, 'req/s', True)
+    }
+
+def make_file(tmp_dir, size):
+    file_path = os.path.join(tmp_dir, 'bench.bin')
+    if not os.path.exists(file_path):
+        block = os.urandom(1024 * 1024)
+        with open(file_path, 'wb') as fh:
+            for i in range(size // len(block)):
+                fh.write(block)
+    return file_path
+
+def bench_transfer(options, tmp_dir):
+    size = options.transfer_mb * 1024 * 1024
+    file_path = make_file(tmp_dir, size)
+    to_path = os.path.join(tmp_dir, 'download.bin')
+    rst = {}
+    with ServerProcess(options) as server:
+        client = server.client()
+
+        t = time.time()
+        client.put_file('/bench.bin', file_path)
+        rst['upload_mbps'] = result(options.transfer_mb / (time.time() - t), 'MB/s', True)
+
+        t = time.time()
+        client.download_to('/bench.bin', to_path)
+        rst['download_mbps'] = result(options.transfer_mb / (time.time() - t), 'MB/s', True)
+
+        t = time.time()
+        client.download_parallel('/bench.bin', to_path, segment_size=size // 8)
+        rst['download_parallel_mbps'] = result(options.transfer_mb / (time.time() - t), 'MB/s', True)
+    return rst
+
+def max_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def measure(queue, url, transport, operation, file_path, to_path):
+    # a new transport, the inherited connections belong to the parent
+    client = fakeserver.fake_client(url, transport=TRANSPORTS[transport]())
+    before = max_rss_mb()
+    if operation == 'put_file':
+        client.put_file('/memory.bin', file_path)
+    elif operation == 'put_stream':
+        with open(file_path, 'rb') as fh:
+            client.put_stream('/memory.bin', fh)
+    elif operation == 'post_file':
+        client.post_file('/memory.bin', file_path)
+    elif operation == 'get_file':
+        client.get_file('/bench.bin')
+    elif operation == 'download_to':
+        client.download_to('/bench.bin', to_path)
+    queue.put(max_rss_mb() - before)
+
+def bench_memory(options, tmp_dir):
+    """
+    Peak memory growth of each operation, measured in a fresh process
+    """
+    file_path = make_file(tmp_dir, options.transfer_mb * 1024 * 1024)
+    to_path = os.path.join(tmp_dir, 'download.bin')
+    rst = {}
+    with ServerProcess(options) as server:
+        server.client().put_file('/bench.bin', file_path)
+        server.transport.close()
+        for operation in ['put_file', 'put_stream', 'post_file', 'get_file', 'download_to']:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=measure, args=(queue, server.url, options.transport, operation,
+                                                                 file_path, to_path))
+            p.start()
+            growth = queue.get(timeout=600)
+            p.join()
+            rst['memory_%s_mb' % operation] = result(growth, 'MB', False)
+    return rst
+
+def bench_tree(options, tmp_dir):
+    rst = {}
+    size = 1000
+    while size <= options.max_entries:
+        with ServerProcess(options, size) as server:
+            client = server.client()
+
+            t = time.time()
+            count = sum(1 for entry in client.walk('/tree', workers=options.workers))
+            rst['walk_%d_eps' % size] = result(count / (time.time() - t), 'entries/s', True)
+
+            t = time.time()
+            count = 0
+            rst_delta = {'cursor': None, 'has_more': True}
+            while rst_delta['has_more']:
+                rst_delta = client.delta(rst_delta['cursor'])
+                count += len(rst_delta['entries'])
+            rst['delta_%d_eps' % size] = result(count / (time.time() - t), 'entries/s', True)
+        size *= 10
+    return rst
+
+def compare(results, baseline, tolerance):
+    """
+    Messages for the results worse than baseline by more than tolerance
+    """
+    regressions = []
+    for name, rst in sorted(results.items()):
+        if name not in baseline:
+            continue
+        value, expected = rst['value'], baseline[name]['value']
+        if rst['higher_is_better']:
+            regressed = value < expected * (1 - tolerance)
+        else:
+            regressed = value > expected * (1 + tolerance) + SLACK.get(rst['unit'], 0)
+        if regressed:
+            regressions.append('%s: %s %s, baseline %s %s' % (name, value, rst['unit'], expected, rst['unit']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WeipanClient against a local fake server')
+    parser.add_argument('groups', nargs='*', help='benchmark groups of %s, all by default' % ', '.join(GROUPS))
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='baseline results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--requests', type=int, default=1000, help='metadata calls per run')
+    parser.add_argument('--workers', type=int, default=8, help='threads for concurrent runs')
+    parser.add_argument('--transfer-mb', type=int, default=64, help='size of the transferred file')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='pooled', help='request.Transport of the clients')
+    parser.add_argument('--max-entries', type=int, default=100000,
+                        help='largest synthetic tree, sizes go from 1000 by factors of 10')
+    options = parser.parse_args()
+    for group in options.groups:
+        if group not in GROUPS:
+            parser.error('unknown group %s' % group)
+
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for group in options.groups or GROUPS:
+            rst = globals()['bench_' + group](options, tmp_dir)
+            for name, value in sorted(rst.items()):
+                print '%-28s %12s %s' % (name, value['value'], value['unit'])
+            results.update(rst)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if options.output:
+        with open(options.output, 'wb') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+    if options.baseline and options.save_baseline:
+        with open(options.baseline, 'wb') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    elif options.baseline:
+        with open(options.baseline, 'rb') as fh:
+            baseline = json.load(fh)['results']
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print 'Regressions past the baseline:'
+            for message in regressions:
+                print '  ' + message
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
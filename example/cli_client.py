@@ -127,10 +127,8 @@ class WeipanTerm(cmd.Cmd):
         Examples:
         Weipan> get file.txt ~/weipan-file.txt
         """
-        to_file = open(os.path.expanduser(to_path), "wb")
-
-        f = self.api_client.get_file(self.current_path + "/" + from_path)
-        to_file.write(f)
+        self.api_client.download_to(self.current_path + "/" + from_path,
+                                    os.path.expanduser(to_path))
 
     @command()
     def do_thumbnail(self, from_path, to_path, size='l'):
@@ -0,0 +1,67 @@
+import unittest
+import os.path
+import sys
+import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import async_client
+
+class SlowClient:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def metadata(self, path, list=True):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if path == '/missing':
+            raise ValueError(path)
+        return {'path': path, 'list': list}
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.stub = SlowClient()
+        self.client = async_client.WeipanAsyncClient(None, concurrency=4, client=self.stub)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_api_surface(self):
+        for name in async_client.API_METHODS:
+            self.assertTrue(hasattr(self.client, name))
+
+    def test_concurrent(self):
+        start = time.time()
+        results = [self.client.metadata('/%d' % i, list=False) for i in range(8)]
+        self.assertEqual([r.get()['path'] for r in results], ['/%d' % i for i in range(8)])
+        self.assertEqual(self.stub.max_running, 4)
+        self.assertTrue(time.time() - start < 0.05 * 8)
+
+    def test_exception(self):
+        self.assertRaises(ValueError, self.client.metadata('/missing').get)
+
+    def test_callback(self):
+        got = []
+        self.client.metadata('/a', callback=got.append).wait()
+        time.sleep(0.01)
+        self.assertEqual(got[0]['path'], '/a')
+
+    def test_map(self):
+        rst = self.client.map('metadata', [('/a',), ('/b', False)])
+        self.assertEqual(rst, [{'path': '/a', 'list': True}, {'path': '/b', 'list': False}])
+
+    def test_max_pending(self):
+        client = async_client.WeipanAsyncClient(None, concurrency=8, max_pending=2, client=self.stub)
+        with client:
+            results = [client.metadata('/%d' % i) for i in range(6)]
+        self.assertEqual(self.stub.max_running, 2)
+        self.assertTrue(all(r.successful() for r in results))
+
+if __name__ == '__main__':
+    unittest.main()
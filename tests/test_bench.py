@@ -0,0 +1,38 @@
+import unittest
+import os.path
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'benchmarks'))
+import bench
+from weipan import fakeserver
+
+class TestBench(unittest.TestCase):
+    def test_compare(self):
+        baseline = {
+            'rps': bench.result(100, 'req/s', True),
+            'memory': bench.result(10, 'MB', False),
+            'small': bench.result(0.1, 'MB', False)
+        }
+        results = {
+            'rps': bench.result(80, 'req/s', True),
+            'memory': bench.result(12, 'MB', False),
+            'small': bench.result(1.5, 'MB', False),
+            'new': bench.result(1, 'req/s', True)
+        }
+        self.assertEqual(bench.compare(results, baseline, 0.25), [])
+        results['rps']['value'] = 70
+        results['memory']['value'] = 20
+        regressions = bench.compare(results, baseline, 0.25)
+        self.assertEqual([r.split(':')[0] for r in regressions], ['memory', 'rps'])
+
+    def test_populate(self):
+        store = fakeserver.FakeStore()
+        bench.populate(store, 'sandbox', '/tree', 250, fanout=20)
+        _, entries, cursor, has_more = store.delta('sandbox', limit=1000)
+        # /tree itself and 250 entries below it
+        self.assertEqual(len(entries), 251)
+        self.assertEqual(len(store.children('sandbox', '/tree')), 20)
+
+if __name__ == '__main__':
+    unittest.main()
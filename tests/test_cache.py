@@ -0,0 +1,326 @@
+import unittest
+import os.path
+import sys
+import shutil
+import tempfile
+import time
+import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import cache, client, request, session
+
+class FakeResponse:
+    reason = ''
+
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or []
+
+    def read(self):
+        return ''
+
+    def getheaders(self):
+        return self.headers
+
+class MetadataClient(client.WeipanClient):
+    """
+    Answers metadata requests from a dict, with 304 when the hash matches
+    """
+
+    def __init__(self, *args, **kwargs):
+        client.WeipanClient.__init__(self, *args, **kwargs)
+        self.listings = {}
+        self.requests = []
+
+    def get(self, target, params=None, follow=False, format='json'):
+        self.requests.append((target, params))
+        listing = self.listings[target.lower()]
+        if params.get('hash') == listing['hash']:
+            raise request.ErrorResponse(FakeResponse(304))
+        return listing
+
+class TestLRUCache(unittest.TestCase):
+    def test_lru(self):
+        c = cache.LRUCache(max_size=2, ttl=None)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(len(c), 2)
+
+    def test_ttl(self):
+        c = cache.LRUCache(ttl=-1)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), None)
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        c = cache.DiskCache(os.path.join(self.directory, 'meta'))
+        c.set('a', {'hash': 'x'})
+        self.assertEqual(cache.DiskCache(os.path.join(self.directory, 'meta')).get('a'), {'hash': 'x'})
+        c.delete('a')
+        self.assertEqual(c.get('a'), None)
+
+    def test_ttl(self):
+        c = cache.DiskCache(self.directory, ttl=-1)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), None)
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+        self.client = MetadataClient(sess, metadata_cache=cache.LRUCache())
+        self.client.listings['metadata/sandbox/dir'] = {'hash': 'h1', 'contents': []}
+
+    def test_not_modified(self):
+        first = self.client.metadata('/dir')
+        second = self.client.metadata('/Dir/')
+        self.assertEqual(first, second)
+        self.assertFalse('hash' in self.client.requests[0][1])
+        self.assertEqual(self.client.requests[1][1]['hash'], 'h1')
+
+    def test_modified(self):
+        self.client.metadata('/dir')
+        self.client.listings['metadata/sandbox/dir'] = {'hash': 'h2', 'contents': [{'path': '/dir/a'}]}
+        self.assertEqual(self.client.metadata('/dir')['hash'], 'h2')
+        self.client.metadata('/dir')
+        self.assertEqual(self.client.requests[2][1]['hash'], 'h2')
+
+    def test_explicit_hash(self):
+        self.client.metadata('/dir')
+        self.assertRaises(request.ErrorResponse, self.client.metadata, '/dir', hash='h1')
+
+    def test_params_in_key(self):
+        self.client.metadata('/dir')
+        self.client.metadata('/dir', include_deleted=True)
+        self.assertFalse('hash' in self.client.requests[1][1])
+
+class RedirectClient(client.WeipanClient):
+    """
+    Redirects files and thumbnails to signed URLs, counts requests
+    """
+
+    def __init__(self, *args, **kwargs):
+        client.WeipanClient.__init__(self, *args, **kwargs)
+        self.requests = 0
+        self.expires = time.time() + 3600
+
+    def get(self, target, params=None, follow=False, format='json'):
+        self.requests += 1
+        if target.startswith('media/'):
+            return {'url': 'http://media/%s' % self.requests, 'expires': self.expires}
+        location = 'http://storage/%s?n=%d&Expires=%d' % (target, self.requests, self.expires)
+        raise request.ErrorResponse(FakeResponse(302, [('location', location)]))
+
+class TestURLCache(unittest.TestCase):
+    def test_url_expires(self):
+        self.assertEqual(cache.url_expires('http://s/a?Expires=1700000000&sig=x'), 1700000000)
+        self.assertEqual(cache.url_expires('http://s/a'), None)
+        self.assertEqual(cache.url_expires({'expires': 'Tue, 14 Nov 2023 22:13:20 +0000'}), 1700000000)
+
+    def test_default_ttl(self):
+        c = cache.URLCache(default_ttl=-1)
+        self.assertEqual(c.get('a', lambda: 'http://s/1'), 'http://s/1')
+        self.assertEqual(c.get('a', lambda: 'http://s/2'), 'http://s/2')
+
+    def test_expired_url(self):
+        c = cache.URLCache()
+        c.get('a', lambda: 'http://s/1?Expires=%d' % (time.time() - 1))
+        self.assertEqual(c.get('a', lambda: 'http://s/2'), 'http://s/2')
+
+    def test_lru(self):
+        c = cache.URLCache(max_size=1)
+        c.get('a', lambda: 'http://s/a')
+        c.get('b', lambda: 'http://s/b')
+        self.assertEqual(len(c), 1)
+        self.assertEqual(c.get('a', lambda: 'http://s/new'), 'http://s/new')
+
+    def test_refresh_ahead(self):
+        c = cache.URLCache(refresh_ahead=1)
+        c.get('a', lambda: 'http://s/1?Expires=%d' % (time.time() + 60))
+        fresh = 'http://s/2?Expires=%d' % (time.time() + 60)
+        # served from cache, refreshed in the background
+        self.assertTrue(c.get('a', lambda: fresh).startswith('http://s/1'))
+        for i in range(100):
+            if not c.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(c.get('a', lambda: None), fresh)
+
+    def test_client(self):
+        sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+        c = RedirectClient(sess, url_cache=cache.URLCache(refresh_ahead=0))
+        url = c.get_file_url('/a.txt')
+        self.assertEqual(c.get_file_url('/A.txt'), url)
+        self.assertNotEqual(c.get_file_url('/a.txt', rev='2'), url)
+        self.assertNotEqual(c.get_thumbnail_url('/a.txt', 's'), c.get_thumbnail_url('/a.txt', 'l'))
+        self.assertEqual(c.media('/a.mp4'), c.media('/a.mp4'))
+        self.assertEqual(c.requests, 5)
+
+    def test_shared_between_accounts(self):
+        url_cache = cache.URLCache()
+        for token in ['token-a', 'token-b']:
+            sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+            sess.token = token
+            c = RedirectClient(sess, url_cache=url_cache)
+            c.get_file_url('/a.txt')
+            # not served from the other account's entry
+            self.assertEqual(c.requests, 1)
+        self.assertEqual(len(url_cache), 2)
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        c = cache.FileCache(self.directory, 1000)
+        self.assertEqual(c.get('a'), None)
+        c.set('a', 'x' * 10)
+        self.assertEqual(c.get('a'), 'x' * 10)
+        self.assertEqual(cache.FileCache(self.directory, 1000).size, 10)
+
+    def test_evict_lru(self):
+        c = cache.FileCache(self.directory, 250)
+        for i, key in enumerate('abc'):
+            c.set(key, key * 100)
+            os.utime(c.file_path(key), (i, i))
+        # c is the most recent, a the least recently used
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(c.get('b'), 'b' * 100)
+        self.assertEqual(c.get('c'), 'c' * 100)
+        self.assertEqual(c.size, 200)
+
+    def test_shared_budget(self):
+        # two instances stand for two processes sharing the directory
+        a = cache.FileCache(self.directory, 250)
+        b = cache.FileCache(self.directory, 250)
+        for i in range(10):
+            (i % 2 and a or b).set(str(i), 'x' * 100)
+            total = sum(size for file_path, size, mtime in a.scan())
+            self.assertTrue(total <= 250, total)
+        self.assertEqual(b.size, total)
+        b.set('9', 'y' * 50)
+        self.assertEqual(a.read_size(), total - 50)
+
+    def test_open_fill(self):
+        c = cache.FileCache(self.directory, 1000)
+        self.assertEqual(c.open('a'), None)
+        with c.open('a', lambda fh: fh.write('content')) as fh:
+            self.assertEqual(fh.read(), 'content')
+        with c.open('a', lambda fh: fh.write('other')) as fh:
+            self.assertEqual(fh.read(), 'content')
+
+    def test_keep_added_entry(self):
+        c = cache.FileCache(self.directory, 100)
+        c.set('a', 'a' * 50)
+        with c.open('big', lambda fh: fh.write('b' * 500)) as fh:
+            self.assertEqual(len(fh.read()), 500)
+        self.assertEqual(c.get('a'), None)
+
+    def test_read_after_evicted(self):
+        c = cache.FileCache(self.directory, 1000)
+        c.set('a', 'content')
+        fh = c.open('a')
+        c.clear()
+        self.assertEqual(fh.read(), 'content')
+        fh.close()
+
+    def test_failed_fill(self):
+        c = cache.FileCache(self.directory, 1000)
+        def fill(fh):
+            fh.write('partial')
+            raise IOError('broken')
+        self.assertRaises(IOError, c.add, 'a', fill)
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(list(c.scan()), [])
+
+class ThumbnailClient(client.WeipanClient):
+    def __init__(self, *args, **kwargs):
+        client.WeipanClient.__init__(self, *args, **kwargs)
+        self.requests = []
+        self.rev = 'r1'
+
+    def get(self, target, params=None, follow=False, format='json'):
+        self.requests.append(target)
+        if target.startswith('metadata/'):
+            return {'path': target, 'rev': self.rev}
+        if target.endswith('broken.png'):
+            raise ValueError(target)
+        return '%s %s %s' % (target, params['size'], self.rev)
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+        self.client = ThumbnailClient(sess, thumbnail_cache=cache.FileCache(self.directory, 10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cached_by_rev(self):
+        first = self.client.get_thumbnail('/a.png', 's')
+        self.assertEqual(self.client.get_thumbnail('/a.png', 's'), first)
+        self.assertEqual(self.client.requests, ['metadata/sandbox/a.png', 'thumbnails/sandbox/a.png', 'metadata/sandbox/a.png'])
+        self.client.rev = 'r2'
+        self.assertNotEqual(self.client.get_thumbnail('/a.png', 's'), first)
+
+    def test_prefetch(self):
+        errors = self.client.prefetch_thumbnails([
+            {'path': '/a.png', 'rev': 'r1'},
+            {'path': '/b.png', 'rev': 'r1'},
+            '/broken.png'
+        ], 'm', workers=3)
+        self.assertEqual(errors.keys(), ['/broken.png'])
+        self.client.requests = []
+        self.client.get_thumbnail('/b.png', 'm', rev='r1')
+        self.assertEqual(self.client.requests, [])
+
+class BlobClient(client.WeipanClient):
+    def __init__(self, *args, **kwargs):
+        client.WeipanClient.__init__(self, *args, **kwargs)
+        self.downloads = []
+
+    def get(self, target, params=None, follow=False, format='json'):
+        return {'path': target, 'rev': 'r2'}
+
+    def get_file_stream(self, from_path, rev=None):
+        self.downloads.append((from_path, rev))
+        return StringIO.StringIO('%s@%s' % (from_path, rev))
+
+class TestBlobCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+        self.client = BlobClient(sess, blob_cache=cache.FileCache(os.path.join(self.directory, 'blobs'), 10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_file(self):
+        self.assertEqual(self.client.get_file('/a.bin', rev='r1'), '/a.bin@r1')
+        self.assertEqual(self.client.get_file('/A.bin', rev='r1'), '/a.bin@r1')
+        self.assertEqual(self.client.get_file('/a.bin'), '/a.bin@r2')
+        self.assertEqual(self.client.downloads, [('/a.bin', 'r1'), ('/a.bin', 'r2')])
+
+    def test_download_to(self):
+        to = os.path.join(self.directory, 'out')
+        self.assertEqual(self.client.download_to('/a.bin', to, rev='r1'), len('/a.bin@r1'))
+        self.assertEqual(self.client.download_to('/a.bin', to, rev='r1'), len('/a.bin@r1'))
+        with open(to, 'rb') as fh:
+            self.assertEqual(fh.read(), '/a.bin@r1')
+        self.assertEqual(len(self.client.downloads), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,17 +3,31 @@ import os.path
 import datetime
 import sys
 import time
+import StringIO
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
-from weipan import session, client, request
+from weipan import session, client, request, fakeserver
 
 class TestClient(unittest.TestCase):
     setup_once = False
     remote_dir = None
+    # without a token on the command line, tests run against a local fake server
+    app_key = None
+    app_secret = None
+    callback = None
+    access_type = 'sandbox'
+    token = None
+    delay = None
+    server = None
     def setUp(self):
+        if self.token is None:
+            self.__class__.server = fakeserver.FakeWeipanServer().start()
+            self.__class__.token = self.server.token
         self.session = session.WeipanSession(self.app_key, self.app_secret, self.callback, self.access_type)
         self.session.set_token(self.token)
         self.client = client.WeipanClient(self.session, debug=True, delay=self.delay)
+        if self.server is not None:
+            self.server.bind(self.client)
         self.local_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'app')
         self.local_pic = os.path.join(self.local_dir, 'weipan.png')
         self.local_txt = os.path.join(self.local_dir, 'test.txt')
@@ -29,6 +43,16 @@ class TestClient(unittest.TestCase):
 
 
 
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+
+    def settle(self):
+        """
+        Give the live service time to apply a change
+        """
+        if self.server is None:
+            time.sleep(1)
+
     def print_title(self, title):
         print "\n"+'* '*10 + ' ' + title + ' ' + '* '*10
 
@@ -115,6 +139,24 @@ class TestClient(unittest.TestCase):
         #print rst
         self.assert_file(rst)
 
+    def test_put_stream(self):
+        self.print_title('test_put_stream')
+
+        with open(self.local_txt, 'rb') as fh:
+            rst = self.client.put_stream(self.remote_dir+'/stream_test.txt', fh, os.path.getsize(self.local_txt))
+        self.assert_file(rst)
+        rst = self.client.put_stream(self.remote_dir+'/chunked_test.txt', iter(['test ', '', 'content']))
+        self.assert_file(rst)
+        self.settle()
+        self.assertEqual(self.client.get_file(self.remote_dir+'/chunked_test.txt'), 'test content')
+
+    def test_put_bytes(self):
+        self.print_title('test_put_bytes')
+
+        rst = self.client.put_bytes(self.remote_dir+'/bytes_test.txt', 'test content')
+        self.assert_file(rst)
+        self.assertEqual(int(rst['bytes']), 12)
+
     def test_post_file(self):
         self.print_title('test_post_file')
 
@@ -126,10 +168,20 @@ class TestClient(unittest.TestCase):
         self.print_title('test_get_file')
 
         self.client.put_file(self.remote_dir+'/get_test.txt', self.local_txt)
-        time.sleep(1)
+        self.settle()
         rst = self.client.get_file(self.remote_dir+'/get_test.txt')
         self.assertEqual(rst, 'test content')
 
+    def test_download_to(self):
+        self.print_title('test_download_to')
+
+        self.client.put_file(self.remote_dir+'/download_test.txt', self.local_txt)
+        self.settle()
+        out = StringIO.StringIO()
+        rst = self.client.download_to(self.remote_dir+'/download_test.txt', out, chunk_size=4)
+        self.assertEqual(rst, len('test content'))
+        self.assertEqual(out.getvalue(), 'test content')
+
     def test_get_file_url(self):
         self.print_title('test_get_file_url')
 
@@ -156,7 +208,7 @@ class TestClient(unittest.TestCase):
 
         self.client.put_file(self.remote_dir+'/revisions_test.txt', self.local_txt)
 
-        time.sleep(1)
+        self.settle()
         
         rst = self.client.revisions(self.remote_dir+'/revisions_test.txt')
         self.assertIsInstance(rst, list)
@@ -239,7 +291,7 @@ class TestClient(unittest.TestCase):
 
         self.client.put_file(self.remote_dir + '/media_weipan.png', self.local_pic)
 
-        time.sleep(1)
+        self.settle()
 
         rst = self.client.media(self.remote_dir + '/media_weipan.png')
         # print rst
@@ -257,7 +309,7 @@ class TestClient(unittest.TestCase):
 
         self.client.put_file(self.remote_dir + '/thumbnails_weipan.png', self.local_pic)
 
-        time.sleep(1)
+        self.settle()
 
         self.client.get_thumbnail(self.remote_dir + '/thumbnails_weipan.png', 's')
         rst = self.client.get_thumbnail_url(self.remote_dir + '/thumbnails_weipan.png', 's')
@@ -313,7 +365,7 @@ class TestClient(unittest.TestCase):
         self.client.create_folder(self.remote_dir + '/test_move')
         self.client.put_file(self.remote_dir + '/move_test.txt', self.local_txt)
 
-        time.sleep(1)
+        self.settle()
 
         # move file
         rst = self.client.move(self.remote_dir + '/move_test.txt', self.remote_dir + '/test_move/move_new_test.txt')
@@ -343,11 +395,9 @@ class TestClient(unittest.TestCase):
 
 
 if __name__ == '__main__':
-    TestClient.app_key = None
-    TestClient.app_secret = None
-    TestClient.callback = None
     TestClient.access_type = 'basic' in sys.argv and 'basic' or 'sandbox'
-    TestClient.token = sys.argv[1]
+    if len(sys.argv) > 1 and sys.argv[1] != 'basic':
+        TestClient.token = sys.argv[1]
+        TestClient.delay = 0.5
     sys.argv[1:] = []
-    TestClient.delay = 0.5
     unittest.main()
\ No newline at end of file
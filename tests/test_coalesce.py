@@ -0,0 +1,92 @@
+import unittest
+import os.path
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, coalesce, async_client, fakeserver
+
+class TestSingleFlight(unittest.TestCase):
+    def run_concurrently(self, group, func, n=8):
+        """
+        n calls of group.do('key', func), started while the first one runs
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def leader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return func()
+
+        def run(i):
+            try:
+                return group.do('key', i and func or leader)
+            except Exception, e:
+                return e
+
+        pool = ThreadPool(n)
+        first = pool.apply_async(run, (0,))
+        started.wait()
+        rest = pool.map_async(run, range(1, n))
+        while group.shared < n - 1:
+            started.wait(0.01)
+        release.set()
+        results = [first.get()] + rest.get()
+        pool.close()
+        self.assertEqual(len(calls), 1)
+        return results
+
+    def test_result(self):
+        group = coalesce.SingleFlight()
+        results = self.run_concurrently(group, lambda: {'items': [1]})
+        self.assertEqual(results, [{'items': [1]}] * 8)
+        # every caller got its own copy
+        self.assertEqual(len(set(id(r) for r in results)), 8)
+        self.assertEqual(len(group), 0)
+        self.assertEqual(group.do('key', lambda: 2), 2)
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('boom')
+        group = coalesce.SingleFlight()
+        results = self.run_concurrently(group, fail)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(len(group), 0)
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.server = fakeserver.FakeWeipanServer(latency=0.2).start()
+        self.server.store.put('sandbox', '/hot/a.txt', 'a')
+        self.single_flight = coalesce.SingleFlight()
+        self.client = self.server.client(single_flight=self.single_flight)
+
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+        self.server.stop()
+
+    def test_coalesced(self):
+        with async_client.WeipanAsyncClient(None, concurrency=8, client=self.client) as c:
+            listings = c.map('metadata', [('/hot',)] * 8)
+            urls = c.map('get_file_url', [('/hot/a.txt',)] * 8)
+            missing = [c.metadata('/missing') for i in range(4)]
+            for r in missing:
+                self.assertRaises(request.ErrorResponse, r.get)
+        self.assertEqual(self.server.requests['/2/metadata/sandbox/hot'], 1)
+        self.assertEqual(self.server.requests['/2/files/sandbox/hot/a.txt'], 1)
+        self.assertEqual(self.server.requests['/2/metadata/sandbox/missing'], 1)
+        self.assertEqual(len(set(r['hash'] for r in listings)), 1)
+        self.assertEqual(len(set(urls)), 1)
+
+    def test_streams_not_coalesced(self):
+        with async_client.WeipanAsyncClient(None, concurrency=4, client=self.client) as c:
+            streams = [c.get_file_stream('/hot/a.txt') for i in range(4)]
+            for r in streams:
+                self.assertEqual(''.join(request.iter_response(r.get())), 'a')
+        self.assertEqual(self.server.requests['/2/files/sandbox/hot/a.txt'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+import os.path
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, dedup, fakeserver
+
+CONTENT = 'installer' * 10000
+UPLOAD = '/upload/2/files_put/sandbox'
+
+class TestDedupUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, 'setup.exe')
+        with open(self.file_path, 'wb') as fh:
+            fh.write(CONTENT)
+        self.server = fakeserver.FakeWeipanServer().start()
+        self.server.store.put('sandbox', '/a/setup.exe', CONTENT)
+        self.client = self.server.client()
+        self.content_map = dedup.ContentMap()
+        self.content_map.add_all([self.client.metadata('/a')])
+
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def uploads(self):
+        return sum(n for path, n in self.server.requests.items() if path.startswith(UPLOAD))
+
+    def test_copy(self):
+        self.assertEqual(len(self.content_map), 1)
+        upload = dedup.DedupUpload(self.client, '/b/setup.exe', self.file_path, self.content_map)
+        meta = upload.run()
+        self.assertEqual(meta['path'], '/b/setup.exe')
+        self.assertEqual(upload.copied_from['path'], '/a/setup.exe')
+        self.assertEqual(self.client.get_file('/b/setup.exe'), CONTENT)
+        self.assertEqual(self.uploads(), 0)
+        self.assertEqual(len(self.content_map), 2)
+
+    def test_copy_ref(self):
+        ref = dict(self.client.metadata('/a/setup.exe'), path='/other/account.exe',
+                   copy_ref=self.client.copy_ref('/a/setup.exe')['copy_ref'])
+        content_map = dedup.ContentMap()
+        content_map.add(ref)
+        upload = dedup.DedupUpload(self.client, '/c.exe', self.file_path, content_map)
+        upload.run()
+        self.assertEqual(upload.copied_from['path'], '/other/account.exe')
+        self.assertEqual(self.uploads(), 0)
+
+    def test_fallbacks(self):
+        # the source is gone
+        self.server.store.delete('sandbox', '/a/setup.exe')
+        self.client.put_file_dedup('/b/setup.exe', self.file_path, self.content_map)
+        self.assertEqual(self.uploads(), 1)
+        self.assertEqual([m['path'] for m in self.content_map.by_sha1(
+            self.client.metadata('/b/setup.exe')['sha1'])], ['/b/setup.exe'])
+
+        # the target exists
+        self.server.store.put('sandbox', '/c/setup.exe', 'old')
+        meta = self.client.put_file_dedup('/c/setup.exe', self.file_path, self.content_map)
+        self.assertEqual(self.uploads(), 2)
+        self.assertEqual(meta['path'], '/c/setup.exe')
+
+        # the source changed since it was listed
+        self.server.store.put('sandbox', '/b/setup.exe', 'changed')
+        content_map = dedup.ContentMap()
+        content_map.add(self.client.metadata('/c/setup.exe'))
+        self.server.store.put('sandbox', '/c/setup.exe', 'x' * len(CONTENT))
+        upload = dedup.DedupUpload(self.client, '/d/setup.exe', self.file_path, content_map)
+        upload.run()
+        self.assertEqual(upload.copied_from, None)
+        self.assertEqual(self.client.get_file('/d/setup.exe'), CONTENT)
+        self.assertEqual(self.uploads(), 3)
+
+    def test_sync(self):
+        local_dir = os.path.join(self.tmp_dir, 'local')
+        for name in ['x', 'y']:
+            os.makedirs(os.path.join(local_dir, name))
+            shutil.copy(self.file_path, os.path.join(local_dir, name, 'setup.exe'))
+        self.client.sync_up(local_dir, '/', content_map=self.content_map)
+        self.assertEqual(self.client.get_file('/x/setup.exe'), CONTENT)
+        self.assertEqual(self.client.get_file('/y/setup.exe'), CONTENT)
+        self.assertEqual(self.uploads(), 0)
+
+    def test_source_became_folder(self):
+        self.server.store.delete('sandbox', '/a/setup.exe')
+        self.server.store.create_folder('sandbox', '/a/setup.exe')
+        self.server.store.put('sandbox', '/a/setup.exe/inner.txt', 'inner')
+        meta = dedup.DedupUpload(self.client, '/b/setup.exe', self.file_path, self.content_map).run()
+        self.assertEqual(meta['path'], '/b/setup.exe')
+        self.assertFalse(self.client.metadata('/b/setup.exe')['is_dir'])
+        self.assertEqual(self.client.get_file('/b/setup.exe'), CONTENT)
+
+    def test_sync_type_change(self):
+        # the remote file b becomes a folder, its old content moves to new
+        self.server.store.put('sandbox', '/back/b', CONTENT)
+        local_dir = os.path.join(self.tmp_dir, 'local')
+        os.makedirs(os.path.join(local_dir, 'b'))
+        with open(os.path.join(local_dir, 'b', 'child.txt'), 'wb') as fh:
+            fh.write('child')
+        shutil.copy(self.file_path, os.path.join(local_dir, 'new'))
+
+        plan = self.client.sync_up(local_dir, '/back', delete=True, content_map=dedup.ContentMap())
+        self.assertTrue(all(r.ok for r in plan.results))
+        self.assertFalse(self.client.metadata('/back/new')['is_dir'])
+        self.assertEqual(self.client.get_file('/back/new'), CONTENT)
+        self.assertEqual(self.client.get_file('/back/b/child.txt'), 'child')
+        self.assertEqual(sorted(m['path'] for m in self.client.metadata('/back')['contents']),
+                         ['/back/b', '/back/new'])
+
+if __name__ == '__main__':
+    unittest.main()
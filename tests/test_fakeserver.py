@@ -0,0 +1,164 @@
+import unittest
+import os.path
+import sys
+import shutil
+import hashlib
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, retry, cache, fakeserver
+
+CONTENT = ''.join(chr(i % 251) for i in range(100000))
+
+class TestFakeServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = fakeserver.FakeWeipanServer().start()
+        self.client = self.server.client()
+        self.file_path = os.path.join(self.tmp_dir, 'big.bin')
+        with open(self.file_path, 'wb') as fh:
+            fh.write(CONTENT)
+
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_and_get(self):
+        meta = self.client.put_file('/a/big.bin', self.file_path)
+        self.assertEqual(meta['bytes'], str(len(CONTENT)))
+        self.assertEqual(meta['sha1'], hashlib.sha1(CONTENT).hexdigest())
+        self.assertTrue(self.client.metadata('/a')['is_dir'])
+        self.assertEqual(self.client.get_file('/A/BIG.bin'), CONTENT)
+
+    def test_conflict_rename(self):
+        self.client.put_file('/big.bin', self.file_path)
+        meta = self.client.put_file('/big.bin', self.file_path, overwrite=False)
+        self.assertEqual(meta['path'], '/big (1).bin')
+        meta = self.client.put_file('/big.bin', self.file_path, parent_rev='0')
+        self.assertEqual(meta['path'], '/big (2).bin')
+
+    def test_revisions_and_restore(self):
+        first = self.client.put_file('/big.bin', self.file_path)
+        with open(self.file_path, 'wb') as fh:
+            fh.write('changed')
+        self.client.put_file('/big.bin', self.file_path)
+        self.assertEqual(len(self.client.revisions('/big.bin')), 2)
+        self.assertEqual(self.client.get_file('/big.bin', rev=first['rev']), CONTENT)
+        self.client.restore('/big.bin', first['rev'])
+        self.assertEqual(self.client.get_file('/big.bin'), CONTENT)
+
+    def test_get_by_rev_after_move(self):
+        self.client.put_file('/a/big.bin', self.file_path)
+        self.client.move('/a', '/b')
+        meta = self.client.metadata('/b/big.bin')
+        self.assertEqual(self.client.get_file('/b/big.bin', rev=meta['rev']), CONTENT)
+        entries = dict(self.client.delta()['entries'])
+        self.assertEqual(entries['/b/big.bin']['rev'], meta['rev'])
+
+    def test_metadata_not_modified(self):
+        self.client.create_folder('/dir')
+        c = self.server.client(metadata_cache=cache.LRUCache())
+        first = c.metadata('/dir')
+        self.assertTrue(c.metadata('/dir') is first)
+        self.client.create_folder('/dir/sub')
+        self.assertEqual(len(c.metadata('/dir')['contents']), 1)
+
+    def test_delta(self):
+        self.server.delta_limit = 2
+        for name in ['a', 'b', 'c']:
+            self.client.create_folder('/' + name)
+        rst = self.client.delta()
+        self.assertTrue(rst['reset'])
+        self.assertTrue(rst['has_more'])
+        rst2 = self.client.delta(rst['cursor'])
+        self.assertFalse(rst2['reset'])
+        self.assertFalse(rst2['has_more'])
+        self.assertEqual([k for k, meta in rst['entries'] + rst2['entries']], ['/a', '/b', '/c'])
+
+        self.client.move('/a', '/d')
+        self.client.delete('/b')
+        rst = self.client.delta(rst2['cursor'])
+        self.assertEqual(rst['entries'][0][0], '/a')
+        self.assertEqual(rst['entries'][0][1], None)
+        rst = self.client.delta(rst['cursor'])
+        self.assertEqual(rst['entries'], [['/b', None]])
+        self.assertFalse(rst['has_more'])
+
+    def test_range(self):
+        self.client.put_file('/big.bin', self.file_path)
+        to_path = os.path.join(self.tmp_dir, 'out.bin')
+        self.assertEqual(self.client.download_parallel('/big.bin', to_path, segment_size=30000), len(CONTENT))
+        with open(to_path, 'rb') as fh:
+            self.assertEqual(fh.read(), CONTENT)
+
+    def test_copy_ref(self):
+        self.client.put_file('/big.bin', self.file_path)
+        other = self.server.client('basic')
+        ref = self.client.copy_ref('/big.bin')['copy_ref']
+        meta = other.copy(None, '/copied.bin', from_copy_ref=ref)
+        self.assertEqual(meta['root'], 'basic')
+        self.assertEqual(other.get_file('/copied.bin'), CONTENT)
+
+    def test_errors(self):
+        self.assertRaises(request.ErrorResponse, self.client.metadata, '/missing')
+        self.client.create_folder('/dir')
+        try:
+            self.client.create_folder('/dir')
+        except request.ErrorResponse, e:
+            self.assertEqual(e.status, 403)
+        else:
+            self.fail('create_folder on an existing path')
+
+    def test_invalid_token(self):
+        self.client.session.set_token('other')
+        try:
+            self.client.account_info()
+        except request.ErrorResponse, e:
+            self.assertEqual(e.status, 401)
+        else:
+            self.fail('invalid token accepted')
+
+    def test_injected_failures(self):
+        impl = request.RequestObject(retry=retry.RetryPolicy(max_retries=2, backoff=0))
+        url = request.append_url(self.client.build_api_url('account/info'), {'access_token': self.server.token})
+        self.server.fail(503, count=2, path='account')
+        self.assertTrue('uid' in impl.get(url, format='json'))
+        self.server.fail(None, count=1)
+        self.assertTrue('uid' in impl.get(url, format='json'))
+        self.server.fail(500, count=3)
+        self.assertRaises(request.ErrorResponse, impl.get, url, format='json')
+        self.assertEqual(self.server.requests['/2/account/info'], 8)
+        impl.pool.clear()
+
+    def test_rate_limit(self):
+        self.server.bucket = fakeserver.ratelimit.TokenBucket(0.001, 2)
+        impl = request.RequestObject(retry=retry.RetryPolicy(max_retries=0))
+        url = request.append_url(self.client.build_api_url('account/info'), {'access_token': self.server.token})
+        impl.get(url, format='json')
+        impl.get(url, format='json')
+        try:
+            impl.get(url, format='json')
+        except request.ErrorResponse, e:
+            self.assertEqual(e.status, 429)
+            self.assertEqual(e.getheader('retry-after'), '1')
+        else:
+            self.fail('rate limit not applied')
+        impl.pool.clear()
+
+    def test_disk_store(self):
+        store_dir = os.path.join(self.tmp_dir, 'store')
+        server = fakeserver.FakeWeipanServer(store=fakeserver.FakeStore(store_dir)).start()
+        server.client().put_file('/big.bin', self.file_path)
+        request.Request.IMPL.pool.clear()
+        server.stop()
+
+        server = fakeserver.FakeWeipanServer(store=fakeserver.FakeStore(store_dir)).start()
+        try:
+            self.assertEqual(server.client().get_file('/big.bin'), CONTENT)
+        finally:
+            request.Request.IMPL.pool.clear()
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
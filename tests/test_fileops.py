@@ -0,0 +1,91 @@
+import unittest
+import os.path
+import sys
+import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import fileops
+
+class RecordingClient:
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.log = []
+
+    def call(self, name, *args):
+        with self.lock:
+            self.log.append(('start', name) + args)
+        time.sleep(self.delay)
+        with self.lock:
+            self.log.append(('end', name) + args)
+        if args[-1].endswith('fail'):
+            raise ValueError(args)
+        return {'path': args[-1]}
+
+    def create_folder(self, path):
+        return self.call('create_folder', path)
+
+    def move(self, from_path, to_path):
+        return self.call('move', from_path, to_path)
+
+    def copy(self, from_path, to_path, from_copy_ref=None):
+        return self.call('copy', from_path, to_path)
+
+    def delete(self, path):
+        return self.call('delete', path)
+
+class TestFileOpsBatch(unittest.TestCase):
+    def test_ancestors(self):
+        self.assertEqual(fileops.ancestors('/a/b/c'), ['/', '/a', '/a/b'])
+        self.assertEqual(fileops.ancestors('/'), [])
+
+    def test_dependencies(self):
+        batch = fileops.FileOpsBatch(None, [
+            ('create_folder', '/new'),
+            ('move', '/x', '/new/x'),
+            ('move', '/y', '/New/y'),
+            ('copy', '/z', '/other/z'),
+            ('delete', '/new'),
+            ('create_folder', '/other/sub/deep'),
+            ('delete', '/other')
+        ])
+        self.assertEqual(batch.dependencies(), [
+            set(),
+            set([0]),
+            set([0]),
+            set(),
+            set([0, 1, 2]),
+            set(),
+            set([3, 5])
+        ])
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, fileops.FileOpsBatch, None, [('rmtree', '/')])
+
+    def test_run(self):
+        client = RecordingClient(delay=0.05)
+        ops = [('create_folder', '/dst')] + [('move', '/src/%d' % i, '/dst/%d' % i) for i in range(8)]
+        start = time.time()
+        results = fileops.FileOpsBatch(client, ops, workers=8).run()
+        elapsed = time.time() - start
+
+        self.assertEqual([r.op for r in results], ops)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(results[3].result, {'path': '/dst/2'})
+        # the folder is created before anything is moved into it
+        self.assertEqual(client.log[:2], [('start', 'create_folder', '/dst'), ('end', 'create_folder', '/dst')])
+        self.assertTrue(elapsed < client.delay * 5)
+
+    def test_errors_do_not_stop_batch(self):
+        client = RecordingClient(delay=0)
+        results = fileops.FileOpsBatch(client, [
+            ('create_folder', '/fail'),
+            ('move', '/a', '/fail/a'),
+            ('delete', '/other/fail')
+        ]).run()
+        self.assertEqual([r.ok for r in results], [False, True, False])
+        self.assertTrue(isinstance(results[0].error, ValueError))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import os.path
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import hashing
+
+def digests(content):
+    return hashlib.md5(content).hexdigest(), hashlib.sha1(content).hexdigest()
+
+class CountingHasher(hashing.Hasher):
+    def __init__(self, *args, **kwargs):
+        hashing.Hasher.__init__(self, *args, **kwargs)
+        self.hashed = []
+
+    def hash_many(self, file_paths):
+        misses = [p for p in file_paths if self.cache is None or
+                  self.cache.get(hashing.file_key(os.stat(p))) is None]
+        self.hashed.extend(misses)
+        return hashing.Hasher.hash_many(self, file_paths)
+
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.contents = {}
+        for i, size in enumerate([0, 1, 100000, 3 * 1024 * 1024 + 7]):
+            path = os.path.join(self.tmp_dir, 'f%d' % i)
+            content = os.urandom(size)
+            with open(path, 'wb') as fh:
+                fh.write(content)
+            # old enough to be cached
+            os.utime(path, (time.time() - 60, time.time() - 60))
+            self.contents[path] = content
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hash_file(self):
+        for path, content in self.contents.items():
+            self.assertEqual(hashing.hash_file(path, chunk_size=65536), digests(content))
+
+    def test_hash_many(self):
+        hasher = hashing.Hasher(processes=2)
+        rst = hasher.hash_many(sorted(self.contents) * 2)
+        self.assertEqual(rst, dict((path, digests(c)) for path, c in self.contents.items()))
+
+    def test_cache(self):
+        cache = hashing.HashCache(os.path.join(self.tmp_dir, 'hashes.db'))
+        hasher = CountingHasher(cache, processes=2)
+        paths = sorted(self.contents)
+        hasher.hash_many(paths)
+        self.assertEqual(len(cache), 4)
+
+        # renamed files keep their entry, modified ones are hashed again
+        os.rename(paths[0], paths[0] + '.renamed')
+        with open(paths[1], 'wb') as fh:
+            fh.write('b')
+        os.utime(paths[1], (time.time() - 30, time.time() - 30))
+        rst = hasher.hash_many([paths[0] + '.renamed'] + paths[1:])
+        self.assertEqual(hasher.hashed, paths + [paths[1]])
+        self.assertEqual(rst[paths[1]], digests('b'))
+        cache.close()
+
+        cache = hashing.HashCache(os.path.join(self.tmp_dir, 'hashes.db'))
+        self.assertEqual(hashing.Hasher(cache).hash(paths[3]), digests(self.contents[paths[3]]))
+        cache.close()
+
+    def test_racy(self):
+        cache = hashing.HashCache(':memory:')
+        path = os.path.join(self.tmp_dir, 'new')
+        with open(path, 'wb') as fh:
+            fh.write('new')
+        self.assertEqual(hashing.Hasher(cache).hash(path), digests('new'))
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os.path
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, index, fakeserver
+
+class TestRemoteIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = fakeserver.FakeWeipanServer().start()
+        self.client = self.server.client()
+        store = self.server.store
+        store.put('sandbox', '/docs/Report 2014.txt', 'x' * 100)
+        store.put('sandbox', '/docs/report_final.txt', 'x' * 5000)
+        store.put('sandbox', '/docs/old/report.txt', 'y')
+        store.put('sandbox', '/music/song.mp3', 'z' * 20000)
+        self.index = index.RemoteIndex(self.client)
+        self.index.update()
+
+    def tearDown(self):
+        self.index.close()
+        request.Request.IMPL.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def paths(self, entries):
+        return [e['path'] for e in entries]
+
+    def test_search(self):
+        self.assertEqual(len(self.index), 7)
+        self.assertEqual(self.paths(self.index.search('/docs', 'REPORT')),
+                         ['/docs/old/report.txt', '/docs/Report 2014.txt', '/docs/report_final.txt'])
+        self.assertEqual(self.paths(self.index.search('/', 'report', file_limit=1)), ['/docs/old/report.txt'])
+        # LIKE wildcards are literal
+        self.assertEqual(self.paths(self.index.search('/', '_')), ['/docs/report_final.txt'])
+
+    def test_find(self):
+        self.assertEqual(self.paths(self.index.find(prefix='rep', min_size=50, max_size=5000)),
+                         ['/docs/Report 2014.txt', '/docs/report_final.txt'])
+        self.assertEqual(self.paths(self.index.find('/docs', is_dir=True)), ['/docs/old'])
+        self.assertEqual(self.paths(self.index.find(name='SONG.mp3')), ['/music/song.mp3'])
+        self.assertEqual(self.index.find(modified_after=time.time() + 3600), [])
+        self.assertEqual(len(self.index.find(modified_after=time.time() - 3600)), 7)
+        self.assertEqual(self.paths(self.index.listdir('/music')), ['/music/song.mp3'])
+        song = self.index.get('/Music/Song.mp3')
+        self.assertEqual(self.paths(self.index.by_sha1(song['sha1'])), ['/music/song.mp3'])
+
+    def test_update(self):
+        self.client.move('/docs', '/archive')
+        self.client.delete('/music/song.mp3')
+        self.client.create_folder('/new')
+        self.index.update()
+        self.assertEqual(self.index.find('/docs'), [])
+        self.assertEqual(self.index.get('/music/song.mp3'), None)
+        self.assertEqual(len(self.index.find('/archive')), 4)
+        self.assertTrue(self.index.get('/new')['is_dir'])
+
+    def test_stale_falls_back(self):
+        self.index.max_age = 0
+        time.sleep(0.01)
+        self.client.put_file('/docs/report_2015.txt', __file__)
+        self.assertEqual(len(self.index.search('/docs', 'report', file_limit=2)), 2)
+        self.assertEqual(self.server.requests['/2/search/sandbox/docs'], 1)
+        self.assertEqual(len(self.index.search('/docs', 'report')), 4)
+
+    def test_resume(self):
+        db_path = os.path.join(self.tmp_dir, 'index.db')
+        idx = index.RemoteIndex(self.client, db_path)
+        idx.update()
+        idx.close()
+        self.client.create_folder('/more')
+        idx = index.RemoteIndex(self.client, db_path)
+        self.assertEqual(idx.update(), 1)
+        self.assertEqual(len(idx), 8)
+        idx.close()
+
+if __name__ == '__main__':
+    unittest.main()
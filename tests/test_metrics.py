@@ -0,0 +1,109 @@
+import unittest
+import os.path
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, retry, metrics, fakeserver
+
+class Recorder(request.RequestHook):
+    def __init__(self):
+        self.calls = []
+
+    def before_request(self, info):
+        self.calls.append(('before', info.endpoint, info.status))
+
+    def after_response(self, info):
+        self.calls.append(('after', info.endpoint, info.status))
+
+    def on_error(self, info, error):
+        self.calls.append(('error', info.endpoint, info.status))
+
+class TestHelpers(unittest.TestCase):
+    def test_mask_url(self):
+        self.assertEqual(request.mask_url('http://h/2/account/info?access_token=secret&x=1'),
+                         'http://h/2/account/info?access_token=***&x=1')
+        self.assertEqual(request.mask_url('http://h/a?b=1&access_token=secret'), 'http://h/a?b=1&access_token=***')
+
+    def test_endpoint_name(self):
+        self.assertEqual(request.endpoint_name('http://openapi.vdisk.me/2/metadata/sandbox/a/b?list=true'), 'metadata')
+        self.assertEqual(request.endpoint_name('http://openapi.vdisk.me/2/fileops/copy'), 'fileops/copy')
+        self.assertEqual(request.endpoint_name('http://openapi.vdisk.me/2/account/info'), 'account/info')
+        self.assertEqual(request.endpoint_name('http://upload.openapi.vdisk.me/2/files_put/basic/a'), 'files_put')
+        self.assertEqual(request.endpoint_name('https://auth.sina.com.cn/oauth2/access_token'), 'oauth2/access_token')
+        self.assertEqual(request.endpoint_name('http://file.vdisk.me/abc?Expires=1'), 'file.vdisk.me')
+
+    def test_histogram(self):
+        h = metrics.Histogram([0.01, 0.1, 1])
+        for value in [0.005] * 90 + [0.05] * 9 + [5]:
+            h.add(value)
+        self.assertEqual(h.counts, [90, 9, 0, 1])
+        self.assertEqual(h.percentile(0.5), 0.01)
+        self.assertEqual(h.percentile(0.99), 0.1)
+        self.assertEqual(h.percentile(1), 5)
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        self.impl = request.Request.IMPL
+        request.Request.IMPL = request.RequestObject(retry=retry.RetryPolicy(backoff=0))
+        self.server = fakeserver.FakeWeipanServer().start()
+        self.recorder = Recorder()
+        self.metrics = metrics.MetricsCollector()
+        self.client = self.server.client(hooks=[self.recorder, self.metrics])
+
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+        request.Request.IMPL = self.impl
+        self.server.stop()
+
+    def test_calls(self):
+        self.client.create_folder('/a')
+        self.assertRaises(request.ErrorResponse, self.client.metadata, '/missing')
+        self.assertEqual(self.recorder.calls, [
+            ('before', 'fileops/create_folder', None),
+            ('after', 'fileops/create_folder', 200),
+            ('before', 'metadata', None),
+            ('error', 'metadata', 404)
+        ])
+
+    def test_redirect(self):
+        self.client.put_file('/a.txt', __file__)
+        self.client.get_file('/a.txt')
+        endpoints = [endpoint for call, endpoint, status in self.recorder.calls if call == 'after']
+        self.assertEqual(endpoints, ['files_put', 'files', '127.0.0.1'])
+
+    def test_info(self):
+        infos = []
+        hook = request.RequestHook()
+        hook.after_response = infos.append
+        request.Request.IMPL.pool.clear()
+        self.client.hooks.append(hook)
+        self.client.put_file('/a.txt', __file__)
+        self.client.account_info()
+
+        put, info = infos
+        self.assertEqual(put.bytes_sent, os.path.getsize(__file__))
+        self.assertTrue(put.timings['dns'] >= 0)
+        self.assertTrue(put.timings['connect'] >= 0)
+        self.assertTrue(put.timings['ttfb'] <= put.timings['total'])
+        self.assertTrue('access_token=***' in put.url)
+        self.assertEqual(info.timings['connect'], 0)
+        self.assertEqual(info.bytes_sent, 0)
+        self.assertTrue(info.bytes_received > 0)
+
+    def test_metrics(self):
+        self.server.fail(503, count=1, path='account')
+        self.client.account_info()
+        self.client.account_info()
+        self.assertRaises(request.ErrorResponse, self.client.metadata, '/missing')
+        stats = self.metrics.snapshot()
+        self.assertEqual(stats['account/info']['requests'], 2)
+        self.assertEqual(stats['account/info']['retries'], 1)
+        self.assertEqual(stats['account/info']['errors'], 0)
+        self.assertEqual(stats['account/info']['latency']['count'], 2)
+        self.assertEqual(stats['metadata']['errors'], 1)
+        self.assertEqual(stats['metadata']['statuses'], {404: 1})
+        self.assertEqual(len(self.metrics.slowest(1)), 1)
+        self.assertTrue('account/info' in str(self.metrics))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import os.path
+import sys
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import mirror
+
+class DeltaClient:
+    """
+    Serves queued delta pages and file contents
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.files = {}
+        self.downloads = []
+
+    def delta(self, cursor=None):
+        return self.pages[cursor]
+
+    def download_to(self, from_path, to, rev=None):
+        self.downloads.append(from_path)
+        with open(to, 'wb') as fh:
+            fh.write(self.files[(from_path, rev)])
+
+def file_meta(path, rev):
+    return {'path': path, 'rev': rev, 'is_dir': False}
+
+def dir_meta(path):
+    return {'path': path, 'is_dir': True}
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.state_dir = tempfile.mkdtemp()
+        self.client = DeltaClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+        shutil.rmtree(self.state_dir)
+
+    def mirror(self, remote_root='/'):
+        return mirror.Mirror(self.client, self.local_dir, remote_root, os.path.join(self.state_dir, 'state'), workers=4)
+
+    def read(self, *parts):
+        with open(os.path.join(self.local_dir, *parts), 'rb') as fh:
+            return fh.read()
+
+    def test_full_then_incremental(self):
+        self.client.files[('/Docs/a.txt', 'r1')] = 'a1'
+        self.client.files[('/Docs/b.txt', 'r1')] = 'b1'
+        self.client.files[('/top.txt', 'r1')] = 'top'
+        self.client.pages[None] = {'reset': True, 'cursor': 'c1', 'has_more': True, 'entries': [
+            ['/docs', dir_meta('/Docs')],
+            ['/docs/a.txt', file_meta('/Docs/a.txt', 'r1')],
+        ]}
+        self.client.pages['c1'] = {'reset': False, 'cursor': 'c2', 'has_more': False, 'entries': [
+            ['/docs/b.txt', file_meta('/Docs/b.txt', 'r1')],
+            ['/top.txt', file_meta('/top.txt', 'r1')],
+        ]}
+        stats = self.mirror().pull()
+        self.assertEqual(stats, {'downloaded': 3, 'deleted': 0, 'folders': 1})
+        self.assertEqual(self.read('Docs', 'a.txt'), 'a1')
+        self.assertEqual(self.read('top.txt'), 'top')
+
+        # rename b.txt to c.txt, update a.txt
+        self.client.files[('/Docs/a.txt', 'r2')] = 'a2'
+        self.client.files[('/Docs/c.txt', 'r1')] = 'b1'
+        self.client.pages['c2'] = {'reset': False, 'cursor': 'c3', 'has_more': False, 'entries': [
+            ['/docs/b.txt', None],
+            ['/docs/c.txt', file_meta('/Docs/c.txt', 'r1')],
+            ['/docs/a.txt', file_meta('/Docs/a.txt', 'r2')],
+        ]}
+        self.client.downloads = []
+        stats = self.mirror().pull()
+        self.assertEqual(stats, {'downloaded': 2, 'deleted': 1, 'folders': 0})
+        self.assertEqual(sorted(self.client.downloads), ['/Docs/a.txt', '/Docs/c.txt'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.local_dir, 'Docs'))), ['a.txt', 'c.txt'])
+        self.assertEqual(self.read('Docs', 'a.txt'), 'a2')
+
+        # folder deleted
+        self.client.pages['c3'] = {'reset': False, 'cursor': 'c4', 'has_more': False, 'entries': [
+            ['/docs', None],
+        ]}
+        self.mirror().pull()
+        self.assertEqual(os.listdir(self.local_dir), ['top.txt'])
+
+    def test_reset_prunes_and_skips_unchanged(self):
+        self.client.files[('/a.txt', 'r1')] = 'a'
+        self.client.files[('/b.txt', 'r1')] = 'b'
+        self.client.pages[None] = {'reset': True, 'cursor': 'c1', 'has_more': False, 'entries': [
+            ['/a.txt', file_meta('/a.txt', 'r1')],
+            ['/b.txt', file_meta('/b.txt', 'r1')],
+        ]}
+        self.mirror().pull()
+        self.client.pages['c1'] = {'reset': True, 'cursor': 'c2', 'has_more': False, 'entries': [
+            ['/a.txt', file_meta('/a.txt', 'r1')],
+        ]}
+        self.client.downloads = []
+        stats = self.mirror().pull()
+        self.assertEqual(self.client.downloads, [])
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(os.listdir(self.local_dir), ['a.txt'])
+
+    def test_folder_delete_unindexes_descendants(self):
+        self.client.files[('/a/x.txt', 'r1')] = 'x'
+        self.client.files[('/a-b/y.txt', 'r1')] = 'y'
+        self.client.files[('/a0/z.txt', 'r1')] = 'z'
+        self.client.pages[None] = {'reset': True, 'cursor': 'c1', 'has_more': False, 'entries': [
+            ['/a', dir_meta('/a')],
+            ['/a/x.txt', file_meta('/a/x.txt', 'r1')],
+            ['/a-b', dir_meta('/a-b')],
+            ['/a-b/y.txt', file_meta('/a-b/y.txt', 'r1')],
+            ['/a0', dir_meta('/a0')],
+            ['/a0/z.txt', file_meta('/a0/z.txt', 'r1')],
+        ]}
+        self.client.pages['c1'] = {'reset': False, 'cursor': 'c2', 'has_more': False, 'entries': [
+            ['/a', None],
+        ]}
+        self.mirror().pull()
+        m = self.mirror()
+        m.pull()
+        m.index = m.open_index()
+        keys = [row[0] for row in m.index.execute('SELECT key FROM entries ORDER BY key')]
+        m.index.close()
+        self.assertEqual(keys, ['/a-b', '/a-b/y.txt', '/a0', '/a0/z.txt'])
+        self.assertEqual(sorted(os.listdir(self.local_dir)), ['a-b', 'a0'])
+
+    def test_remote_root(self):
+        self.client.files[('/Photos/x.png', 'r1')] = 'x'
+        self.client.pages[None] = {'reset': True, 'cursor': 'c1', 'has_more': False, 'entries': [
+            ['/photos', dir_meta('/Photos')],
+            ['/photos/x.png', file_meta('/Photos/x.png', 'r1')],
+            ['/other.txt', file_meta('/other.txt', 'r1')],
+        ]}
+        self.mirror('/photos').pull()
+        self.assertEqual(os.listdir(self.local_dir), ['x.png'])
+
+    def test_failed_download_keeps_cursor(self):
+        self.client.pages[None] = {'reset': True, 'cursor': 'c1', 'has_more': False, 'entries': [
+            ['/missing.txt', file_meta('/missing.txt', 'r1')],
+        ]}
+        m = self.mirror()
+        self.assertRaises(KeyError, m.pull)
+        self.assertEqual(m.load_cursor(), None)
+        self.assertEqual(os.listdir(self.local_dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
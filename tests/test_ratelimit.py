@@ -0,0 +1,75 @@
+import unittest
+import os.path
+import sys
+import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import ratelimit, client, session, request, fakeserver
+from weipan.config import API_URL, UPLOAD_URL, AUTH_URL
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = ratelimit.TokenBucket(rate=50, burst=5)
+        start = time.time()
+        for i in range(5):
+            self.assertEqual(bucket.acquire(), 0)
+        self.assertTrue(time.time() - start < 0.01)
+        for i in range(5):
+            bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_shared_by_threads(self):
+        bucket = ratelimit.TokenBucket(rate=100, burst=1)
+        start = time.time()
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for i in range(5)]) for j in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 20 requests, the first one from the burst
+        self.assertTrue(time.time() - start >= 0.19)
+
+    def test_try_acquire(self):
+        bucket = ratelimit.TokenBucket(rate=0.001, burst=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        # a refused try takes nothing
+        self.assertTrue(0 <= bucket.tokens < 1)
+
+class TestRateLimiter(unittest.TestCase):
+    def test_endpoint_class(self):
+        self.assertEqual(ratelimit.endpoint_class(API_URL + 'metadata/sandbox'), 'api')
+        self.assertEqual(ratelimit.endpoint_class(UPLOAD_URL + 'files_put/sandbox/a'), 'upload')
+        self.assertEqual(ratelimit.endpoint_class(AUTH_URL + 'access_token'), 'auth')
+
+    def test_budgets(self):
+        limiter = ratelimit.RateLimiter(api=(1, 1), upload=None)
+        limiter.acquire(API_URL + 'account/info')
+        for i in range(10):
+            self.assertEqual(limiter.acquire(UPLOAD_URL + 'files_put/sandbox/a'), 0)
+        self.assertTrue(limiter.buckets['api'].reserve() > 0.9)
+
+    def test_client_delay(self):
+        sess = session.WeipanSession('key', 'secret', 'http://localhost/', 'sandbox')
+        c = client.WeipanClient(sess, delay=10)
+        # an idle client does not wait
+        self.assertEqual(c.rate_limiter.acquire(API_URL + 'account/info'), 0)
+        self.assertTrue(c.rate_limiter.buckets['api'].reserve() > 9)
+
+    def test_client_hosts(self):
+        server = fakeserver.FakeWeipanServer().start()
+        try:
+            limiter = ratelimit.RateLimiter(api=(1000, 1000), upload=(1000, 1000))
+            c = server.client(rate_limiter=limiter)
+            c.put_file('/a.txt', __file__)
+            c.account_info()
+            self.assertTrue(999 <= limiter.buckets['upload'].tokens < 1000)
+            self.assertTrue(999 <= limiter.buckets['api'].tokens < 1000)
+        finally:
+            request.Request.IMPL.pool.clear()
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
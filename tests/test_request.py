@@ -0,0 +1,282 @@
+import unittest
+import os.path
+import sys
+import json
+import threading
+import urlparse
+import hashlib
+import StringIO
+import tempfile
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, retry
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        urlinfo = urlparse.urlparse(self.path)
+        path = urlinfo.query and urlinfo.path + '?' + urlinfo.query or urlinfo.path
+        if path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', 'http://%s:%d/json' % self.server.server_address)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if path.startswith('/close'):
+            body = 'closed'
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+        elif path.startswith('/big'):
+            body = 'z' * 100000
+            self.send_response(200)
+        elif path.startswith('/missing'):
+            body = json.dumps({'error': 'missing'})
+            self.send_response(404)
+        else:
+            body = json.dumps({'path': path})
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        data = self.rfile.read(length)
+        self.server.posts += 1
+        if urlparse.urlparse(self.path).path.startswith('/drop'):
+            # processed, but the connection drops before the response
+            self.close_connection = 1
+            return
+        body = json.dumps({
+            'length': length,
+            'md5': hashlib.md5(data).hexdigest(),
+            'content_type': self.headers['Content-Type']
+        })
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    posts = 0
+
+    def handle_error(self, request, client_address):
+        # clients closing pooled connections is expected
+        pass
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.base = 'http://%s:%d' % self.server.server_address
+        self.impl = request.RequestObject()
+
+    def tearDown(self):
+        self.impl.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(5):
+            rst = self.impl.get(self.base + '/json', {'i': i}, format='json')
+            self.assertEqual(rst['path'], '/json?i=%d' % i)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reuse_after_redirect_and_error(self):
+        rst = self.impl.get(self.base + '/redirect', follow=True, format='json')
+        self.assertEqual(rst['path'], '/json')
+        self.assertRaises(request.ErrorResponse, self.impl.get, self.base + '/missing', format='json')
+        self.impl.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_close(self):
+        self.assertEqual(self.impl.get(self.base + '/close', format='plain'), 'closed')
+        self.assertEqual(self.impl.get(self.base + '/close', format='plain'), 'closed')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_dropped_connection(self):
+        self.impl.get(self.base + '/json', format='json')
+        for conns in self.impl.pool.idle.values():
+            for conn, released_at in conns:
+                conn.sock.close()
+        self.impl.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_no_resend_after_delivery(self):
+        impl = request.PooledTransport(retry=retry.RetryPolicy(max_retries=0))
+        try:
+            impl.get(self.base + '/json', format='json')
+            self.assertRaises(request.SocketError, impl.post, self.base + '/drop', {'a': 'b'}, format='json')
+            self.assertEqual(self.server.posts, 1)
+            self.assertEqual(self.server.connections, 1)
+        finally:
+            impl.close()
+
+    def test_idle_timeout(self):
+        self.impl.pool.idle_timeout = 0
+        self.impl.get(self.base + '/json', format='json')
+        self.impl.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_iter_response(self):
+        response = self.impl.get(self.base + '/big', format='response')
+        chunks = list(request.iter_response(response, 4096))
+        self.assertEqual(''.join(chunks), 'z' * 100000)
+        self.assertTrue(max(len(c) for c in chunks) <= 4096)
+        self.impl.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_release_partial_response(self):
+        response = self.impl.get(self.base + '/big', format='response')
+        response.read(10)
+        request.release_response(response)
+        self.impl.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_max_size(self):
+        pool = request.ConnectionPool(max_size=1)
+        key = ('http', '127.0.0.1', 80)
+        a = self.impl.connect(*key)
+        b = self.impl.connect(*key)
+        pool.release(key, a)
+        pool.release(key, b)
+        self.assertEqual(len(pool.idle[key]), 1)
+
+    def test_concurrent(self):
+        errors = []
+        def worker():
+            try:
+                for i in range(10):
+                    self.impl.get(self.base + '/json', format='json')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(self.server.connections <= 4)
+
+class TestTransports(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.base = 'http://%s:%d' % self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_simple(self):
+        transport = request.SimpleTransport()
+        for i in range(3):
+            self.assertEqual(transport.get(self.base + '/json', format='json')['path'], '/json')
+        self.assertEqual(transport.get(self.base + '/redirect', follow=True, format='json')['path'], '/json')
+        self.assertEqual(self.server.connections, 5)
+        self.assertEqual(sum(len(conns) for conns in transport.pool.idle.values()), 0)
+
+    def test_pooled(self):
+        transport = request.PooledTransport(max_size=2, idle_timeout=10)
+        for i in range(3):
+            transport.get(self.base + '/json', format='json')
+        self.assertEqual(self.server.connections, 1)
+        transport.close()
+        self.assertEqual(transport.pool.idle, {})
+
+    def test_per_client(self):
+        from weipan import client, session
+        transport = request.PooledTransport()
+        s = session.WeipanSession(None, None, None, transport=transport)
+        c = client.WeipanClient(s)
+        c.api_url = self.base + '/'
+        self.assertTrue(c.get_transport() is transport)
+        c.account_info()
+        self.assertEqual(len(transport.pool.idle), 1)
+        self.assertTrue(client.WeipanClient(s, transport=request.Request.IMPL).get_transport() is request.Request.IMPL)
+        transport.close()
+
+class TestMultipartBody(unittest.TestCase):
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, 'x' * 1000 + 'y' * 1000)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def test_same_as_joined_body(self):
+        with open(self.file_path, 'rb') as fh:
+            content = fh.read()
+        name = os.path.basename(self.file_path)
+        content_type, expected = request.encode_multipart_formdata([('overwrite', 'true')], [('file', name, content)])
+
+        body = request.MultipartBody([('overwrite', 'true')], [('file', name, self.file_path)], chunk_size=300)
+        chunks = list(body)
+        self.assertEqual(body.content_type, content_type)
+        self.assertEqual(''.join(chunks), expected)
+        self.assertEqual(len(body), len(expected))
+        self.assertTrue(max(len(c) for c in chunks) <= 300)
+
+    def test_post(self):
+        server = Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            impl = request.RequestObject()
+            rst = impl.post('http://%s:%d/upload' % server.server_address, {'@file': self.file_path, 'overwrite': 'true'}, format='json')
+        finally:
+            server.shutdown()
+            server.server_close()
+        body = request.MultipartBody([('overwrite', 'true')], [('file', os.path.basename(self.file_path), self.file_path)])
+        self.assertEqual(rst['length'], len(body))
+        self.assertEqual(rst['md5'], hashlib.md5(''.join(body)).hexdigest())
+        self.assertEqual(rst['content_type'], body.content_type)
+
+class TestStreamBody(unittest.TestCase):
+    def test_length(self):
+        body = request.StreamBody(StringIO.StringIO('a' * 250), 250, chunk_size=100)
+        self.assertEqual(body.headers(), {'Content-Length': '250'})
+        self.assertEqual([len(c) for c in body], [100, 100, 50])
+        self.assertEqual(request.body_length(body), 250)
+        self.assertRaises(ValueError, list, request.StreamBody(iter(['abc']), 4))
+        self.assertRaises(ValueError, list, request.StreamBody(iter(['abc', 'de']), 4))
+
+    def test_chunked(self):
+        body = request.StreamBody(iter(['abc', '', u'\xe9']))
+        self.assertEqual(body.headers(), {'Transfer-Encoding': 'chunked'})
+        self.assertEqual(''.join(body), '3\r\nabc\r\n2\r\n\xc3\xa9\r\n0\r\n\r\n')
+        self.assertEqual(request.body_length(body), None)
+
+    def test_rewind(self):
+        body = request.StreamBody(iter(['abc']))
+        self.assertTrue(request.rewind_body(body))
+        list(body)
+        self.assertFalse(request.rewind_body(body))
+
+        source = StringIO.StringIO('xyz')
+        source.read(1)
+        body = request.StreamBody(source, 2)
+        self.assertEqual(''.join(body), 'yz')
+        self.assertTrue(request.rewind_body(body))
+        self.assertEqual(''.join(body), 'yz')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import os.path
+import sys
+import json
+import socket
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, retry
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the queued statuses first, then 200
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self):
+        if self.command in ('POST', 'PUT'):
+            self.server.body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.hits += 1
+            status = self.server.statuses and self.server.statuses.pop(0) or 200
+        body = json.dumps({'hits': self.server.hits})
+        self.send_response(status)
+        if status in (429, 503) and self.server.retry_after is not None:
+            self.send_header('Retry-After', self.server.retry_after)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = reply
+
+    def log_message(self, format, *args):
+        return
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    hits = 0
+    retry_after = None
+
+    def handle_error(self, request, client_address):
+        pass
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), FlakyHandler)
+        self.server.lock = threading.Lock()
+        self.server.statuses = []
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.url = 'http://%s:%d/' % self.server.server_address
+        self.policy = retry.RetryPolicy(max_retries=3, backoff=0.001)
+        self.impl = request.RequestObject(retry=self.policy)
+
+    def tearDown(self):
+        self.impl.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_retried(self):
+        self.server.statuses = [503, 500]
+        self.assertEqual(self.impl.get(self.url, format='json'), {'hits': 3})
+        self.assertEqual(self.policy.counters['retries'], 2)
+        self.assertEqual(self.policy.counters['statuses'], 2)
+
+    def test_give_up(self):
+        self.server.statuses = [502] * 10
+        try:
+            self.impl.get(self.url, format='json')
+            self.fail()
+        except request.ErrorResponse, e:
+            self.assertEqual(e.status, 502)
+        self.assertEqual(self.server.hits, 4)
+        self.assertEqual(self.policy.counters['gave_up'], 1)
+
+    def test_post_not_retried(self):
+        self.server.statuses = [500]
+        self.assertRaises(request.ErrorResponse, self.impl.post, self.url, {'path': '/a'}, format='json')
+        self.assertEqual(self.server.hits, 1)
+
+    def test_post_retried_on_429(self):
+        self.server.statuses = [429]
+        self.assertEqual(self.impl.post(self.url, {'path': '/a'}, format='json'), {'hits': 2})
+
+    def test_client_error_not_retried(self):
+        self.server.statuses = [404]
+        self.assertRaises(request.ErrorResponse, self.impl.get, self.url, format='json')
+        self.assertEqual(self.server.hits, 1)
+
+    def test_retry_after(self):
+        self.server.statuses = [503]
+        self.server.retry_after = '0'
+        self.assertEqual(self.impl.get(self.url, format='json'), {'hits': 2})
+        # beyond the budget
+        self.server.statuses = [503]
+        self.server.retry_after = '3600'
+        self.assertRaises(request.ErrorResponse, self.impl.get, self.url, format='json')
+
+    def test_connect_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://%s:%d/' % sock.getsockname()
+        sock.close()
+        self.assertRaises(request.ConnectError, self.impl.post, url, {'path': '/a'}, format='json')
+        self.assertEqual(self.policy.counters['connect_errors'], 4)
+
+    def test_file_body_rewound(self):
+        import StringIO
+        body = StringIO.StringIO('skip' + 'content')
+        body.seek(4)
+        self.server.statuses = [503]
+        self.policy.idempotent_methods = ('GET', 'PUT')
+        self.impl.put(self.url, body=body, headers={'Content-Length': '7'}, format='json')
+        self.assertEqual(self.server.hits, 2)
+        self.assertEqual(self.server.body, 'content')
+
+    def test_backoff(self):
+        policy = retry.RetryPolicy(backoff=1, max_backoff=5, jitter=False)
+        self.assertEqual([policy.backoff_delay(i) for i in range(5)], [1, 2, 4, 5, 5])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import os.path
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import sync, fileops, request, hashing
+
+class FakeResponse:
+    reason = ''
+
+    def __init__(self, status):
+        self.status = status
+
+    def read(self):
+        return ''
+
+    def getheaders(self):
+        return []
+
+class TreeClient:
+    """
+    Keeps a remote tree in a dict of lowercased path => metadata
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = {}
+        self.calls = []
+
+    def add_folder(self, path):
+        self.tree[path.lower()] = {'path': path, 'is_dir': True, 'bytes': '0'}
+
+    def add_file(self, path, content):
+        self.tree[path.lower()] = {
+            'path': path,
+            'is_dir': False,
+            'bytes': str(len(content)),
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha1': hashlib.sha1(content).hexdigest()
+        }
+
+    def metadata(self, path, list=True):
+        key = path.lower()
+        if key != '/' and key not in self.tree:
+            raise request.ErrorResponse(FakeResponse(404))
+        meta = dict(self.tree.get(key, {'path': '/', 'is_dir': True}))
+        meta['contents'] = [m for k, m in sorted(self.tree.items())
+                            if k.rsplit('/', 1)[0] == key.rstrip('/')]
+        return meta
+
+    def put_file(self, path, file_path):
+        with self.lock:
+            self.calls.append(('put_file', path))
+        with open(file_path, 'rb') as fh:
+            self.add_file(path, fh.read())
+        return self.tree[path.lower()]
+
+    def create_folder(self, path):
+        with self.lock:
+            self.calls.append(('create_folder', path))
+        self.add_folder(path)
+        return self.tree[path.lower()]
+
+    def delete(self, path):
+        with self.lock:
+            self.calls.append(('delete', path))
+            for k in self.tree.keys():
+                if k == path.lower() or k.startswith(path.lower() + '/'):
+                    del self.tree[k]
+        return {'path': path, 'is_deleted': True}
+
+    def batch(self, ops, workers):
+        return fileops.FileOpsBatch(self, ops, workers).run()
+
+class TestSyncUp(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.client = TreeClient()
+        self.write('a.txt', 'aaa')
+        self.write('sub/b.txt', 'bbb')
+        self.write('sub/deep/c.txt', 'ccc')
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def write(self, relative, content):
+        local_path = os.path.join(self.local_dir, relative)
+        if not os.path.isdir(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        with open(local_path, 'wb') as fh:
+            fh.write(content)
+
+    def syncer(self, delete=False):
+        return sync.SyncUp(self.client, self.local_dir, '/backup', delete, workers=2)
+
+    def test_initial(self):
+        plan = self.syncer().plan()
+        self.assertEqual(plan.create_folders, ['/backup', '/backup/sub', '/backup/sub/deep'])
+        self.assertEqual(sorted(p for l, p in plan.uploads), ['/backup/a.txt', '/backup/sub/b.txt', '/backup/sub/deep/c.txt'])
+        self.assertTrue('3 to create, 3 to upload, 0 to delete, 0 unchanged' in str(plan))
+
+        plan = self.syncer().run(plan)
+        self.assertTrue(all(r.ok for r in plan.results))
+        self.assertEqual(len(self.syncer().plan()), 0)
+
+    def test_only_changes(self):
+        self.syncer().run()
+        self.write('sub/b.txt', 'BBB')
+        self.write('sub/new.txt', 'new')
+        self.client.calls = []
+        plan = self.syncer().run()
+        self.assertEqual(plan.unchanged, 2)
+        self.assertEqual(sorted(self.client.calls), [('put_file', '/backup/sub/b.txt'), ('put_file', '/backup/sub/new.txt')])
+
+    def test_delete(self):
+        self.syncer().run()
+        self.client.add_folder('/backup/old')
+        self.client.add_file('/backup/old/x.txt', 'x')
+        self.client.add_file('/backup/y.txt', 'y')
+
+        self.assertEqual(self.syncer().plan().deletes, [])
+        plan = self.syncer(delete=True).plan()
+        self.assertEqual(plan.deletes, ['/backup/old', '/backup/y.txt'])
+        self.syncer(delete=True).run(plan)
+        self.assertFalse('/backup/old/x.txt' in self.client.tree)
+
+    def test_type_change(self):
+        self.client.add_folder('/backup')
+        self.client.add_folder('/backup/a.txt')
+        plan = self.syncer().plan()
+        self.assertEqual(plan.deletes, ['/backup/a.txt'])
+        self.syncer().run(plan)
+        self.assertFalse(self.client.tree['/backup/a.txt']['is_dir'])
+
+    def test_type_change_delete(self):
+        self.client.add_folder('/backup')
+        self.client.add_folder('/backup/a.txt')
+        self.client.add_file('/backup/a.txt/inner.txt', 'inner')
+        plan = self.syncer(delete=True).plan()
+        # the children go with the folder
+        self.assertEqual(plan.deletes, ['/backup/a.txt'])
+        self.syncer(delete=True).run(plan)
+        self.assertTrue(all(r.ok for r in plan.results))
+        self.assertFalse('/backup/a.txt/inner.txt' in self.client.tree)
+
+    def test_hasher(self):
+        hashed = []
+
+        class Hasher(hashing.Hasher):
+            def hash_many(self, file_paths):
+                hashed.append(sorted(file_paths))
+                return hashing.Hasher.hash_many(self, file_paths)
+
+        self.syncer().run()
+        self.write('sub/b.txt', 'longer')
+        self.client.hasher = Hasher(processes=1)
+        plan = self.syncer().plan()
+        self.assertEqual(plan.unchanged, 2)
+        # the file whose size differs is not hashed, the others in one call
+        self.assertEqual(hashed, [[os.path.join(self.local_dir, 'a.txt'),
+                                   os.path.join(self.local_dir, 'sub', 'deep', 'c.txt')]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import unittest
+import os.path
+import sys
+import re
+import hashlib
+import tempfile
+import threading
+import socket
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import request, transfer
+
+CONTENT = ''.join(chr(i % 251) for i in range(100000))
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        rst = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if rst and self.server.support_range:
+            start, end = int(rst.group(1)), int(rst.group(2))
+            body = CONTENT[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(CONTENT)))
+        else:
+            body = CONTENT
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        with self.server.lock:
+            fail = self.server.failures > 0
+            self.server.failures -= 1
+        if fail:
+            # drop the connection halfway
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    support_range = True
+    failures = 0
+
+    def handle_error(self, request, client_address):
+        # clients closing pooled connections is expected
+        pass
+
+class StubClient:
+    def __init__(self, url, meta):
+        self.url = url
+        self.meta = meta
+
+    def metadata(self, path, list=True):
+        return self.meta
+
+    def revisions(self, path, rev_limit=None):
+        return self.revs
+
+    def get_file_url(self, path, rev=None):
+        return self.url
+
+class TestSegmentedDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), RangeHandler)
+        self.server.lock = threading.Lock()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.client = StubClient('http://%s:%d/file' % self.server.server_address, {
+            'bytes': str(len(CONTENT)),
+            'md5': hashlib.md5(CONTENT).hexdigest(),
+            'sha1': hashlib.sha1(CONTENT).hexdigest()
+        })
+        fd, self.to_path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        request.Request.IMPL.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.to_path)
+
+    def download(self, **kwargs):
+        return transfer.SegmentedDownload(self.client, '/file', self.to_path, segment_size=7000, **kwargs).run()
+
+    def read(self):
+        with open(self.to_path, 'rb') as fh:
+            return fh.read()
+
+    def test_download(self):
+        self.assertEqual(self.download(workers=4), len(CONTENT))
+        self.assertEqual(self.read(), CONTENT)
+
+    def test_retry_segment(self):
+        self.server.failures = 3
+        self.assertEqual(self.download(workers=2), len(CONTENT))
+        self.assertEqual(self.read(), CONTENT)
+
+    def test_too_many_failures(self):
+        self.server.failures = 100
+        self.assertRaises(transfer.TransferError, self.download, workers=1, retries=1)
+
+    def test_range_not_supported(self):
+        self.server.support_range = False
+        self.assertRaises(transfer.TransferError, self.download)
+
+    def test_checksum_mismatch(self):
+        self.client.meta['md5'] = hashlib.md5('other').hexdigest()
+        self.assertRaises(transfer.ChecksumError, self.download)
+
+    def test_old_rev(self):
+        # the latest revision is shorter than the one downloaded
+        old = dict(self.client.meta, rev='old')
+        self.client.meta = {'bytes': '10', 'rev': 'new', 'md5': hashlib.md5('0123456789').hexdigest()}
+        self.client.revs = [self.client.meta, old]
+        self.assertEqual(self.download(rev='old'), len(CONTENT))
+        self.assertEqual(self.read(), CONTENT)
+
+        old['md5'] = hashlib.md5('other').hexdigest()
+        self.assertRaises(transfer.ChecksumError, self.download, rev='old')
+        self.assertRaises(transfer.TransferError, self.download, rev='missing')
+
+    def test_empty_file(self):
+        self.client.meta = {'bytes': '0'}
+        self.assertEqual(self.download(), 0)
+        self.assertEqual(self.read(), '')
+
+class UploadClient:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.uploads = 0
+        self.remote = None
+
+    def put_file(self, path, file_path, overwrite=True):
+        if self.failures:
+            self.failures -= 1
+            raise socket.error('connection reset')
+        self.uploads += 1
+        with open(file_path, 'rb') as fh:
+            self.remote = {'path': path, 'sha1': hashlib.sha1(fh.read()).hexdigest()}
+        return self.remote
+
+    def metadata(self, path, list=True):
+        if self.remote is None:
+            raise request.ErrorResponse(FakeResponse(404))
+        return self.remote
+
+class FakeResponse:
+    reason = ''
+
+    def __init__(self, status):
+        self.status = status
+
+    def read(self):
+        return ''
+
+    def getheaders(self):
+        return []
+
+class TestVerifiedUpload(unittest.TestCase):
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp()
+        os.write(fd, CONTENT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def upload(self, client, **kwargs):
+        return transfer.VerifiedUpload(client, '/big.bin', self.file_path, retry_delay=0, **kwargs).run()
+
+    def test_upload(self):
+        client = UploadClient()
+        rst = self.upload(client)
+        self.assertEqual(rst['sha1'], hashlib.sha1(CONTENT).hexdigest())
+        self.assertEqual(client.uploads, 1)
+
+    def test_retry(self):
+        client = UploadClient(failures=2)
+        self.upload(client, retries=2)
+        self.assertEqual(client.uploads, 1)
+        client = UploadClient(failures=2)
+        self.assertRaises(socket.error, self.upload, client, retries=1)
+
+    def test_already_uploaded(self):
+        client = UploadClient()
+        client.put_file('/big.bin', self.file_path)
+        self.upload(client)
+        self.assertEqual(client.uploads, 1)
+
+    def test_changed_remote(self):
+        client = UploadClient()
+        client.remote = {'path': '/big.bin', 'sha1': hashlib.sha1('other').hexdigest()}
+        self.upload(client)
+        self.assertEqual(client.uploads, 1)
+
+if __name__ == '__main__':
+    unittest.main()
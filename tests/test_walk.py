@@ -0,0 +1,77 @@
+import unittest
+import os.path
+import sys
+import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from weipan import walk
+
+class TreeClient:
+    """
+    Folders /d<i> each holding folders /d<i>/e<j> which each hold one file
+    """
+
+    def __init__(self, width=4, delay=0.02):
+        self.width = width
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def metadata(self, path, list=True):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        if path.endswith('broken'):
+            raise ValueError(path)
+        depth = path.rstrip('/').count('/')
+        if depth == 0:
+            contents = [{'path': '/d%d' % i, 'is_dir': True} for i in range(self.width)]
+            contents.append({'path': '/broken', 'is_dir': True})
+        elif depth == 1:
+            contents = [{'path': '%s/e%d' % (path, j), 'is_dir': True} for j in range(self.width)]
+        else:
+            contents = [{'path': path + '/f.txt', 'is_dir': False}]
+        return {'path': path, 'is_dir': True, 'contents': contents}
+
+class TestWalk(unittest.TestCase):
+    def test_walk(self):
+        client = TreeClient()
+        errors = []
+        start = time.time()
+        paths = [e['path'] for e in walk.walk(client, '/', onerror=errors.append, workers=8)]
+        elapsed = time.time() - start
+
+        self.assertEqual(len(paths), 4 + 1 + 16 + 16)
+        self.assertEqual(len(set(paths)), len(paths))
+        self.assertTrue('/d3/e2/f.txt' in paths)
+        # breadth first
+        self.assertTrue(paths.index('/d3') < paths.index('/d0/e0'))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(client.max_running, 8)
+        # 1 + 5 + 16 listings, 8 at a time
+        self.assertTrue(elapsed < client.delay * 12)
+
+    def test_error(self):
+        self.assertRaises(ValueError, list, walk.walk(TreeClient(delay=0), '/'))
+
+    def test_max_depth(self):
+        paths = [e['path'] for e in walk.walk(TreeClient(delay=0), '/', max_depth=2, onerror=lambda e: None)]
+        self.assertEqual(len(paths), 4 + 1 + 16)
+
+    def test_filter(self):
+        paths = [e['path'] for e in walk.walk(TreeClient(delay=0), '/', filter=lambda e: not e['path'].startswith('/d1') and e['path'] != '/broken')]
+        self.assertEqual(len(paths), 3 + 12 + 12)
+        self.assertFalse([p for p in paths if p.startswith('/d1')])
+
+    def test_abandon(self):
+        entries = walk.walk(TreeClient(delay=0), '/')
+        self.assertEqual(entries.next()['path'], '/d0')
+        entries.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous Weipan API client
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .client import WeipanClient
+from .config import *
+
+# WeipanClient methods exposed by WeipanAsyncClient
+API_METHODS = [
+    'account_info',
+    'delta',
+    'get_file',
+    'get_file_stream',
+    'download_to',
+    'download_parallel',
+    'get_file_url',
+    'put_file',
+    'put_stream',
+    'put_bytes',
+    'put_file_verified',
+    'post_file',
+    'metadata',
+    'revisions',
+    'restore',
+    'search',
+    'shares',
+    'copy_ref',
+    'media',
+    'get_thumbnail',
+    'get_thumbnail_url',
+    'copy',
+    'create_folder',
+    'delete',
+    'move',
+    'share_media'
+]
+
+class WeipanAsyncClient:
+    """
+    Weipan API client whose methods return immediately
+
+    Every API method of WeipanClient is available with the same arguments,
+    plus an optional callback, and returns a multiprocessing.pool.AsyncResult.
+    Calls run on a pool of `concurrency` workers sharing the keep-alive
+    connection pool, and submitting blocks once `max_pending` calls are
+    queued or running. With a single_flight, identical calls in flight at
+    once are answered by one request.
+    """
+
+    def __init__(self, session, concurrency=ASYNC_CONCURRENCY, max_pending=ASYNC_MAX_PENDING, client=None, **kwargs):
+        """
+        client: WeipanClient to run calls with, created from session and kwargs by default
+        """
+        self.client = client or WeipanClient(session, **kwargs)
+        self.pool = ThreadPool(concurrency)
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the pool, return an AsyncResult
+        """
+        callback = kwargs.pop('callback', None)
+        self.pending.acquire()
+
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.pending.release()
+        try:
+            return self.pool.apply_async(run, callback=callback)
+        except:
+            self.pending.release()
+            raise
+
+    def map(self, method, args_list):
+        """
+        Call an API method once for each argument tuple, return results in order
+
+        The first exception raised by a call is raised.
+        """
+        results = [getattr(self, method)(*args) for args in args_list]
+        return [r.get() for r in results]
+
+    def close(self):
+        """
+        Wait for submitted calls and stop the workers
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _api_method(name):
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.client, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "Asynchronous WeipanClient.%s, returns an AsyncResult" % name
+    return method
+
+for _name in API_METHODS:
+    setattr(WeipanAsyncClient, _name, _api_method(_name))
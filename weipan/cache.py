@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caches for API results
+"""
+
+import os
+import json
+import time
+import hashlib
+import urlparse
+import threading
+import email.utils
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .config import *
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache bounded by entry count and age
+    """
+
+    def __init__(self, max_size=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL):
+        """
+        max_size: max entries, the least recently used is evicted first
+        ttl: seconds an entry is kept, None for no limit
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                return None
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskCache:
+    """
+    JSON values stored as files in a directory, bounded by age
+
+    Entries survive restarts and can be shared by processes, each write
+    goes to a temp file renamed into place.
+    """
+
+    def __init__(self, directory, ttl=METADATA_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def file_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.json')
+
+    def get(self, key):
+        file_path = self.file_path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(file_path) > self.ttl:
+                os.remove(file_path)
+                return None
+            with open(file_path, 'rb') as fh:
+                return json.load(fh)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def set(self, key, value):
+        file_path = self.file_path(key)
+        tmp_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as fh:
+            json.dump(value, fh)
+        os.rename(tmp_path, file_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self.file_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+def parse_expires(value):
+    """
+    Unix time from a timestamp or an HTTP date, None if it can not be parsed
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    date = email.utils.parsedate_tz(value or '')
+    if date is None:
+        return None
+    return email.utils.mktime_tz(date)
+
+def url_expires(value):
+    """
+    Expiry of a signed URL (its Expires query parameter) or of a media
+    result (its expires field), None when unknown
+    """
+    if isinstance(value, dict):
+        return parse_expires(value.get('expires'))
+    query = urlparse.parse_qs(urlparse.urlparse(value).query)
+    for name in ('Expires', 'expires'):
+        if name in query:
+            return parse_expires(query[name][0])
+    return None
+
+class URLCache:
+    """
+    Thread-safe LRU cache of time-limited URLs
+
+    Entries expire with the URL they hold, or after default_ttl when the
+    URL carries no expiry. A hit in the last `refresh_ahead` fraction of
+    the lifetime is served at once while a background thread fetches a
+    fresh URL.
+    """
+
+    def __init__(self, max_size=URL_CACHE_SIZE, default_ttl=URL_CACHE_TTL, refresh_ahead=URL_CACHE_REFRESH_AHEAD):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.refresh_ahead = refresh_ahead
+        self.lock = threading.Lock()
+        # key => (value, stored_at, expires_at)
+        self.entries = OrderedDict()
+        self.refreshing = set()
+
+    def store(self, key, value):
+        now = time.time()
+        expires_at = url_expires(value)
+        if expires_at is None:
+            expires_at = now + self.default_ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now, expires_at)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def refresh(self, key, fetch):
+        try:
+            self.store(key, fetch())
+        except Exception:
+            # the next get after expiry fetches again and raises
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def get(self, key, fetch):
+        """
+        Return the cached value for key, calling fetch() for a missing or expired one
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and now < entry[2]:
+                self.entries[key] = entry
+                value, stored_at, expires_at = entry
+                refresh = now > expires_at - (expires_at - stored_at) * self.refresh_ahead and key not in self.refreshing
+                if refresh:
+                    self.refreshing.add(key)
+            else:
+                entry = None
+        if entry is None:
+            value = fetch()
+            self.store(key, value)
+            return value
+        if refresh:
+            t = threading.Thread(target=self.refresh, args=(key, fetch))
+            t.setDaemon(True)
+            t.start()
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class FileCache:
+    """
+    Files in a directory bounded by their total size, least recently used evicted first
+
+    Entries are named after the sha1 of their key and written to a temp
+    file renamed into place, so readers never see partial entries. Reads
+    touch the mtime, which eviction orders by. Several processes may share
+    a directory: the total size is kept in a file updated under a file
+    lock by every add, so the budget counts the entries of all of them,
+    and a file opened before its entry is evicted stays readable.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            lock_file = self.lock_directory()
+            try:
+                self.size = sum(size for file_path, size, mtime in self.scan())
+                self.write_size(self.size)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    def file_path(self, key):
+        name = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def scan(self):
+        """
+        Yield (file_path, size, mtime) of every entry
+        """
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue
+                file_path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                yield file_path, st.st_size, st.st_mtime
+
+    def size_path(self):
+        # named like a temp file so scan() skips it
+        return os.path.join(self.directory, 'size.tmp')
+
+    def read_size(self):
+        """
+        Total size of the entries of all processes, call with the directory locked
+        """
+        try:
+            with open(self.size_path(), 'rb') as fh:
+                return int(fh.read())
+        except (IOError, ValueError):
+            return sum(size for file_path, size, mtime in self.scan())
+
+    def write_size(self, size):
+        with open(self.size_path(), 'wb') as fh:
+            fh.write(str(size))
+
+    def touch(self, file_path):
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            pass
+
+    def get(self, key):
+        """
+        Content for key, None on a miss
+        """
+        file_path = self.file_path(key)
+        try:
+            with open(file_path, 'rb') as fh:
+                data = fh.read()
+        except IOError:
+            return None
+        self.touch(file_path)
+        return data
+
+    def set(self, key, data):
+        self.add(key, lambda fh: fh.write(data)).close()
+
+    def open(self, key, fill=None):
+        """
+        Open the entry for key for reading
+
+        On a miss the entry is added with fill if given, otherwise None is returned.
+        """
+        file_path = self.file_path(key)
+        try:
+            fh = open(file_path, 'rb')
+        except IOError:
+            if fill is None:
+                return None
+            return self.add(key, fill)
+        self.touch(file_path)
+        return fh
+
+    def add(self, key, fill):
+        """
+        Store the entry written by fill(fh) into a temp file, return it opened for reading
+
+        The returned file stays readable even if the entry gets evicted.
+        """
+        file_path = self.file_path(key)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            try:
+                os.makedirs(os.path.dirname(file_path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(file_path)):
+                    raise
+        tmp_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'wb') as fh:
+                fill(fh)
+            size = os.path.getsize(tmp_path)
+            fh = open(tmp_path, 'rb')
+            with self.lock:
+                lock_file = self.lock_directory()
+                try:
+                    try:
+                        # an entry replaced by the rename
+                        size -= os.path.getsize(file_path)
+                    except OSError:
+                        pass
+                    os.rename(tmp_path, file_path)
+                    self.size = self.read_size() + size
+                    if self.size > self.max_bytes:
+                        self.shrink(keep=file_path)
+                    else:
+                        self.write_size(self.size)
+                finally:
+                    if lock_file is not None:
+                        lock_file.close()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return fh
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries down to 90% of max_bytes
+
+        keep: path of an entry not to remove, the one just added
+        """
+        with self.lock:
+            lock_file = self.lock_directory()
+            try:
+                self.shrink(keep)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    def shrink(self, keep=None):
+        """
+        evict() with the locks held
+        """
+        entries = sorted(self.scan(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for file_path, entry_size, mtime in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            if file_path == keep:
+                continue
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            size -= entry_size
+        self.size = size
+        self.write_size(size)
+
+    def lock_directory(self):
+        """
+        Lock the directory against adds and evictions by other processes, None where unsupported
+        """
+        if fcntl is None:
+            return None
+        # named like a temp file so scan() skips it
+        lock_file = open(os.path.join(self.directory, 'lock.tmp'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def clear(self):
+        with self.lock:
+            lock_file = self.lock_directory()
+            try:
+                for file_path, size, mtime in list(self.scan()):
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                self.size = 0
+                self.write_size(0)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
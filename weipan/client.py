@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from . import request, session
+from . import request, session, transfer, fileops, walk, ratelimit
 from .config import *
 import re
-import time
+import urllib
+from multiprocessing.pool import ThreadPool
 
 def format_path(path):
     """Normalize path for use with the Weipan API.
@@ -27,13 +28,45 @@ class WeipanClient:
     Weipan API client
     """
 
-    def __init__(self, session, debug=False, delay=None):
-        """
-        delay: fix api delay
+    # hosts, overridden per client for a fakeserver.FakeWeipanServer
+    api_url = API_URL
+    upload_url = UPLOAD_URL
+
+    def __init__(self, session, debug=False, delay=None, metadata_cache=None, rate_limiter=None, url_cache=None,
+                 thumbnail_cache=None, blob_cache=None, hooks=None, transport=None, single_flight=None,
+                 hasher=None):
+        """
+        delay: min seconds between requests, shortcut for RateLimiter.from_delay(delay)
+        metadata_cache: cache.LRUCache or cache.DiskCache, cached listings are
+            revalidated with their hash and served when not modified
+        rate_limiter: ratelimit.RateLimiter, may be shared with other clients
+        url_cache: cache.URLCache for get_file_url, get_thumbnail_url, media and share_media,
+            may be shared with clients of other accounts
+        thumbnail_cache: cache.FileCache for thumbnails, keyed by path, rev and size
+        blob_cache: cache.FileCache for get_file and download_to, keyed by path and rev
+        hooks: request.RequestHook objects called for each request, like metrics.MetricsCollector
+        transport: request.Transport for this client, by default the one of the
+            session if set, else request.Request.IMPL
+        single_flight: coalesce.SingleFlight, identical GETs and redirect lookups
+            made while one is in flight share its result, may be shared with
+            other clients
+        hasher: hashing.Hasher for local files, used by sync_up,
+            put_file_verified and the verification of download_parallel
         """
         self.session = session
         self.is_debug = debug
         self.delay = delay
+        self.metadata_cache = metadata_cache
+        self.url_cache = url_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.blob_cache = blob_cache
+        self.hooks = list(hooks or [])
+        self.transport = transport
+        self.single_flight = single_flight
+        self.hasher = hasher
+        if rate_limiter is None and delay:
+            rate_limiter = ratelimit.RateLimiter.from_delay(delay)
+        self.rate_limiter = rate_limiter
 
     def debug(self, message = None):
         """
@@ -44,23 +77,73 @@ class WeipanClient:
         elif self.is_debug:
             print "[DEBUG] %s" % message
 
+    def get_transport(self):
+        return self.transport or getattr(self.session, 'transport', None) or request.Request.IMPL
+
     def build_api_url(self, target, params=None):
-        return request.append_url("://" in target and target or (API_URL + target), params)
+        return request.append_url("://" in target and target or (self.api_url + target), params)
 
     def request(self, method, target, params=None, body=None, follow=False, format='json'):
         """
         format: json|raw
         """
 
-        # delay request(prevent API server delay)
-        if self.delay:
-            time.sleep(self.delay)
-
         url = self.build_api_url(target, {
             'access_token': self.session.token
         })
-        self.debug("[%s %s] %s" % (method, format, url))
-        return request.Request.request(method, url, params, body, follow=follow, format=format)
+
+        # a streamed response can only be read once
+        if method == 'GET' and body is None and format in ['json', 'plain']:
+            key = (method, url, urllib.urlencode(sorted((params or {}).items())), follow, format)
+            return self.coalesce(key, lambda: self.send(method, url, params, body, follow, format))
+        return self.send(method, url, params, body, follow, format)
+
+    def send(self, method, url, params, body, follow, format):
+        # stay within the API quota
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(url, url.startswith(self.upload_url) and 'upload' or 'api')
+
+        self.debug("[%s %s] %s" % (method, format, request.mask_url(url)))
+        return self.get_transport().request(method, url, params, body, follow=follow, format=format, hooks=self.hooks)
+
+    def coalesce(self, key, func):
+        """
+        func() through single_flight, keyed by key
+        """
+        if self.single_flight is None:
+            return func()
+        return self.single_flight.do(key, func)
+
+    def redirect_location(self, target, params=None):
+        """
+        Location of the 302 redirect answered for target
+        """
+        key = ('location', self.session.token, self.cache_key(target, params or {}))
+        return self.coalesce(key, lambda: self.fetch_location(target, params))
+
+    def fetch_location(self, target, params):
+        try:
+            r = self.get(target, params, format=None)
+            raise request.ErrorResponse(r)
+        except request.ErrorResponse, e:
+            if e.status == 302:
+                return e.getheader('location')
+            else:
+                raise e
+
+    def cache_key(self, target, params):
+        return request.append_url(request.encode_value(target.lower()), urllib.urlencode(sorted(params.items())))
+
+    def cached_url(self, target, params, fetch):
+        """
+        fetch() through url_cache, keyed by the session token, target and params
+
+        Signed URLs belong to an account, the token keeps a cache shared
+        between clients of several accounts from mixing them.
+        """
+        if self.url_cache is None:
+            return fetch()
+        return self.url_cache.get((self.session.token, self.cache_key(target, params)), fetch)
 
     def get(self, target, params=None, follow=False, format='json'):
         return self.request('GET', target, params, follow=follow, format=format)
@@ -89,7 +172,13 @@ class WeipanClient:
     def get_file(self, from_path, rev=None, return_content=True):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#files_get
+
+        With a blob_cache, content is served from the cache.
         """
+        if self.blob_cache is not None and return_content:
+            with self.open_blob(from_path, rev) as fh:
+                return fh.read()
+
         path = "files/%s%s" % (self.session.root, format_path(from_path))
 
         params = {}
@@ -97,6 +186,51 @@ class WeipanClient:
             params['rev'] = rev
         return self.get(path, params, follow=True, format=return_content and 'plain' or 'response')
 
+    def get_file_stream(self, from_path, rev=None):
+        """
+        Open a remote file for streaming, the 302 redirect is followed
+
+        Read the returned response with request.iter_response(), which
+        releases the connection when done.
+        """
+        return self.get_file(from_path, rev, return_content=False)
+
+    def download_to(self, from_path, to, rev=None, chunk_size=CHUNK_SIZE):
+        """
+        Download a remote file to a local path or a writable file object in chunks
+
+        Returns bytes written. A partially written local path is removed on error.
+        With a blob_cache, the file is copied from the cache.
+        """
+        if self.blob_cache is not None:
+            with self.open_blob(from_path, rev) as source:
+                return transfer.write_to(to, lambda fh: transfer.copy_file(source, fh, chunk_size))
+
+        response = self.get_file_stream(from_path, rev)
+        try:
+            return transfer.write_to(to, lambda fh: request.copy_response(response, fh, chunk_size))
+        finally:
+            request.release_response(response)
+
+    def open_blob(self, from_path, rev=None):
+        """
+        Open the blob_cache copy of a file revision, downloading it on a miss
+
+        rev: the latest revision is looked up with metadata by default
+        """
+        if rev is None:
+            rev = self.metadata(from_path, list=False)['rev']
+        key = request.encode_value(u"%s%s?rev=%s" % (self.session.root, format_path(from_path).lower(), rev))
+        return self.blob_cache.open(key, lambda fh: request.copy_response(self.get_file_stream(from_path, rev), fh))
+
+    def download_parallel(self, from_path, to_path, rev=None, workers=SEGMENT_WORKERS, segment_size=SEGMENT_SIZE):
+        """
+        Download a large file with parallel HTTP Range requests
+
+        The result is verified against md5/sha1 of the revision, returns bytes written.
+        """
+        return transfer.SegmentedDownload(self, from_path, to_path, rev, workers, segment_size).run()
+
     def get_file_url(self, from_path, rev=None):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#files_get
@@ -105,20 +239,33 @@ class WeipanClient:
         params = {}
         if rev is not None:
             params['rev'] = rev
-        try:
-            r = self.get(path, params, format=None)
-            raise request.ErrorResponse(r)
-        except request.ErrorResponse, e:
-            if e.status == 302:
-                return e.getheader('location')
-            else:
-                raise e
+        return self.cached_url(path, params, lambda: self.redirect_location(path, params))
 
     def put_file(self, path, file_path, overwrite = True, parent_rev = None):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#files_put
         """
-        path = "%sfiles_put/%s%s" % (UPLOAD_URL, self.session.root, format_path(path))
+        with open(file_path, 'rb') as fh:
+            return self.put_body(path, fh, overwrite, parent_rev)
+
+    def put_stream(self, path, source, length=None, overwrite=True, parent_rev=None, chunk_size=CHUNK_SIZE):
+        """
+        Upload from a file-like object or an iterator of strings, see request.StreamBody
+
+        length: bytes the source holds, when known, else the body is sent
+            with chunked transfer encoding
+        The source is read chunk_size bytes at a time and is not closed.
+        """
+        return self.put_body(path, request.StreamBody(source, length, chunk_size), overwrite, parent_rev)
+
+    def put_bytes(self, path, data, overwrite=True, parent_rev=None):
+        """
+        Upload a string as the content of a file
+        """
+        return self.put_body(path, request.encode_value(data), overwrite, parent_rev)
+
+    def put_body(self, path, body, overwrite=True, parent_rev=None):
+        path = "%sfiles_put/%s%s" % (self.upload_url, self.session.root, format_path(path))
 
         params = {
             'overwrite': overwrite and 'true' or 'false'
@@ -127,14 +274,31 @@ class WeipanClient:
         if parent_rev is not None:
             params['parent_rev'] = parent_rev
 
-        return self.put(path, params, open(file_path, 'rb'))
+        return self.put(path, params, body)
+
+    def put_file_verified(self, path, file_path, overwrite=True, retries=UPLOAD_RETRIES):
+        """
+        put_file with retries and a sha1 check, see transfer.VerifiedUpload
+
+        Nothing is sent when the remote file already has the same content.
+        """
+        return transfer.VerifiedUpload(self, path, file_path, overwrite, retries).run()
+
+    def put_file_dedup(self, path, file_path, content_map, overwrite=True):
+        """
+        put_file which copies a remote file with the same content instead, see dedup.DedupUpload
+
+        content_map: dedup.ContentMap of the known remote files
+        """
+        from . import dedup
+        return dedup.DedupUpload(self, path, file_path, content_map, overwrite).run()
 
     def post_file(self, path, file_path, overwrite = True, parent_rev = None):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#files_post
         todo
         """
-        path = "%sfiles/%s%s" % (UPLOAD_URL, self.session.root, format_path(path))
+        path = "%sfiles/%s%s" % (self.upload_url, self.session.root, format_path(path))
 
         params = {
             'overwrite': overwrite and 'true' or 'false'
@@ -154,9 +318,32 @@ class WeipanClient:
             'list': list and 'true' or 'false',
             'include_deleted': include_deleted and 'true' or 'false'
         }
+
+        key = cached = None
+        if self.metadata_cache is not None and hash is None:
+            key = self.cache_key(path, params)
+            cached = self.metadata_cache.get(key)
+            if cached is not None:
+                hash = cached['hash']
+
         if hash is not None:
             params['hash'] = hash
-        return self.get(path, params)
+        try:
+            rst = self.get(path, params)
+        except request.ErrorResponse, e:
+            if e.status == 304 and cached is not None:
+                return cached
+            raise
+
+        if key is not None and rst.get('hash'):
+            self.metadata_cache.set(key, rst)
+        return rst
+
+    def walk(self, root, max_depth=None, filter=None, onerror=None, workers=WALK_WORKERS):
+        """
+        Recursively list root with concurrent metadata calls, see walk.walk
+        """
+        return walk.walk(self, root, max_depth, filter, onerror, workers)
 
     def revisions(self, path, rev_limit=None):
         """
@@ -187,6 +374,8 @@ class WeipanClient:
             'query': query,
             'include_deleted': include_deleted and 'true' or 'false'
         }
+        if file_limit is not None:
+            params['file_limit'] = file_limit
         return self.get(path, params)
 
     def shares(self, path, cancel=False):
@@ -211,17 +400,58 @@ class WeipanClient:
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#media
         """
         path = "media/%s%s" % (self.session.root, format_path(path))
-        return self.get(path)
+        return self.cached_url(path, {}, lambda: self.get(path))
 
-    def get_thumbnail(self, path, size, return_content=True):
+    def get_thumbnail(self, path, size, return_content=True, rev=None):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#thumbnails
+
+        With a thumbnail_cache, content is served from disk once fetched.
+        rev: rev of the image if known, otherwise it is read from metadata
         """
+        key = None
+        if self.thumbnail_cache is not None and return_content:
+            if rev is None:
+                rev = self.metadata(path, list=False)['rev']
+            key = request.encode_value(u"%s%s?rev=%s&size=%s" % (self.session.root, format_path(path).lower(), rev, size))
+
         path = "thumbnails/%s%s" % (self.session.root, format_path(path))
         params = {
             'size': size
         }
-        return self.get(path, params, follow=True, format=return_content and 'plain' or None)
+        if key is None:
+            return self.get(path, params, follow=True, format=return_content and 'plain' or None)
+
+        content = self.thumbnail_cache.get(key)
+        if content is None:
+            content = self.get(path, params, follow=True, format='plain')
+            self.thumbnail_cache.set(key, content)
+        return content
+
+    def prefetch_thumbnails(self, paths, size, workers=THUMBNAIL_WORKERS):
+        """
+        Fill thumbnail_cache with the thumbnails of paths concurrently
+
+        paths: paths or metadata entries, entries save a metadata call each
+        Returns {path: exception} of the thumbnails which could not be fetched.
+        """
+        def fetch(entry):
+            if isinstance(entry, dict):
+                path, rev = entry['path'], entry.get('rev')
+            else:
+                path, rev = entry, None
+            try:
+                self.get_thumbnail(path, size, rev=rev)
+            except Exception, e:
+                return path, e
+            return path, None
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(fetch, paths)
+        finally:
+            pool.close()
+        return dict((path, error) for path, error in results if error is not None)
 
     def get_thumbnail_url(self, path, size):
         """
@@ -231,14 +461,7 @@ class WeipanClient:
         params = {
             'size': size
         }
-        try:
-            r = self.get(path, params, format=None)
-            raise request.ErrorResponse(r)
-        except request.ErrorResponse, e:
-            if e.status == 302:
-                return e.getheader('location')
-            else:
-                raise e
+        return self.cached_url(path, params, lambda: self.redirect_location(path, params))
 
     def copy(self, from_path, to_path, from_copy_ref=None):
         """
@@ -285,6 +508,31 @@ class WeipanClient:
         }
         return self.post('fileops/move', params)
 
+    def batch(self, ops, workers=BATCH_WORKERS):
+        """
+        Run fileops concurrently, see fileops.FileOpsBatch
+
+        ops: sequence like [('create_folder', '/a'), ('move', '/b', '/a/b')]
+        Returns a fileops.BatchResult for each op, failed ops do not stop the batch.
+        """
+        return fileops.FileOpsBatch(self, ops, workers).run()
+
+    def sync_up(self, local_dir, remote_dir, delete=False, dry_run=False, workers=SYNC_WORKERS, content_map=None):
+        """
+        Upload the files of local_dir which differ from remote_dir, see sync.SyncUp
+
+        delete: also delete remote entries missing locally
+        dry_run: only return the plan
+        content_map: dedup.ContentMap, files with known content are copied instead of uploaded
+        Returns a sync.SyncPlan, with results set when it was executed.
+        """
+        from . import sync
+        syncer = sync.SyncUp(self, local_dir, remote_dir, delete, workers, content_map=content_map)
+        plan = syncer.plan()
+        if dry_run:
+            return plan
+        return syncer.run(plan)
+
     def share_media(self, from_copy_ref):
         """
         see: http://vdisk.weibo.com/developers/index.php?module=api&action=apidoc#shareops_media
@@ -292,4 +540,4 @@ class WeipanClient:
         params = {
             'from_copy_ref': from_copy_ref
         }
-        return self.get('shareops/media', params)
\ No newline at end of file
+        return self.cached_url('shareops/media', params, lambda: self.get('shareops/media', params))
\ No newline at end of file
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coalescing of identical concurrent calls
+"""
+
+import sys
+import copy
+import threading
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Thread-safe single-flight group
+
+    While a call for a key is running, do() with the same key waits for it
+    instead of calling again, then returns its result or raises its
+    exception. Waiters get a deep copy of the result, so every caller may
+    modify what it got. Only results of calls that started after do() was
+    called are returned, nothing is cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        # number of do() calls answered by another caller's call
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Return func(), or the result of the call running for key
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = Call()
+                leader = True
+            else:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return copy.deepcopy(call.result)
+
+        try:
+            result = func()
+        except:
+            call.exc_info = sys.exc_info()
+            self.remove(key)
+            call.done.set()
+            raise
+        if self.remove(key):
+            # a private copy, the caller may modify result meanwhile
+            call.result = copy.deepcopy(result)
+        call.done.set()
+        return result
+
+    def remove(self, key):
+        """
+        End the call for key, return its number of waiters
+        """
+        with self.lock:
+            return self.calls.pop(key).waiters
+
+    def __len__(self):
+        """
+        Number of calls running
+        """
+        return len(self.calls)
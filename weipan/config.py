@@ -3,4 +3,69 @@
 API_URL = 'http://openapi.vdisk.me/2/'
 UPLOAD_URL = 'http://upload.openapi.vdisk.me/2/'
 AUTH_URL = 'https://auth.sina.com.cn/oauth2/'
-SDK_VERSION = '1.0'
\ No newline at end of file
+SDK_VERSION = '1.0'
+
+# keep-alive connection pool
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 60
+
+# block size for streamed request and response bodies
+CHUNK_SIZE = 64 * 1024
+
+# segmented downloads
+SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_WORKERS = 4
+SEGMENT_RETRIES = 3
+# revisions listed to find the size of an older rev
+SEGMENT_REV_LIMIT = 1000
+
+# upload retries
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 1
+
+# WeipanAsyncClient
+ASYNC_CONCURRENCY = 16
+ASYNC_MAX_PENDING = 1024
+
+# concurrent fileops batches
+BATCH_WORKERS = 8
+
+# metadata cache
+METADATA_CACHE_SIZE = 1000
+METADATA_CACHE_TTL = 24 * 3600
+
+# delta mirror
+MIRROR_WORKERS = 8
+
+# directory sync
+SYNC_WORKERS = 4
+
+# recursive listing
+WALK_WORKERS = 8
+
+# automatic retries
+RETRY_MAX = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 30
+RETRY_BUDGET = 120
+
+# redirect and media URL cache
+URL_CACHE_SIZE = 10000
+URL_CACHE_TTL = 300
+URL_CACHE_REFRESH_AHEAD = 0.2
+
+# thumbnail cache
+THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+THUMBNAIL_WORKERS = 8
+
+# request metrics, latency histogram buckets in seconds
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# local index of the remote tree
+INDEX_MAX_AGE = 300
+INDEX_QUERY_LIMIT = 1000
+
+# local file hashing, None processes for one per CPU
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_PROCESSES = None
+HASH_RACY_WINDOW = 2
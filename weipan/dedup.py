@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Uploads which copy remote files with the same content instead of sending bytes
+"""
+
+import os
+import threading
+
+from . import request, transfer
+from .client import format_path
+from .config import *
+
+class ContentMap:
+    """
+    Thread-safe map of sha1 => metadata of remote files with that content
+
+    Fill it from listings, e.g. map.add_all(client.walk('/')) or
+    map.add_all(index.find(is_dir=False)) with an index.RemoteIndex.
+    An entry holding a copy_ref is copied by reference, which also works
+    for files of another account.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # sha1 => {lowercased path: metadata}
+        self.files = {}
+
+    def add(self, meta):
+        """
+        Record a file from a listing, folders and deleted files are ignored
+        """
+        if meta.get('is_dir') or meta.get('is_deleted') or not meta.get('sha1'):
+            return
+        with self.lock:
+            self.files.setdefault(meta['sha1'].lower(), {})[format_path(meta['path']).lower()] = meta
+
+    def add_all(self, metas):
+        for meta in metas:
+            self.add(meta)
+            for child in meta.get('contents') or []:
+                self.add(child)
+
+    def discard(self, meta):
+        with self.lock:
+            paths = self.files.get(meta['sha1'].lower(), {})
+            paths.pop(format_path(meta['path']).lower(), None)
+            if not paths:
+                self.files.pop(meta['sha1'].lower(), None)
+
+    def discard_below(self, path):
+        """
+        Forget a remote path and everything below it, e.g. once it is deleted
+        """
+        key = format_path(path).lower()
+        with self.lock:
+            for sha1, paths in self.files.items():
+                for p in paths.keys():
+                    if p == key or p.startswith(key.rstrip('/') + '/'):
+                        del paths[p]
+                if not paths:
+                    del self.files[sha1]
+
+    def by_sha1(self, sha1):
+        """
+        Metadata of the files with this content
+        """
+        with self.lock:
+            return self.files.get(sha1.lower(), {}).values()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(paths) for paths in self.files.values())
+
+class DedupUpload:
+    """
+    Create a remote file from a local one, by a server side copy when possible
+
+    The local file is hashed and a remote file with the same sha1 and size
+    is copied to the target with fileops/copy, by path or by copy_ref. The
+    hashes of the copy are checked, and the bytes are uploaded when no
+    source is usable or the target exists. A copy which does not match, or
+    is a folder, is deleted and replaced by an upload.
+    Uploaded and copied files are added to the content map.
+    """
+
+    def __init__(self, client, path, file_path, content_map, overwrite=True):
+        self.client = client
+        self.path = format_path(path)
+        self.file_path = file_path
+        self.content_map = content_map
+        self.overwrite = overwrite
+        # metadata of the source of the copy, None when uploaded
+        self.copied_from = None
+
+    def matches(self, meta, md5, sha1):
+        return (meta.get('sha1') or meta.get('md5')) and \
+               (not meta.get('sha1') or meta['sha1'].lower() == sha1) and \
+               (not meta.get('md5') or meta['md5'].lower() == md5)
+
+    def copy(self, source):
+        """
+        Copy source to the target, return the metadata of the copy
+        """
+        if source.get('copy_ref'):
+            return self.client.copy(None, self.path, from_copy_ref=source['copy_ref'])
+        return self.client.copy(source['path'], self.path)
+
+    def run(self):
+        """
+        Return the metadata of the remote file
+        """
+        md5, sha1 = transfer.file_hashes(self.file_path, getattr(self.client, 'hasher', None))
+        size = os.path.getsize(self.file_path)
+
+        meta = None
+        for source in self.content_map.by_sha1(sha1):
+            if int(source.get('bytes', -1)) != size or format_path(source['path']).lower() == self.path.lower():
+                continue
+            try:
+                meta = self.copy(source)
+            except request.ErrorResponse, e:
+                if e.status == 404:
+                    # gone since it was listed
+                    self.content_map.discard(source)
+                    continue
+                if e.status == 403:
+                    # the target exists, only an upload can replace it
+                    break
+                raise
+            if not meta.get('sha1') and not meta.get('md5'):
+                meta = self.client.metadata(self.path, list=False)
+            if not meta.get('is_dir') and self.matches(meta, md5, sha1):
+                self.copied_from = source
+                break
+            # changed since it was listed, an upload can not replace a folder
+            self.content_map.discard(source)
+            self.client.delete(self.path)
+            meta = None
+            break
+
+        if meta is None:
+            meta = self.client.put_file(self.path, self.file_path, self.overwrite)
+        if meta.get('sha1') and meta['sha1'].lower() != sha1:
+            raise transfer.ChecksumError("sha1 mismatch for %s: %s != %s" % (meta['path'], meta['sha1'], sha1))
+        self.content_map.add(meta)
+        return meta
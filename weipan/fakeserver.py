@@ -0,0 +1,952 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Weipan API, for hermetic tests and benchmarks
+"""
+
+import os
+import re
+import cgi
+import json
+import time
+import uuid
+import urllib
+import urlparse
+import hashlib
+import mimetypes
+import threading
+import email.utils
+import StringIO
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from . import client, session, ratelimit
+
+FAKE_TOKEN = 'fake-token'
+ROOTS = ('basic', 'sandbox')
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+def split_path(path):
+    """
+    Normalized path and its lowercased key, '' for the root
+    """
+    path = '/'.join(p for p in path.split('/') if p)
+    if path:
+        path = '/' + path
+    return path, path.lower()
+
+def parent_key(key):
+    return key.rsplit('/', 1)[0]
+
+def format_size(size):
+    if size < 1024:
+        return '%d bytes' % size
+    for unit in ['KB', 'MB', 'GB']:
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return '%.1f %s' % (size, unit)
+
+def format_date(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(t))
+
+def entry_metadata(root, entry):
+    """
+    API metadata of a stored entry
+    """
+    meta = {
+        'path': entry['path'] or '/',
+        'root': root,
+        'is_dir': entry['is_dir'],
+        'rev': entry['rev'],
+        'revision': entry['revision'],
+        'modified': format_date(entry['modified'])
+    }
+    if entry['is_dir']:
+        meta.update(size='0 bytes', bytes='0', thumb_exists=False, icon='folder')
+    else:
+        mime_type = mimetypes.guess_type(entry['path'])[0] or 'application/octet-stream'
+        meta.update({
+            'size': format_size(entry['bytes']),
+            'bytes': str(entry['bytes']),
+            'mime_type': mime_type,
+            'thumb_exists': mime_type.startswith('image/'),
+            'icon': mime_type.startswith('image/') and 'page_white_picture' or 'page_white',
+            'md5': entry['md5'],
+            'sha1': entry['sha1']
+        })
+    if entry['is_deleted']:
+        meta['is_deleted'] = True
+    return meta
+
+class FakeStore:
+    """
+    Thread-safe file tree, revisions and contents of a fake account
+
+    Entries are keyed by lowercased path like on the real service, and
+    every change appends the key to the event log which backs delta
+    cursors. Contents are kept in memory, or as files under `directory`,
+    which also holds the tree written by save() and read back on start.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.revision = 0
+        self.roots = {}
+        self.refs = {}
+        self.blobs = {}
+        self.snapshots = {}
+        if directory is not None:
+            if not os.path.isdir(os.path.join(directory, 'blobs')):
+                os.makedirs(os.path.join(directory, 'blobs'))
+            self.load()
+
+    def state_path(self):
+        return os.path.join(self.directory, 'state.json')
+
+    def load(self):
+        if not os.path.exists(self.state_path()):
+            return
+        with open(self.state_path(), 'rb') as fh:
+            state = json.load(fh)
+        self.revision = state['revision']
+        self.refs = dict((ref, tuple(target)) for ref, target in state['refs'].items())
+        for root, tree in state['roots'].items():
+            children = {}
+            for key in tree['entries']:
+                if key:
+                    children.setdefault(parent_key(key), set()).add(key)
+            self.roots[root] = {'entries': tree['entries'], 'events': tree['events'], 'children': children}
+
+    def save(self):
+        """
+        Write the tree to `directory`, a no-op for a memory store
+        """
+        if self.directory is None:
+            return
+        with self.lock:
+            state = {
+                'revision': self.revision,
+                'refs': self.refs,
+                'roots': dict((root, {'entries': tree['entries'], 'events': tree['events']})
+                              for root, tree in self.roots.items())
+            }
+            tmp_path = self.state_path() + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                json.dump(state, fh)
+            os.rename(tmp_path, self.state_path())
+
+    def tree(self, root):
+        if root not in self.roots:
+            self.roots[root] = {
+                'entries': {'': self.new_entry('', True)},
+                'events': [],
+                'children': {}
+            }
+        return self.roots[root]
+
+    def next_revision(self):
+        self.revision += 1
+        return {'rev': '%x' % (0x10000000 + self.revision), 'revision': self.revision, 'modified': time.time()}
+
+    def new_entry(self, path, is_dir):
+        entry = {'path': path, 'is_dir': is_dir, 'is_deleted': False, 'share': False}
+        entry.update(self.next_revision())
+        if not is_dir:
+            entry['versions'] = []
+        return entry
+
+    def write_blob(self, content):
+        sha1 = hashlib.sha1(content).hexdigest()
+        if self.directory is None:
+            self.blobs[sha1] = content
+        else:
+            blob_path = os.path.join(self.directory, 'blobs', sha1)
+            if not os.path.exists(blob_path):
+                with open(blob_path + '.tmp', 'wb') as fh:
+                    fh.write(content)
+                os.rename(blob_path + '.tmp', blob_path)
+        return {'blob': sha1, 'sha1': sha1, 'md5': hashlib.md5(content).hexdigest(), 'bytes': len(content)}
+
+    def read_blob(self, sha1):
+        if self.directory is None:
+            if sha1 not in self.blobs:
+                raise FakeError(404, 'blob not found')
+            return self.blobs[sha1]
+        try:
+            with open(os.path.join(self.directory, 'blobs', sha1), 'rb') as fh:
+                return fh.read()
+        except IOError:
+            raise FakeError(404, 'blob not found')
+
+    def get(self, root, path):
+        """
+        Stored entry of path, deleted or not, None if missing
+        """
+        return self.tree(root)['entries'].get(split_path(path)[1])
+
+    def lookup(self, root, path):
+        entry = self.get(root, path)
+        if entry is None or entry['is_deleted']:
+            raise FakeError(404, 'path not found: %s' % path)
+        return entry
+
+    def changed(self, root, key):
+        self.tree(root)['events'].append(key)
+
+    def add(self, root, entry):
+        tree = self.tree(root)
+        key = entry['path'].lower()
+        tree['entries'][key] = entry
+        tree['children'].setdefault(parent_key(key), set()).add(key)
+        self.changed(root, key)
+
+    def remove(self, root, key):
+        tree = self.tree(root)
+        del tree['entries'][key]
+        tree['children'].get(parent_key(key), set()).discard(key)
+        tree['children'].pop(key, None)
+        self.changed(root, key)
+
+    def purge(self, root, key):
+        """
+        Remove an entry with its descendants
+        """
+        for k in reversed(self.descendants(root, key)):
+            self.remove(root, k)
+        self.remove(root, key)
+
+    def children(self, root, key):
+        tree = self.tree(root)
+        return [tree['entries'][k] for k in sorted(tree['children'].get(key, ()))]
+
+    def descendants(self, root, key):
+        """
+        Keys below key, parents first
+        """
+        children = self.tree(root)['children']
+        keys = []
+        stack = [key]
+        while stack:
+            for k in sorted(children.get(stack.pop(), ()), reverse=True):
+                keys.append(k)
+                stack.append(k)
+        return keys
+
+    def make_dirs(self, root, path):
+        """
+        Create the missing ancestors of path
+        """
+        parts = split_path(path)[0].split('/')[1:-1]
+        for i in range(len(parts)):
+            dir_path = '/' + '/'.join(parts[:i + 1])
+            entry = self.get(root, dir_path)
+            if entry is None:
+                self.add(root, self.new_entry(dir_path, True))
+            elif not entry['is_dir']:
+                raise FakeError(403, 'parent is a file: %s' % dir_path)
+            elif entry['is_deleted']:
+                entry.update(self.next_revision(), is_deleted=False)
+                self.changed(root, dir_path.lower())
+
+    def free_path(self, root, path):
+        """
+        path, or "name (n).ext" for the first n which is not taken
+        """
+        name, ext = os.path.splitext(path)
+        n = 0
+        while True:
+            entry = self.get(root, path)
+            if entry is None or entry['is_deleted']:
+                return path
+            n += 1
+            path = '%s (%d)%s' % (name, n, ext)
+
+    def put(self, root, path, content, overwrite=True, parent_rev=None):
+        """
+        Store a new version of a file, conflicts are renamed
+        """
+        with self.lock:
+            path = split_path(path)[0]
+            if not path:
+                raise FakeError(403, 'can not write the root')
+            self.make_dirs(root, path)
+            entry = self.get(root, path)
+            if entry is not None and not entry['is_deleted']:
+                if entry['is_dir'] or not overwrite or (parent_rev and parent_rev != entry['rev']):
+                    path = self.free_path(root, path)
+                    entry = None
+            elif entry is not None and entry['is_dir']:
+                self.purge(root, path.lower())
+                entry = None
+            if entry is None:
+                entry = self.new_entry(path, False)
+                self.add(root, entry)
+            else:
+                self.changed(root, path.lower())
+            version = self.next_revision()
+            version.update(self.write_blob(content))
+            entry['versions'].append(version)
+            entry.update(version, is_deleted=False)
+            return entry
+
+    def create_folder(self, root, path):
+        with self.lock:
+            path = split_path(path)[0]
+            entry = self.get(root, path)
+            if entry is not None and not entry['is_deleted']:
+                raise FakeError(403, 'path exists: %s' % path)
+            self.make_dirs(root, path)
+            if entry is not None:
+                self.purge(root, path.lower())
+            entry = self.new_entry(path, True)
+            self.add(root, entry)
+            return entry
+
+    def delete(self, root, path):
+        with self.lock:
+            entry = self.lookup(root, path)
+            key = entry['path'].lower()
+            if not key:
+                raise FakeError(403, 'can not delete the root')
+            for k in [key] + self.descendants(root, key):
+                e = self.tree(root)['entries'][k]
+                if not e['is_deleted']:
+                    e.update(self.next_revision(), is_deleted=True)
+                    self.changed(root, k)
+            return entry
+
+    def check_target(self, root, from_key, to_path):
+        to_path = split_path(to_path)[0]
+        to_key = to_path.lower()
+        if not to_path:
+            raise FakeError(403, 'can not write the root')
+        if from_key is not None and (to_key == from_key or to_key.startswith(from_key + '/')):
+            raise FakeError(403, 'can not move or copy into itself')
+        target = self.get(root, to_path)
+        if target is not None:
+            if not target['is_deleted']:
+                raise FakeError(403, 'path exists: %s' % to_path)
+            self.purge(root, to_key)
+        self.make_dirs(root, to_path)
+        return to_path
+
+    def copy(self, root, from_path, to_path, from_root=None):
+        """
+        Copy an entry with its descendants, from another root for copy refs
+        """
+        with self.lock:
+            from_root = from_root or root
+            source = self.lookup(from_root, from_path)
+            from_key = source['path'].lower()
+            to_path = self.check_target(root, from_root == root and from_key or None, to_path)
+            for k in [from_key] + self.descendants(from_root, from_key):
+                e = self.tree(from_root)['entries'][k]
+                if e['is_deleted']:
+                    continue
+                entry = dict(e, path=to_path + e['path'][len(from_key):], share=False)
+                entry.update(self.next_revision())
+                if not entry['is_dir']:
+                    version = dict(e['versions'][-1])
+                    version.update(self.next_revision())
+                    entry.update(version)
+                    entry['versions'] = [version]
+                self.add(root, entry)
+            return self.get(root, to_path)
+
+    def move(self, root, from_path, to_path):
+        with self.lock:
+            source = self.lookup(root, from_path)
+            from_key = source['path'].lower()
+            if not from_key:
+                raise FakeError(403, 'can not move the root')
+            to_path = self.check_target(root, from_key, to_path)
+            keys = [from_key] + self.descendants(root, from_key)
+            entries = self.tree(root)['entries']
+            moved = [dict(entries[k], path=to_path + entries[k]['path'][len(from_key):]) for k in keys]
+            for k in reversed(keys):
+                self.remove(root, k)
+            for entry in moved:
+                if not entry['is_deleted']:
+                    revision = self.next_revision()
+                    entry.update(revision)
+                    if not entry['is_dir']:
+                        # the new rev can be fetched like any other
+                        version = dict(entry['versions'][-1])
+                        version.update(revision)
+                        entry['versions'] = entry['versions'] + [version]
+                self.add(root, entry)
+            return moved[0]
+
+    def restore(self, root, path, rev):
+        with self.lock:
+            entry = self.get(root, path)
+            if entry is None or entry['is_dir']:
+                raise FakeError(404, 'file not found: %s' % path)
+            for version in entry['versions']:
+                if version['rev'] == rev:
+                    break
+            else:
+                raise FakeError(404, 'rev not found: %s' % rev)
+            version = dict(version)
+            version.update(self.next_revision())
+            entry['versions'].append(version)
+            entry.update(version, is_deleted=False)
+            self.make_dirs(root, entry['path'])
+            self.changed(root, entry['path'].lower())
+            return entry
+
+    def versions(self, root, path, limit=10):
+        """
+        Entries of the revisions of a file, latest first
+        """
+        with self.lock:
+            entry = self.get(root, path)
+            if entry is None or entry['is_dir']:
+                raise FakeError(404, 'file not found: %s' % path)
+            return [dict(entry, is_deleted=False, **version) for version in reversed(entry['versions'][-limit:])]
+
+    def search(self, root, path, query, limit=1000, include_deleted=False):
+        with self.lock:
+            entry = self.lookup(root, path)
+            query = query.lower()
+            entries = self.tree(root)['entries']
+            found = []
+            for k in self.descendants(root, entry['path'].lower()):
+                e = entries[k]
+                if query in k.rsplit('/', 1)[1] and (include_deleted or not e['is_deleted']):
+                    found.append(e)
+            found.sort(key=lambda e: e['path'].lower())
+            return found[:limit]
+
+    def listing_hash(self, root, entry, include_deleted=False):
+        digest = hashlib.md5(include_deleted and 'deleted' or '')
+        for e in self.children(root, entry['path'].lower()):
+            digest.update('%s:%s\n' % (e['path'].lower().encode('utf-8'), e['rev']))
+        return digest.hexdigest()
+
+    def delta(self, root, cursor=None, limit=1000):
+        """
+        (reset, entries, cursor, has_more), entries are [key, entry or None]
+
+        A cursor is a position in the event log. Without a valid cursor
+        the whole tree is listed page by page, from a snapshot of the keys
+        at the time the listing started.
+        """
+        with self.lock:
+            tree = self.tree(root)
+            events = tree['events']
+            cursor = cursor or ''
+            if cursor.isdigit() and int(cursor) <= len(events):
+                seq = int(cursor)
+                end = min(seq + limit, len(events))
+                keys = []
+                for k in events[seq:end]:
+                    if k in keys:
+                        keys.remove(k)
+                    keys.append(k)
+                return False, [[k, tree['entries'].get(k)] for k in keys], str(end), end < len(events)
+
+            match = re.match(r'^reset-(\d+)-(\d+)$', cursor)
+            offset, seq = match is not None and map(int, match.groups()) or (0, len(events))
+            if seq > len(events):
+                offset, seq = 0, len(events)
+            keys = self.snapshots.get((root, seq))
+            if keys is None or offset == 0:
+                keys = sorted(k for k, e in tree['entries'].items() if k and not e['is_deleted'])
+                self.snapshots = {(root, seq): keys}
+            entries = [[k, tree['entries'].get(k)] for k in keys[offset:offset + limit]]
+            if offset + limit < len(keys):
+                return offset == 0, entries, 'reset-%d-%d' % (offset + limit, seq), True
+            return offset == 0, entries, str(seq), seq < len(events)
+
+    def create_ref(self, root, path):
+        with self.lock:
+            entry = self.lookup(root, path)
+            ref = uuid.uuid4().hex
+            self.refs[ref] = (root, entry['path'])
+            return ref
+
+    def resolve_ref(self, ref):
+        """
+        (root, path) of a copy ref
+        """
+        if ref not in self.refs:
+            raise FakeError(404, 'copy_ref not found')
+        return self.refs[ref]
+
+    def usage(self):
+        with self.lock:
+            return sum(e['bytes'] for tree in self.roots.values()
+                       for e in tree['entries'].values() if not e['is_dir'] and not e['is_deleted'])
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Routes the API, upload, auth and storage hosts, which share one address
+
+    <url>/2/... API, <url>/upload/2/... uploads, <url>/oauth2/... auth,
+    <url>/storage/... and <url>/thumbnail/... the targets of redirects.
+    """
+    protocol_version = 'HTTP/1.1'
+    # answer with one write, small writes wait for delayed ACKs otherwise
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    # (host, name): method
+    ROUTES = {
+        ('api', 'account_info'): 'GET',
+        ('api', 'delta'): 'GET',
+        ('api', 'files'): 'GET',
+        ('api', 'metadata'): 'GET',
+        ('api', 'revisions'): 'GET',
+        ('api', 'restore'): 'POST',
+        ('api', 'search'): 'GET',
+        ('api', 'shares'): 'POST',
+        ('api', 'copy_ref'): 'POST',
+        ('api', 'media'): 'GET',
+        ('api', 'thumbnails'): 'GET',
+        ('api', 'fileops_copy'): 'POST',
+        ('api', 'fileops_create_folder'): 'POST',
+        ('api', 'fileops_delete'): 'POST',
+        ('api', 'fileops_move'): 'POST',
+        ('api', 'shareops_media'): 'GET',
+        ('upload', 'files_put'): 'PUT',
+        ('upload', 'files'): 'POST',
+        ('auth', 'access_token'): 'POST',
+        ('auth', 'authorize'): 'GET'
+    }
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def log_message(self, format, *args):
+        return
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in ('\r\n', '\n', ''):
+                        pass
+                    return ''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def parse_params(self, query):
+        self.params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        self.files = {}
+        self.body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if self.command != 'POST':
+            return
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            self.params.update(urlparse.parse_qsl(self.body, keep_blank_values=True))
+        elif content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=StringIO.StringIO(self.body), environ={'REQUEST_METHOD': 'POST'},
+                                    headers={'content-type': content_type, 'content-length': str(len(self.body))})
+            for field in form.list or []:
+                if field.filename is not None:
+                    self.files[field.name] = field.value
+                else:
+                    self.params[field.name] = field.value
+
+    def param(self, name, default=None):
+        value = self.params.get(name, default)
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        return value
+
+    def flag(self, name, default=False):
+        return self.params.get(name, default and 'true' or 'false').lower() == 'true'
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(status, json.dumps(data), [('Content-Type', 'application/json')])
+
+    def send_error_json(self, status, message, headers=()):
+        self.send_body(status, json.dumps({'error': message, 'error_code': status}),
+                       [('Content-Type', 'application/json')] + list(headers))
+
+    def redirect(self, location):
+        self.send_body(302, '', [('Location', location)])
+
+    def metadata(self, entry):
+        return entry_metadata(self.root, entry)
+
+    def signed_url(self, target):
+        return '%s/%s?Expires=%d' % (self.server.url, target, int(time.time() + self.server.url_ttl))
+
+    def route(self, path):
+        """
+        (host, name, root, path) of a request path
+        """
+        for prefix, host in [('/2/', 'api'), ('/upload/2/', 'upload'), ('/oauth2/', 'auth')]:
+            if path.startswith(prefix):
+                break
+        else:
+            return None
+        target = path[len(prefix):]
+        match = re.match(r'^(account|fileops|shareops)/(\w+)$', target)
+        if match is not None or host == 'auth':
+            name = match and '%s_%s' % match.groups() or target
+            return host, name, self.params.get('root', 'sandbox'), None
+        match = re.match(r'^(\w+)/(\w+)(/.*)?$', target)
+        if match is None:
+            return None
+        name, root, path = match.groups()
+        return host, name, root, (path or '').decode('utf-8')
+
+    def dispatch(self):
+        urlinfo = urlparse.urlparse(self.path)
+        self.parse_params(urlinfo.query)
+        path = urllib.unquote(urlinfo.path)
+        server = self.server
+        server.count(path)
+
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            if server.bucket is not None and not server.bucket.try_acquire():
+                return self.send_error_json(429, 'rate limit exceeded', [('Retry-After', '1')])
+            failure = server.take_failure(path)
+            if failure is not None:
+                status, retry_after = failure
+                if status is None:
+                    # drop the connection without an answer
+                    self.close_connection = 1
+                    return
+                headers = retry_after is not None and [('Retry-After', str(retry_after))] or []
+                return self.send_error_json(status, 'injected failure', headers)
+
+            match = re.match(r'^/(storage|thumbnail)/(\w*)(?:/(\w+))?$', path)
+            if match is not None:
+                return self.serve_blob(*match.groups())
+
+            route = self.route(path)
+            if route is None or route[:2] not in self.ROUTES:
+                raise FakeError(404, 'unknown endpoint: %s' % path)
+            host, name, self.root, target = route
+            if self.ROUTES[route[:2]] != self.command:
+                raise FakeError(405, 'method not allowed')
+            if host != 'auth':
+                if server.token is not None and self.params.get('access_token') != server.token:
+                    raise FakeError(401, 'invalid access_token')
+                if self.root not in ROOTS:
+                    raise FakeError(400, 'invalid root: %s' % self.root)
+            getattr(self, '%s_%s' % (host, name))(target)
+        except FakeError, e:
+            self.send_error_json(e.status, e.message)
+        except Exception, e:
+            self.send_error_json(500, repr(e))
+
+    def serve_blob(self, kind, blob, size):
+        expires = self.params.get('Expires')
+        if expires is not None and int(expires) < time.time():
+            raise FakeError(403, 'url expired')
+        content = self.server.store.read_blob(blob)
+        if kind == 'thumbnail':
+            content = '\x89PNG\r\n\x1a\n' + hashlib.sha1('%s:%s' % (blob, size)).digest()
+
+        match = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match is None:
+            return self.send_body(200, content)
+        start = int(match.group(1))
+        end = match.group(2) and min(int(match.group(2)), len(content) - 1) or len(content) - 1
+        if start > end:
+            return self.send_body(416, '', [('Content-Range', 'bytes */%d' % len(content))])
+        self.send_body(206, content[start:end + 1], [('Content-Range', 'bytes %d-%d/%d' % (start, end, len(content)))])
+
+    def api_account_info(self, path):
+        self.send_json({
+            'uid': '1',
+            'sina_uid': '1',
+            'quota_info': {
+                'quota': self.server.quota,
+                'consumed': self.server.store.usage()
+            }
+        })
+
+    def api_delta(self, path):
+        reset, entries, cursor, has_more = self.server.store.delta(self.root, self.params.get('cursor'), self.server.delta_limit)
+        self.send_json({
+            'reset': reset,
+            'cursor': cursor,
+            'has_more': has_more,
+            'entries': [[k, e is not None and not e['is_deleted'] and self.metadata(e) or None] for k, e in entries]
+        })
+
+    def api_files(self, path):
+        entry = self.server.store.lookup(self.root, path)
+        if entry['is_dir']:
+            raise FakeError(403, 'can not download a folder')
+        blob = entry['blob']
+        rev = self.params.get('rev')
+        if rev is not None:
+            for version in entry['versions']:
+                if version['rev'] == rev:
+                    blob = version['blob']
+                    break
+            else:
+                raise FakeError(404, 'rev not found: %s' % rev)
+        self.redirect(self.signed_url('storage/%s' % blob))
+
+    def api_metadata(self, path):
+        store = self.server.store
+        include_deleted = self.flag('include_deleted')
+        with store.lock:
+            entry = store.get(self.root, path)
+            if entry is None:
+                raise FakeError(404, 'path not found: %s' % path)
+            meta = self.metadata(entry)
+            if entry['is_dir'] and self.flag('list', True):
+                meta['hash'] = store.listing_hash(self.root, entry, include_deleted)
+                if meta['hash'] == self.params.get('hash'):
+                    return self.send_body(304, '')
+                children = store.children(self.root, entry['path'].lower())
+                meta['contents'] = [self.metadata(e) for e in children if include_deleted or not e['is_deleted']]
+        self.send_json(meta)
+
+    def api_revisions(self, path):
+        limit = int(self.params.get('rev_limit') or 10)
+        self.send_json([self.metadata(e) for e in self.server.store.versions(self.root, path, limit)])
+
+    def api_restore(self, path):
+        self.send_json(self.metadata(self.server.store.restore(self.root, path, self.params.get('rev'))))
+
+    def api_search(self, path):
+        limit = int(self.params.get('file_limit') or 1000)
+        found = self.server.store.search(self.root, path, self.param('query', u''), limit, self.flag('include_deleted'))
+        self.send_json([self.metadata(e) for e in found])
+
+    def api_shares(self, path):
+        store = self.server.store
+        with store.lock:
+            entry = store.lookup(self.root, path)
+            if entry['is_dir'] and self.root != 'basic':
+                raise FakeError(403, 'folders can only be shared by basic apps')
+            entry['share'] = not self.flag('cancel')
+            meta = dict(self.metadata(entry), share=entry['share'])
+        if not entry['share']:
+            return self.send_json(meta)
+        self.send_json({
+            'url': '%s/s/%s' % (self.server.url, hashlib.md5(entry['path'].lower().encode('utf-8')).hexdigest()[:8]),
+            'share': True
+        })
+
+    def api_copy_ref(self, path):
+        self.send_json({
+            'copy_ref': self.server.store.create_ref(self.root, path),
+            'expires': email.utils.formatdate(time.time() + self.server.url_ttl, usegmt=True)
+        })
+
+    def send_media(self, entry):
+        if entry['is_dir']:
+            raise FakeError(403, 'no media for a folder')
+        url = self.signed_url('storage/%s' % entry['blob'])
+        self.send_json({
+            'url': url,
+            'flv_url': url + '&format=flv',
+            'mp3_url': url + '&format=mp3',
+            'mp4_url': url + '&format=mp4',
+            'expires': email.utils.formatdate(time.time() + self.server.url_ttl, usegmt=True)
+        })
+
+    def api_media(self, path):
+        self.send_media(self.server.store.lookup(self.root, path))
+
+    def api_shareops_media(self, path):
+        self.send_media(self.server.store.lookup(*self.server.store.resolve_ref(self.params.get('from_copy_ref'))))
+
+    def api_thumbnails(self, path):
+        entry = self.server.store.lookup(self.root, path)
+        if not self.metadata(entry)['thumb_exists']:
+            raise FakeError(415, 'no thumbnail for %s' % path)
+        self.redirect(self.signed_url('thumbnail/%s/%s' % (entry['blob'], self.params.get('size', 's'))))
+
+    def api_fileops_copy(self, path):
+        store = self.server.store
+        if self.params.get('from_copy_ref'):
+            from_root, from_path = store.resolve_ref(self.params['from_copy_ref'])
+        else:
+            from_root, from_path = self.root, self.param('from_path', u'')
+        self.send_json(self.metadata(store.copy(self.root, from_path, self.param('to_path', u''), from_root)))
+
+    def api_fileops_create_folder(self, path):
+        self.send_json(self.metadata(self.server.store.create_folder(self.root, self.param('path', u''))))
+
+    def api_fileops_delete(self, path):
+        self.send_json(self.metadata(self.server.store.delete(self.root, self.param('path', u''))))
+
+    def api_fileops_move(self, path):
+        self.send_json(self.metadata(self.server.store.move(self.root, self.param('from_path', u''), self.param('to_path', u''))))
+
+    def put(self, path, content):
+        entry = self.server.store.put(self.root, path, content, self.flag('overwrite', True), self.params.get('parent_rev'))
+        self.send_json(self.metadata(entry))
+
+    def upload_files_put(self, path):
+        self.put(path, self.body)
+
+    def upload_files(self, path):
+        if 'file' not in self.files:
+            raise FakeError(400, 'missing file')
+        self.put(path, self.files['file'])
+
+    def auth_access_token(self, path):
+        self.send_json({
+            'access_token': self.server.token or FAKE_TOKEN,
+            'expires_in': 86400,
+            'uid': '1',
+            'refresh_token': 'fake-refresh-token'
+        })
+
+    def auth_authorize(self, path):
+        self.redirect(request_url(self.params.get('redirect_uri', ''), {
+            'code': 'fake-code',
+            'state': self.params.get('state', '')
+        }))
+
+def request_url(url, params):
+    return url + ('?' in url and '&' or '?') + urllib.urlencode(params)
+
+class FakeWeipanServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded local server answering like the Weipan API
+
+    Usage:
+        server = FakeWeipanServer().start()
+        client = server.client()
+        ...
+        server.stop()
+
+    latency: seconds added to every request
+    rate_limit: (rate, burst) or a ratelimit.TokenBucket, requests over the
+        budget are answered 429 with Retry-After
+    token: the only accepted access_token, None to accept any
+    url_ttl: lifetime of redirect and media URLs
+    delta_limit: entries per delta page
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), store=None, token=FAKE_TOKEN, latency=0, rate_limit=None,
+                 url_ttl=3600, delta_limit=1000, quota=10 * 1024 ** 3):
+        HTTPServer.__init__(self, address, FakeHandler)
+        self.url = 'http://%s:%d' % self.server_address
+        self.store = store or FakeStore()
+        self.token = token
+        self.latency = latency
+        if isinstance(rate_limit, tuple):
+            rate_limit = ratelimit.TokenBucket(*rate_limit)
+        self.bucket = rate_limit
+        self.url_ttl = url_ttl
+        self.delta_limit = delta_limit
+        self.quota = quota
+        self.failures = []
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # clients closing pooled connections is expected
+        pass
+
+    def start(self):
+        """
+        Serve on a daemon thread, return self
+        """
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.store.save()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def fail(self, status=500, count=1, path=None, retry_after=None):
+        """
+        Answer the next `count` requests whose path contains `path` with an error
+
+        status: HTTP status, None to drop the connection without an answer
+        """
+        with self.lock:
+            self.failures.append([status, count, path, retry_after])
+
+    def take_failure(self, path):
+        with self.lock:
+            for failure in self.failures:
+                status, count, match, retry_after = failure
+                if match is None or match in path:
+                    failure[1] -= 1
+                    if failure[1] <= 0:
+                        self.failures.remove(failure)
+                    return status, retry_after
+        return None
+
+    def bind(self, obj):
+        """
+        Point a WeipanClient or WeipanSession at this server, return it
+        """
+        return bind(obj, self.url, self.token)
+
+    def client(self, access_type='sandbox', **kwargs):
+        """
+        A WeipanClient bound to this server, kwargs are passed to WeipanClient
+        """
+        return fake_client(self.url, self.token, access_type, **kwargs)
+
+def bind(obj, url, token=FAKE_TOKEN):
+    """
+    Point a WeipanClient or WeipanSession at the fake server at url, return it
+
+    A session without a token gets `token`. Works with a server running in
+    another process, of which only the url is known.
+    """
+    if isinstance(obj, client.WeipanClient):
+        obj.api_url = url + '/2/'
+        obj.upload_url = url + '/upload/2/'
+        bind(obj.session, url, token)
+    else:
+        obj.auth_url = url + '/oauth2/'
+        if obj.token is None:
+            obj.set_token(token or FAKE_TOKEN)
+    return obj
+
+def fake_client(url, token=FAKE_TOKEN, access_type='sandbox', **kwargs):
+    """
+    A WeipanClient bound to the fake server at url, kwargs are passed to WeipanClient
+    """
+    s = session.WeipanSession(None, None, None, access_type)
+    return bind(client.WeipanClient(s, **kwargs), url, token)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent batches of file operations
+"""
+
+import Queue
+from multiprocessing.pool import ThreadPool
+
+from .config import *
+
+# fileops method name => positions of path arguments
+OPS = {
+    'copy': (0, 1),
+    'move': (0, 1),
+    'delete': (0,),
+    'create_folder': (0,)
+}
+
+def path_key(path):
+    return '/' + path.strip('/').lower()
+
+def ancestors(key):
+    """
+    '/a/b/c' => ['/', '/a', '/a/b']
+    """
+    if key == '/':
+        return []
+    parts = key.strip('/').split('/')
+    return ['/'] + ['/' + '/'.join(parts[:i]) for i in range(1, len(parts))]
+
+class BatchResult:
+    def __init__(self, op, result=None, error=None):
+        self.op = op
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "<BatchResult %r ok>" % (self.op,)
+        return "<BatchResult %r error %r>" % (self.op, self.error)
+
+class FileOpsBatch:
+    """
+    Run fileops concurrently, keeping the order of operations on related paths
+
+    ops is a sequence of tuples such as ('create_folder', path),
+    ('move', from_path, to_path), ('copy', from_path, to_path) or
+    ('delete', path). An operation waits for every earlier operation on the
+    same path, an ancestor or a descendant of any of its paths, so creating
+    a folder always happens before moving into it. Unrelated operations run
+    in parallel on `workers` threads.
+    """
+
+    def __init__(self, client, ops, workers=BATCH_WORKERS):
+        for op in ops:
+            if op[0] not in OPS:
+                raise ValueError("unsupported batch operation: %r" % (op,))
+        self.client = client
+        self.ops = list(ops)
+        self.workers = workers
+
+    def dependencies(self):
+        """
+        Return for each op the indexes of earlier ops it has to wait for
+        """
+        # last op on each path, ops on paths below each path since it was last touched
+        last = {}
+        below = {}
+        deps = []
+        for i, op in enumerate(self.ops):
+            keys = set(path_key(op[1 + n]) for n in OPS[op[0]] if len(op) > 1 + n and op[1 + n] is not None)
+            d = set()
+            for key in keys:
+                for node in ancestors(key) + [key]:
+                    if node in last:
+                        d.add(last[node])
+                d.update(below.get(key, ()))
+            for key in keys:
+                last[key] = i
+                below[key] = []
+                for node in ancestors(key):
+                    below.setdefault(node, []).append(i)
+            d.discard(i)
+            deps.append(d)
+        return deps
+
+    def execute(self, i, done):
+        op = self.ops[i]
+        try:
+            done.put((i, BatchResult(op, result=getattr(self.client, op[0])(*op[1:]))))
+        except Exception, e:
+            done.put((i, BatchResult(op, error=e)))
+
+    def run(self):
+        """
+        Return a BatchResult for each op, in order
+        """
+        deps = self.dependencies()
+        dependents = [[] for op in self.ops]
+        for i, d in enumerate(deps):
+            for j in d:
+                dependents[j].append(i)
+
+        results = [None] * len(self.ops)
+        done = Queue.Queue()
+        pool = ThreadPool(self.workers)
+        try:
+            for i, d in enumerate(deps):
+                if not d:
+                    pool.apply_async(self.execute, (i, done))
+            for n in range(len(self.ops)):
+                i, result = done.get()
+                results[i] = result
+                for j in dependents[i]:
+                    deps[j].discard(i)
+                    if not deps[j]:
+                        pool.apply_async(self.execute, (j, done))
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        return results
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local file hashing on a process pool, with an on-disk cache
+"""
+
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+
+from .config import *
+
+def hash_file(file_path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Return (md5, sha1) hex digests of a local file, read once
+
+    The file is mapped into memory and both digests are fed the same
+    slices, without copying them.
+    """
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as fh:
+        try:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty files and special files cannot be mapped
+            data = None
+        if data is None:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                sha1.update(chunk)
+        else:
+            try:
+                for offset in xrange(0, len(data), chunk_size):
+                    chunk = buffer(data, offset, chunk_size)
+                    md5.update(chunk)
+                    sha1.update(chunk)
+            finally:
+                data.close()
+    return md5.hexdigest(), sha1.hexdigest()
+
+def file_key(st):
+    """
+    Identity of a file version: (device, inode, size, mtime)
+    """
+    return (st.st_dev, st.st_ino, st.st_size, repr(st.st_mtime))
+
+def hash_task(task):
+    # runs in the pool processes, module level to be picklable
+    file_path, chunk_size = task
+    return hash_file(file_path, chunk_size)
+
+class HashCache:
+    """
+    Thread-safe sidecar index of file hashes in SQLite
+
+    Entries are keyed by device and inode and hold the size and mtime the
+    hashes were computed for, so a file is hashed again only when it is
+    replaced or modified, and renames keep their entry.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime TEXT NOT NULL,
+                md5 TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                PRIMARY KEY (dev, ino)
+            )""")
+        self.db.commit()
+
+    def get(self, key):
+        """
+        (md5, sha1) for a file_key(), None when unknown or changed
+        """
+        dev, ino, size, mtime = key
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, md5, sha1 FROM hashes WHERE dev = ? AND ino = ?',
+                                  (dev, ino)).fetchone()
+        if row is None or (row[0], row[1]) != (size, mtime):
+            return None
+        return str(row[2]), str(row[3])
+
+    def set_many(self, items):
+        """
+        items: [(file_key(), (md5, sha1))]
+        """
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                [key + hashes for key, hashes in items])
+            self.db.commit()
+
+    def set(self, key, hashes):
+        self.set_many([(key, hashes)])
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class Hasher:
+    """
+    Hash local files on a pool of processes, skipping the ones in cache
+
+    Usage:
+        hasher = Hasher(HashCache('/data/.weipan-hashes'))
+        c = client.WeipanClient(sess, hasher=hasher)
+        c.sync_up('/data', '/backup')
+
+    cache: HashCache, None to always hash
+    processes: pool size, the number of CPUs by default
+
+    A file modified within racy_window seconds of being hashed is not
+    cached, as a change in the same mtime tick would go unnoticed.
+    """
+
+    def __init__(self, cache=None, processes=HASH_PROCESSES, chunk_size=HASH_CHUNK_SIZE,
+                 racy_window=HASH_RACY_WINDOW):
+        self.cache = cache
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.racy_window = racy_window
+
+    def hash(self, file_path):
+        """
+        Return (md5, sha1) of a local file
+        """
+        return self.hash_many([file_path])[file_path]
+
+    def hash_many(self, file_paths):
+        """
+        Return {file_path: (md5, sha1)} for local files
+
+        Files missing from the cache are hashed in parallel when there
+        are several of them.
+        """
+        rst = {}
+        misses = []
+        for file_path in file_paths:
+            if file_path in rst:
+                continue
+            key = file_key(os.stat(file_path))
+            hashes = self.cache is not None and self.cache.get(key) or None
+            if hashes is None:
+                misses.append((file_path, key))
+            else:
+                rst[file_path] = hashes
+        if not misses:
+            return rst
+
+        started = time.time()
+        tasks = [(file_path, self.chunk_size) for file_path, key in misses]
+        if len(misses) == 1 or self.processes == 1:
+            computed = map(hash_task, tasks)
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(misses)))
+            try:
+                computed = pool.map(hash_task, tasks, chunksize=1)
+                pool.close()
+            finally:
+                pool.terminate()
+
+        cached = []
+        for (file_path, key), hashes in zip(misses, computed):
+            rst[file_path] = hashes
+            if float(key[3]) < started - self.racy_window:
+                cached.append((key, hashes))
+        if self.cache is not None and cached:
+            self.cache.set_many(cached)
+        return rst
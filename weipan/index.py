@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local SQLite index of the remote tree
+"""
+
+import json
+import time
+import sqlite3
+import threading
+import email.utils
+
+from .client import format_path
+from .config import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    rev TEXT,
+    md5 TEXT,
+    sha1 TEXT,
+    mtime REAL,
+    meta TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+CREATE INDEX IF NOT EXISTS entries_mtime ON entries (mtime);
+CREATE INDEX IF NOT EXISTS entries_sha1 ON entries (sha1);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def parse_modified(value):
+    date = email.utils.parsedate_tz(value or '')
+    if date is None:
+        return None
+    return email.utils.mktime_tz(date)
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def prefix_range(key):
+    """
+    Bounds of the keys below key, '0' follows '/'
+    """
+    return key + '/', key + '0'
+
+class RemoteIndex:
+    """
+    Searchable copy of the remote metadata, kept current with delta
+
+    update() applies the changes since the saved cursor, the first call
+    lists the whole tree. Queries are answered from the database: names
+    and paths in lowercase by substring or prefix, sizes and modification
+    times by range. search() has the signature of WeipanClient.search and
+    falls back to the remote call when the last update is older than
+    max_age seconds, None never to fall back.
+
+    The database may be a file kept between runs or ':memory:'. Instances
+    are thread-safe.
+    """
+
+    def __init__(self, client, db_path=':memory:', max_age=INDEX_MAX_AGE):
+        self.client = client
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def get_state(self, name):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row and row[0] or None
+
+    def set_state(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, value))
+
+    def updated(self):
+        """
+        Time of the last completed update, None before the first one
+        """
+        with self.lock:
+            value = self.get_state('updated')
+        return value and float(value) or None
+
+    def is_stale(self):
+        if self.max_age is None:
+            return False
+        updated = self.updated()
+        return updated is None or time.time() - updated > self.max_age
+
+    def remove(self, key):
+        low, high = prefix_range(key)
+        self.db.execute('DELETE FROM entries WHERE key = ? OR (key >= ? AND key < ?)', (key, low, high))
+
+    def add(self, key, meta):
+        if not meta['is_dir']:
+            # a file replacing a folder
+            low, high = prefix_range(key)
+            self.db.execute('DELETE FROM entries WHERE key >= ? AND key < ?', (low, high))
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+            key,
+            meta['path'],
+            key.rsplit('/', 1)[1],
+            key.rsplit('/', 1)[0],
+            meta['is_dir'] and 1 or 0,
+            int(meta.get('bytes') or 0),
+            meta.get('rev'),
+            (meta.get('md5') or '').lower() or None,
+            (meta.get('sha1') or '').lower() or None,
+            parse_modified(meta.get('modified')),
+            json.dumps(meta)
+        ))
+
+    def update(self):
+        """
+        Apply the remote changes since the last update, return the number of entries changed
+
+        Each delta page is committed with its cursor, an interrupted update
+        resumes from the last page.
+        """
+        with self.lock:
+            cursor = self.get_state('cursor')
+            changed = 0
+            while True:
+                rst = self.client.delta(cursor)
+                if rst['reset']:
+                    self.db.execute('DELETE FROM entries')
+                for key, meta in rst['entries']:
+                    key = format_path(key).lower()
+                    if not key:
+                        continue
+                    if meta is None:
+                        self.remove(key)
+                    else:
+                        self.add(key, meta)
+                    changed += 1
+                cursor = rst['cursor']
+                self.set_state('cursor', cursor)
+                if not rst['has_more']:
+                    self.set_state('updated', repr(time.time()))
+                self.db.commit()
+                if not rst['has_more']:
+                    return changed
+
+    def query(self, where, args, limit, order='key'):
+        with self.lock:
+            rows = self.db.execute('SELECT meta FROM entries WHERE %s ORDER BY %s LIMIT ?' % (where, order),
+                                   list(args) + [limit]).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def find(self, path='/', name=None, prefix=None, contains=None, min_size=None, max_size=None,
+             modified_after=None, modified_before=None, is_dir=None, limit=INDEX_QUERY_LIMIT):
+        """
+        Metadata of the entries below path matching all the given conditions, by path
+
+        name: exact name, prefix: start of the name, contains: part of the
+        name, all without regard to case
+        min_size, max_size: bytes, inclusive
+        modified_after, modified_before: unix times, inclusive
+        """
+        key = format_path(path).lower()
+        low, high = prefix_range(key)
+        where = ['key >= ? AND key < ?']
+        args = [low, high]
+        if name is not None:
+            where.append('name = ?')
+            args.append(name.lower())
+        if prefix is not None:
+            where.append("name LIKE ? ESCAPE '\\'")
+            args.append(escape_like(prefix.lower()) + '%')
+        if contains is not None:
+            where.append("name LIKE ? ESCAPE '\\'")
+            args.append('%' + escape_like(contains.lower()) + '%')
+        for column, op, value in [('size', '>=', min_size), ('size', '<=', max_size),
+                                  ('mtime', '>=', modified_after), ('mtime', '<=', modified_before)]:
+            if value is not None:
+                where.append('%s %s ?' % (column, op))
+                args.append(value)
+        if is_dir is not None:
+            where.append('is_dir = ?')
+            args.append(is_dir and 1 or 0)
+        return self.query(' AND '.join(where), args, limit)
+
+    def get(self, path):
+        """
+        Metadata of path, None if it is not in the index
+        """
+        rst = self.query('key = ?', [format_path(path).lower()], 1)
+        return rst and rst[0] or None
+
+    def listdir(self, path, limit=INDEX_QUERY_LIMIT):
+        return self.query('parent = ?', [format_path(path).lower()], limit)
+
+    def by_sha1(self, sha1, limit=INDEX_QUERY_LIMIT):
+        """
+        Metadata of the files with this content
+        """
+        return self.query('sha1 = ?', [sha1.lower()], limit)
+
+    def search(self, path, query, file_limit=None, include_deleted=False):
+        """
+        WeipanClient.search from the index, remote when the index is stale
+
+        Deleted entries are not indexed, include_deleted searches remotely.
+        """
+        if include_deleted or self.is_stale():
+            return self.client.search(path, query, file_limit, include_deleted)
+        return self.find(path, contains=query, limit=file_limit or INDEX_QUERY_LIMIT)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
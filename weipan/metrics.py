@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory request metrics
+"""
+
+import threading
+
+from .request import RequestHook
+from .config import *
+
+class Histogram:
+    """
+    Counts of values per bucket, buckets are upper bounds in ascending order
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p (0..1) percentile, max for the last bucket
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= p * self.count:
+                return i < len(self.buckets) and min(self.buckets[i], self.max) or self.max
+
+    def to_dict(self):
+        return {
+            'buckets': self.buckets,
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max
+        }
+
+class EndpointStats:
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+        self.latency = Histogram(buckets)
+        self.ttfb = Histogram(buckets)
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'statuses': dict(self.statuses),
+            'latency': self.latency.to_dict(),
+            'ttfb': self.ttfb.to_dict(),
+            'p50': self.latency.percentile(0.5),
+            'p95': self.latency.percentile(0.95),
+            'p99': self.latency.percentile(0.99)
+        }
+
+class MetricsCollector(RequestHook):
+    """
+    Thread-safe counters and latency histograms per endpoint
+
+    Usage:
+        metrics = MetricsCollector()
+        c = client.WeipanClient(sess, hooks=[metrics])
+        ...
+        print metrics
+        export(metrics.snapshot())
+
+    An error is a request which got no response or a status of 400 or more,
+    a 304 answered to a metadata hash is not one.
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def after_response(self, info):
+        self.record(info)
+
+    def on_error(self, info, error):
+        self.record(info)
+
+    def record(self, info):
+        with self.lock:
+            stats = self.endpoints.get(info.endpoint)
+            if stats is None:
+                stats = self.endpoints[info.endpoint] = EndpointStats(self.buckets)
+            stats.requests += 1
+            if info.status is None or info.status >= 400:
+                stats.errors += 1
+            stats.retries += info.retries
+            stats.bytes_sent += info.bytes_sent or 0
+            stats.bytes_received += info.bytes_received or 0
+            stats.statuses[info.status] = stats.statuses.get(info.status, 0) + 1
+            stats.latency.add(info.timings['total'])
+            if info.timings['ttfb'] is not None:
+                stats.ttfb.add(info.timings['ttfb'])
+
+    def snapshot(self):
+        """
+        {endpoint: stats} as plain dicts, for export
+        """
+        with self.lock:
+            return dict((endpoint, stats.to_dict()) for endpoint, stats in self.endpoints.items())
+
+    def slowest(self, n=10, p=0.95):
+        """
+        [(endpoint, latency)] of the n endpoints with the highest p percentile latency
+        """
+        with self.lock:
+            rst = [(endpoint, stats.latency.percentile(p)) for endpoint, stats in self.endpoints.items()]
+        rst.sort(key=lambda item: item[1], reverse=True)
+        return rst[:n]
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def __str__(self):
+        lines = ['%-24s %8s %7s %8s %10s %10s' % ('endpoint', 'requests', 'errors', 'retries', 'p50 ms', 'p95 ms')]
+        for endpoint, stats in sorted(self.snapshot().items()):
+            lines.append('%-24s %8d %7d %8d %10.1f %10.1f' % (endpoint, stats['requests'], stats['errors'],
+                         stats['retries'], stats['p50'] * 1000, stats['p95'] * 1000))
+        return '\n'.join(lines)
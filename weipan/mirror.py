@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental local mirror driven by delta
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .client import format_path
+from .index import prefix_range
+from .config import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    rev TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def encode_path(path):
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+class Mirror:
+    """
+    Keep a local directory a copy of a remote folder
+
+    The first pull is a full delta pass, later pulls only apply the changes
+    since the saved cursor: folders are created, files downloaded
+    concurrently and deleted entries removed, a rename being a delete plus
+    an add. The cursor is committed after each delta page in one SQLite
+    transaction with an index of the local copy (path and rev of each
+    entry), so an interrupted pull resumes from the last completed page.
+    Removing a folder from the index is a range delete on its keys, the
+    cost of a pull depends on the changes, not on the size of the tree.
+    """
+
+    def __init__(self, client, local_dir, remote_root='/', state_path=None, workers=MIRROR_WORKERS):
+        """
+        state_path: SQLite database holding the cursor and the index
+        """
+        self.client = client
+        self.local_dir = os.path.abspath(local_dir)
+        self.remote_root = format_path(remote_root).lower()
+        self.state_path = state_path or os.path.join(self.local_dir, '.weipan-mirror.db')
+        self.workers = workers
+        self.stats = None
+        self.index = None
+        self.seen = None
+
+    def open_index(self):
+        db = sqlite3.connect(self.state_path)
+        db.text_factory = str
+        db.executescript(SCHEMA)
+        return db
+
+    def load_cursor(self):
+        db = self.index or self.open_index()
+        try:
+            row = db.execute("SELECT value FROM state WHERE name = 'cursor'").fetchone()
+        finally:
+            if db is not self.index:
+                db.close()
+        return row and row[0] or None
+
+    def save_cursor(self, cursor):
+        """
+        Set the cursor and commit it with the index changes
+        """
+        self.index.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('cursor', ?)", (cursor,))
+        self.index.commit()
+
+    def get_entry(self, key):
+        """
+        (path, is_dir, rev) of an indexed entry, None if it is not indexed
+        """
+        return self.index.execute('SELECT path, is_dir, rev FROM entries WHERE key = ?', (key,)).fetchone()
+
+    def set_entry(self, key, path, is_dir, rev=None):
+        self.index.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                           (key, encode_path(path), is_dir and 1 or 0, rev))
+
+    def local_path(self, path):
+        """
+        Local path of a remote path, None if it is outside the mirrored folder
+        """
+        key = format_path(path).lower()
+        if key != self.remote_root and not key.startswith(self.remote_root + '/'):
+            return None
+        relative = format_path(path)[len(self.remote_root):].lstrip('/')
+        local_path = os.path.normpath(os.path.join(self.local_dir, encode_path(relative)))
+        if local_path != self.local_dir and not local_path.startswith(self.local_dir + os.sep):
+            return None
+        return local_path
+
+    def remove(self, key):
+        """
+        Remove an entry and everything below it, from disk and from the index
+        """
+        entry = self.get_entry(key)
+        local_path = self.local_path(entry and entry[0].decode('utf-8') or key)
+        if local_path is None or local_path == self.local_dir:
+            return
+        if os.path.isdir(local_path) and not os.path.islink(local_path):
+            shutil.rmtree(local_path)
+        elif os.path.lexists(local_path):
+            os.remove(local_path)
+        else:
+            return
+        self.stats['deleted'] += 1
+
+    def unindex(self, key):
+        low, high = prefix_range(key)
+        self.index.execute('DELETE FROM entries WHERE key = ? OR (key >= ? AND key < ?)', (key, low, high))
+
+    def download(self, meta):
+        local_path = self.local_path(meta['path'])
+        parent = os.path.dirname(local_path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmp_path = '%s.%d.weipan-tmp' % (local_path, threading.current_thread().ident)
+        try:
+            self.client.download_to(meta['path'], tmp_path, meta.get('rev'))
+            os.rename(tmp_path, local_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return meta
+
+    def apply(self, entries, pool):
+        """
+        Apply one delta page, files are downloaded on the pool
+        """
+        downloads = []
+        for path, meta in entries:
+            key = format_path(path).lower()
+            if self.seen is not None:
+                self.seen.add(encode_path(key))
+            if self.local_path(path) is None:
+                continue
+            if meta is None:
+                self.remove(key)
+                self.unindex(encode_path(key))
+                continue
+
+            local_path = self.local_path(meta['path'])
+            if meta.get('is_dir'):
+                if os.path.lexists(local_path) and not os.path.isdir(local_path):
+                    os.remove(local_path)
+                if not os.path.isdir(local_path):
+                    os.makedirs(local_path)
+                    self.stats['folders'] += 1
+                self.set_entry(encode_path(key), meta['path'], True)
+                continue
+
+            entry = self.get_entry(encode_path(key))
+            if entry and entry[2] == meta.get('rev') and os.path.isfile(local_path):
+                continue
+            if os.path.isdir(local_path):
+                shutil.rmtree(local_path)
+            downloads.append(meta)
+
+        for meta in pool.imap_unordered(self.download, downloads):
+            self.set_entry(encode_path(format_path(meta['path']).lower()), meta['path'], False, meta.get('rev'))
+            self.stats['downloaded'] += 1
+
+    def prune(self):
+        """
+        After a reset, remove indexed entries which were not listed again
+        """
+        keys = [row[0] for row in self.index.execute('SELECT key FROM entries ORDER BY key')]
+        for key in keys:
+            if key not in self.seen and self.get_entry(key) is not None:
+                self.remove(key)
+                self.unindex(key)
+
+    def pull(self):
+        """
+        Bring the local copy up to date, return counts of changes applied
+        """
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        self.stats = {'downloaded': 0, 'deleted': 0, 'folders': 0}
+        self.index = self.open_index()
+        self.seen = None
+        cursor = self.load_cursor()
+        pool = ThreadPool(self.workers)
+        try:
+            while True:
+                page = self.client.delta(cursor)
+                if page.get('reset'):
+                    self.seen = set()
+                self.apply(page['entries'], pool)
+                cursor = page['cursor']
+                self.save_cursor(cursor)
+                if not page.get('has_more'):
+                    break
+            if self.seen is not None:
+                self.prune()
+                self.index.commit()
+        finally:
+            pool.terminate()
+            self.index.close()
+            self.index = None
+        return self.stats
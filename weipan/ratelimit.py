@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client side rate limiting
+"""
+
+import time
+import threading
+
+from .config import *
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+
+    Tokens are added at `rate` per second up to `burst`, so an idle client
+    may send `burst` requests at once, then `rate` requests per second.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens, return seconds to wait before using them
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if they are available now, return whether they were taken
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available, return seconds waited
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+def endpoint_class(url):
+    """
+    'upload', 'auth' or 'api' depending on the host of url, for the default hosts
+    """
+    if url.startswith(UPLOAD_URL):
+        return 'upload'
+    if url.startswith(AUTH_URL):
+        return 'auth'
+    return 'api'
+
+class RateLimiter:
+    """
+    Token buckets for API, upload and auth hosts
+
+    Each budget is a TokenBucket, a (rate, burst) tuple or None for no
+    limit. One RateLimiter can be shared by clients and threads using the
+    same app key.
+    """
+
+    def __init__(self, api=None, upload=None, auth=None):
+        self.buckets = {}
+        for name, budget in [('api', api), ('upload', upload), ('auth', auth)]:
+            if isinstance(budget, tuple):
+                budget = TokenBucket(*budget)
+            self.buckets[name] = budget
+
+    @classmethod
+    def from_delay(cls, delay):
+        """
+        At most one request per `delay` seconds on each host, without waiting after idle time
+        """
+        return cls(api=(1.0 / delay, 1), upload=(1.0 / delay, 1), auth=(1.0 / delay, 1))
+
+    def acquire(self, url, endpoint=None):
+        """
+        Wait for the budget of an endpoint class, return seconds waited
+
+        endpoint: 'api', 'upload' or 'auth', given by callers which know the
+            hosts they use, else guessed from url with endpoint_class()
+        """
+        bucket = self.buckets.get(endpoint or endpoint_class(url))
+        if bucket is None:
+            return 0
+        return bucket.acquire()
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os.path
+import re
+import sys
 import httplib
 import urlparse
 import urllib
 import socket
 import json
 import mimetypes
+import select
+import threading
+import time
 
 from .config import *
+from .retry import RetryPolicy
 
 def append_url(url, params):
     if type(params) == dict:
@@ -50,12 +56,514 @@ def encode_multipart_formdata(fields, files):
 def get_content_type(filename):
     return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
-class RequestObject:
+class MultipartBody:
+    """
+    multipart/form-data body which streams files from disk
+
+    fields is a sequence of (name, value) elements for regular form fields.
+    files is a sequence of (name, filename, file_path) elements for files to be uploaded.
+    The length is known up front, iterating yields the body in chunks of
+    at most chunk_size bytes, so memory use does not depend on file sizes.
+    """
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    CRLF = '\r\n'
+
+    def __init__(self, fields, files, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.content_type = 'multipart/form-data; boundary=%s' % self.BOUNDARY
+        # str parts are sent as they are, tuple parts are (file_path, size)
+        self.parts = []
+        for (key, value) in fields:
+            self.parts.append(self.CRLF.join([
+                '--' + self.BOUNDARY,
+                'Content-Disposition: form-data; name="%s"' % key,
+                '',
+                encode_value(value),
+                ''
+            ]))
+        for (key, filename, file_path) in files:
+            self.parts.append(self.CRLF.join([
+                '--' + self.BOUNDARY,
+                'Content-Disposition: form-data; name="%s"; filename="%s"' % (key, encode_value(filename)),
+                'Content-Type: %s' % get_content_type(filename),
+                '',
+                ''
+            ]))
+            self.parts.append((file_path, os.path.getsize(file_path)))
+            self.parts.append(self.CRLF)
+        self.parts.append('--' + self.BOUNDARY + '--' + self.CRLF)
+
+    def __len__(self):
+        length = 0
+        for part in self.parts:
+            if isinstance(part, tuple):
+                length += part[1]
+            else:
+                length += len(part)
+        return length
+
+    def __iter__(self):
+        for part in self.parts:
+            if not isinstance(part, tuple):
+                yield part
+                continue
+            with open(part[0], 'rb') as fh:
+                while True:
+                    chunk = fh.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+class StreamBody:
+    """
+    Request body read from a file-like object or an iterator of strings
+
+    With a length the body is sent as is with a Content-Length, and a
+    source which ends early or goes on raises ValueError, else it is sent
+    with chunked transfer encoding. At most chunk_size bytes are read at a
+    time, chunks of an iterator are sent as they come. The body can be sent
+    again only if nothing was read from the source yet, or the source is
+    seekable.
+    """
+
+    def __init__(self, source, length=None, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.length = length
+        self.chunk_size = chunk_size
+        self.started = False
+        self.position = None
+        if hasattr(source, 'seek') and hasattr(source, 'tell'):
+            try:
+                self.position = source.tell()
+            except (IOError, ValueError):
+                pass
+
+    def headers(self):
+        if self.length is None:
+            return {'Transfer-Encoding': 'chunked'}
+        return {'Content-Length': str(self.length)}
+
+    def chunks(self):
+        if hasattr(self.source, 'read'):
+            while True:
+                chunk = self.source.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            for chunk in self.source:
+                yield chunk
+
+    def rewind(self):
+        if not self.started:
+            return True
+        if self.position is None:
+            return False
+        try:
+            self.source.seek(self.position)
+        except (IOError, ValueError):
+            return False
+        self.started = False
+        return True
+
+    def __iter__(self):
+        self.started = True
+        sent = 0
+        for chunk in self.chunks():
+            chunk = encode_value(chunk)
+            if not chunk:
+                # an empty chunk would end a chunked body
+                continue
+            sent += len(chunk)
+            if self.length is None:
+                yield '%x\r\n%s\r\n' % (len(chunk), chunk)
+            elif sent > self.length:
+                raise ValueError("stream is longer than %d bytes" % self.length)
+            else:
+                yield chunk
+        if self.length is None:
+            yield '0\r\n\r\n'
+        elif sent < self.length:
+            raise ValueError("stream ended after %d of %d bytes" % (sent, self.length))
+
+def rewind_body(body, position=None):
+    """
+    Prepare a body to be sent again, return False if it can not be
+    """
+    if body is None or isinstance(body, (basestring, MultipartBody)):
+        return True
+    if isinstance(body, StreamBody):
+        return body.rewind()
+    if position is None:
+        return False
+    try:
+        body.seek(position)
+    except (IOError, ValueError):
+        return False
+    return True
+
+def encode_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def body_length(body, position=None):
+    """
+    Bytes in a request body, None if unknown
+    """
+    if body is None:
+        return 0
+    if isinstance(body, (basestring, MultipartBody)):
+        return len(body)
+    if isinstance(body, StreamBody):
+        return body.length
+    try:
+        return os.fstat(body.fileno()).st_size - (position or 0)
+    except (AttributeError, IOError, OSError):
+        return None
+
+def mask_url(url):
+    """
+    url with the access_token hidden, for logs
+    """
+    return re.sub(r'([?&]access_token=)[^&]*', r'\1***', url)
+
+def endpoint_name(url):
+    """
+    API call of url without root and path like 'metadata' or 'fileops/copy', the host for other URLs
+    """
+    urlinfo = urlparse.urlparse(url)
+    match = re.search(r'/(2|oauth2)/([^?]+)$', urlinfo.path)
+    if match is None:
+        return urlinfo.hostname
+    parts = match.group(1) == 'oauth2' and ['oauth2'] or []
+    for part in match.group(2).split('/'):
+        if part in ('basic', 'sandbox'):
+            break
+        parts.append(part)
+    return '/'.join(parts)
+
+class RequestInfo:
+    """
+    What hooks get to know about one HTTP request
+
+    endpoint: see endpoint_name()
+    url: with the access_token masked
+    status: None when no response was received
+    bytes_sent: size of the body, None if unknown
+    bytes_received: size of the body read, the Content-Length of streamed responses
+    retries: attempts after the first one
+    timings: seconds for dns, connect, ttfb (from the start of the last
+        attempt to the response headers) and total. dns and connect are 0
+        on a reused connection, dns is None on HTTPS where it is part of connect.
+    """
+
+    def __init__(self, method, url, bytes_sent=None):
+        self.method = method
+        self.url = mask_url(url)
+        self.endpoint = endpoint_name(url)
+        self.status = None
+        self.bytes_sent = bytes_sent
+        self.bytes_received = None
+        self.retries = 0
+        self.started = time.time()
+        self.timings = {'dns': None, 'connect': None, 'ttfb': None, 'total': None}
+
+    def finish(self, status, bytes_received):
+        self.status = status
+        self.bytes_received = bytes_received
+        self.timings['total'] = time.time() - self.started
+
+class RequestHook:
+    """
+    Base class of request hooks, override the methods of interest
+
+    Hooks run on the thread making the request, after_response once the
+    body is read (or the response returned for streaming) and on_error
+    when the request raises. Exceptions raised by hooks reach the caller.
+    """
+
+    def before_request(self, info):
+        pass
+
+    def after_response(self, info):
+        pass
+
+    def on_error(self, info, error):
+        pass
+
+def run_hooks(hooks, name, *args):
+    for hook in hooks:
+        getattr(hook, name)(*args)
+
+def send_request(conn, method, url, body, headers):
+    """
+    Send request line, headers and body, iterable bodies are sent chunk by chunk
+    """
+    if body is None or isinstance(body, basestring) or hasattr(body, 'read'):
+        conn.request(method, url, body, headers)
+        return
+
+    conn.putrequest(method, url)
+    for k, v in headers.items():
+        conn.putheader(k, v)
+    conn.endheaders()
+    for chunk in body:
+        conn.send(chunk)
+
+def is_connection_dropped(conn):
+    """
+    Check whether an idle keep-alive connection has been closed by the peer
+
+    An idle connection should never be readable, a readable socket means
+    EOF or unexpected data, either way it can not be reused.
+    """
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+class ConnectionPool:
+    """
+    Thread-safe pool of idle keep-alive connections, keyed by (scheme, host, port)
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        """
+        max_size: max idle connections kept for each key
+        idle_timeout: seconds an idle connection is kept before being closed
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, key):
+        """
+        Get a healthy idle connection for key, or None
+        """
+        now = time.time()
+        while True:
+            with self.lock:
+                conns = self.idle.get(key)
+                if not conns:
+                    return None
+                conn, released_at = conns.pop()
+            if self.idle_timeout is not None and now - released_at > self.idle_timeout:
+                conn.close()
+            elif is_connection_dropped(conn):
+                conn.close()
+            else:
+                return conn
+
+    def release(self, key, conn):
+        """
+        Put a connection back to the pool, close it if the pool is full
+        """
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_size:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn, released_at in conns:
+                conn.close()
+
+class Transport:
+    """
+    Interface of the HTTP transports used by WeipanClient and WeipanSession
+
+    request() sends a request, follows a 302 if asked to and returns the
+    body as parsed JSON (format='json'), a string ('plain') or the
+    response itself (None or 'response', released with release_response()).
+    A status other than 200, or 206 for a Range request, raises
+    ErrorResponse. Transports must be safe to share between threads.
+    """
+
+    def request(self, method, url, params=None, body=None, headers=None, follow=False, format=None, hooks=None):
+        raise NotImplementedError
+
+    def get(self, url, params = None, headers = None, follow=False, format=None, hooks=None):
+        """
+        Send request with GET method
+        """
+        return self.request('GET', url, params=params, headers=headers, follow=follow, format=format, hooks=hooks)
+
+    def post(self, url, params = None, headers=None, follow=False, format=None, hooks=None):
+        """
+        Send request with POST method
+        """
+        return self.request('POST', url, params=params, headers=headers, follow=follow, format=format, hooks=hooks)
+
+    def put(self, url, params = None, body=None, headers=None, follow=False, format=None, hooks=None):
+        """
+        Send request with PUT method
+        """
+        return self.request('PUT', url, params=params, body=body, headers=headers, follow=follow, format=format, hooks=hooks)
+
+    def close(self):
+        """
+        Release the resources held, the transport stays usable
+        """
+        pass
+
+class RequestObject(Transport):
+    """
+    httplib transport with retries, hooks and a keep-alive connection pool
+    """
     https_connect = None
     http_connect = None
-    def request(self, method, url, params=None, body=None, headers=None, follow=False, format=None):
+
+    def __init__(self, pool=None, retry=None, hooks=None):
+        """
+        retry: retry.RetryPolicy, RetryPolicy(max_retries=0) disables retrying
+        hooks: RequestHook objects called for every request
+        """
+        self.pool = pool or ConnectionPool()
+        self.retry = retry or RetryPolicy()
+        self.hooks = list(hooks or [])
+
+    def connect(self, scheme, host, port):
+        """
+        Open a new connection, HTTP and HTTPS handled by different classes
+        """
+        if scheme == 'https':
+            if self.https_connect is None:
+                self.https_connect = httplib.HTTPSConnection
+            return self.https_connect(host, port)
+        else:
+            if self.http_connect is None:
+                self.http_connect = httplib.HTTPConnection
+            return self.http_connect(host, port)
+
+    def open(self, conn, key, info=None):
+        """
+        Connect conn, recording DNS and connect times in info
+
+        With info, plain HTTP sockets are opened here so that the lookup is
+        timed apart from the connect. HTTPS connections resolve the name
+        themselves.
+        """
+        started = time.time()
+        scheme, host, port = key
+        if info is None or scheme != 'http':
+            conn.connect()
+        else:
+            addrs = socket.getaddrinfo(host, port or httplib.HTTP_PORT, 0, socket.SOCK_STREAM)
+            info.timings['dns'] = time.time() - started
+            for i, addr in enumerate(addrs):
+                try:
+                    conn.sock = socket.create_connection(addr[4][:2], conn.timeout)
+                    break
+                except socket.error:
+                    if i == len(addrs) - 1:
+                        raise
+        # the body is written after the headers, without TCP_NODELAY it
+        # waits for the server to ACK them, which may be delayed by 40ms
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if info is not None:
+            info.timings['connect'] = time.time() - started - (info.timings['dns'] or 0)
+
+    def release(self, key, conn, response):
+        """
+        Reuse the connection of a fully read response
+        """
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self.pool.release(key, conn)
+
+    def send(self, key, method, url, body, headers, position=None, info=None):
+        """
+        Send the request on a pooled or a new connection, return (conn, response)
+
+        Raises ConnectError when nothing could be sent.
+        """
+        started = time.time()
+        conn = self.pool.acquire(key)
+        if conn is not None:
+            written = False
+            try:
+                send_request(conn, method, url, body, headers)
+                written = True
+                response = conn.getresponse()
+                if info is not None:
+                    info.timings.update(dns=0, connect=0, ttfb=time.time() - started)
+                return conn, response
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                # the server may close an idle connection at any time, retry
+                # once with a new connection if the body can be sent again,
+                # and if the request was not delivered or may be repeated
+                if written and method not in self.retry.idempotent_methods:
+                    raise SocketError(e)
+                if not rewind_body(body, position):
+                    if isinstance(e, socket.error):
+                        raise SocketError(e)
+                    raise
+
+        conn = self.connect(*key)
+        try:
+            self.open(conn, key, info)
+        except socket.error, e:
+            conn.close()
+            raise ConnectError(e)
+        try:
+            send_request(conn, method, url, body, headers)
+            response = conn.getresponse()
+        except socket.error, e:
+            conn.close()
+            raise SocketError(e)
+        if info is not None:
+            info.timings['ttfb'] = time.time() - started
+        return conn, response
+
+    def send_retrying(self, key, method, url, body, headers, position=None, info=None):
+        """
+        send() with failures retried according to self.retry, return (conn, response)
+        """
+        attempt = 0
+        started = time.time()
+        while True:
+            if info is not None:
+                info.retries = attempt
+            try:
+                conn, response = self.send(key, method, url, body, headers, position, info)
+            except (socket.error, httplib.HTTPException), e:
+                exc_info = sys.exc_info()
+                delay = self.retry.delay(method, attempt, started, sent=not isinstance(e, ConnectError))
+                if delay is None or not rewind_body(body, position):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                if response.status < 400:
+                    return conn, response
+                delay = self.retry.delay(method, attempt, started, response=response)
+                if delay is None or not rewind_body(body, position):
+                    return conn, response
+                response.read()
+                self.release(key, conn, response)
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, method, url, params=None, body=None, headers=None, follow=False, format=None, hooks=None):
         """
         Send HTTP or HTTPS request, and get the response
+
+        Failures are retried according to self.retry.
+        hooks: RequestHook objects for this request, in addition to self.hooks
         """
         params = params or {}
         headers = headers or {}
@@ -73,84 +581,153 @@ class RequestObject:
             mf_fields = []
             for k in params.keys():
                 if k.startswith('@'):
-                    with open(params[k], 'rb') as fh:
-                        file_content = fh.read()
-                    mf_files.append((k[1:], os.path.basename(params[k]), file_content))
+                    mf_files.append((k[1:], os.path.basename(params[k]), params[k]))
                 else:
                     mf_fields.append((k, params[k]))
 
             if mf_files:
-                content_type, body = encode_multipart_formdata(mf_fields, mf_files)
+                body = MultipartBody(mf_fields, mf_files)
+                content_type = body.content_type
+                headers['Content-Length'] = str(len(body))
             else:
                 content_type = "application/x-www-form-urlencoded"
                 body = urllib.urlencode(params)
             headers["Content-type"] = content_type
 
+        if isinstance(body, StreamBody):
+            headers.update(body.headers())
+
         urlinfo = urlparse.urlparse(url)
-        host = urlinfo.hostname
-        scheme= urlinfo.scheme
+        key = (urlinfo.scheme, urlinfo.hostname, urlinfo.port)
 
-        # HTTP and HTTPS handled by different classes
-        if(scheme == 'https'):
-            if self.https_connect is None:
-                self.https_connect = httplib.HTTPSConnection
-            conn = self.https_connect(host)
-        else:
-            if self.http_connect is None:
-                self.http_connect = httplib.HTTPConnection
-            conn = self.http_connect(host)
+        # file bodies are rewound to where they started for a retry
+        position = None
+        if hasattr(body, 'seek') and hasattr(body, 'tell'):
+            try:
+                position = body.tell()
+            except IOError:
+                pass
+
+        active = self.hooks + list(hooks or [])
+        info = None
+        if active:
+            info = RequestInfo(method, url, body_length(body, position))
+            run_hooks(active, 'before_request', info)
 
+        status = received = redirect = None
         try:
-            conn.request(method, url, body, headers)
-        except socket.error, e:
-            raise SocketError(e)
+            conn, response = self.send_retrying(key, method, url, body, headers, position, info)
+            status = response.status
 
-        response = conn.getresponse()
-        if follow and response.status == 302:
-            #follow location
-            redirect = response.getheader('location')
-            return self.request('GET', redirect, follow=True, format=format)
+            if follow and response.status == 302:
+                #follow location
+                redirect = response.getheader('location')
+                received = len(response.read())
+                self.release(key, conn, response)
+                rst = None
+            elif response.status != 200 and not (response.status == 206 and 'Range' in headers):
+                error = ErrorResponse(response, format)
+                received = len(error.body)
+                self.release(key, conn, response)
+                raise error
+            elif format in ['json', 'plain']:
+                content = response.read()
+                received = len(content)
+                self.release(key, conn, response)
+                if format == 'plain':
+                    rst = content
+                else:
+                    try: 
+                        rst = json.loads(content)
+                    except ValueError:
+                        raise ErrorResponse(response, format)
+            else:
+                # the body is read by the caller, see release_response()
+                length = response.getheader('content-length')
+                received = length and length.isdigit() and int(length) or None
+                response.release_conn = lambda: self.release(key, conn, response)
+                rst = response
+        except Exception, e:
+            if info is None:
+                raise
+            exc_info = sys.exc_info()
+            info.finish(status, received)
+            run_hooks(active, 'on_error', info, e)
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-        if response.status != 200:
-            raise ErrorResponse(response, format)
+        if info is not None:
+            info.finish(status, received)
+            run_hooks(active, 'after_response', info)
+        if redirect is not None:
+            return self.request('GET', redirect, follow=True, format=format, hooks=hooks)
+        return rst
 
-        if format in ['json', 'plain']:
-            content = response.read()
-            conn.close()
-            if format == 'plain':
-                return content
-            else:
-                try: 
-                    j = json.loads(content)
-                except ValueError:
-                    raise ErrorResponse(response, format)
-                return j
-        else:
-            return response
+    def close(self):
+        self.pool.clear()
 
-    def get(self, url, params = None, headers = None, follow=False, format=None):
-        """
-        Send request with GET method
-        """
-        return self.request('GET', url, params=params, headers=headers, follow=follow, format=format);
+class PooledTransport(RequestObject):
+    """
+    Keeps up to max_size idle connections per host for reuse
 
-    def post(self, url, params = None, headers=None, follow=False, format=None):
-        """
-        Send request with POST method
-        """
-        return self.request('POST', url, params=params, headers=headers, follow=follow, format=format)
+    The default, best for many small API calls.
+    """
 
-    def put(self, url, params = None, body=None, headers=None, follow=False, format=None):
-        """
-        Send request with PUT method
-        """
-        return self.request('PUT', url, params=params, body=body, headers=headers, follow=follow, format=format)
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, retry=None, hooks=None):
+        RequestObject.__init__(self, ConnectionPool(max_size, idle_timeout), retry, hooks)
+
+class SimpleTransport(RequestObject):
+    """
+    Opens a new connection for every request and closes it afterwards
+
+    Keeps no state between requests, for occasional calls or processes
+    which fork.
+    """
+
+    def __init__(self, retry=None, hooks=None):
+        RequestObject.__init__(self, ConnectionPool(max_size=0), retry, hooks)
+
+def release_response(response):
+    """
+    Give back the connection of a response returned with format=None/'response'
+
+    A fully read response keeps its connection alive for reuse, otherwise
+    the connection is closed.
+    """
+    release = getattr(response, 'release_conn', None)
+    if release is None:
+        response.close()
+    else:
+        response.release_conn = None
+        release()
+
+def iter_response(response, chunk_size=CHUNK_SIZE):
+    """
+    Yield the response body in chunks of at most chunk_size bytes, then release the connection
+    """
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        release_response(response)
+
+def copy_response(response, fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Write the response body to fileobj, return bytes written
+    """
+    written = 0
+    for chunk in iter_response(response, chunk_size):
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
 
 class Request:
     """
-    Request wrapper
+    Request wrapper around the default transport, used by clients created without one
     """
-    IMPL = RequestObject()
+    IMPL = PooledTransport()
 
     @classmethod
     def request(cls, *args, **kwargs):
@@ -181,6 +758,12 @@ def ensure_json(response):
 class SocketError(socket.error):
     pass
 
+class ConnectError(SocketError):
+    """
+    The connection could not be established, nothing was sent
+    """
+    pass
+
 class ErrorResponse(Exception):
     def getheader(self, info):
         for k, v in self.headers:
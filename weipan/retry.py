@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retry policy for failed requests
+"""
+
+import time
+import random
+import threading
+import email.utils
+
+from .config import *
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter, Retry-After and a total time budget
+
+    Idempotent methods are retried on connection errors and on the
+    retryable statuses. Other methods, such as the POSTs of fileops, are
+    only retried when the request could not be sent at all, or on 429,
+    which means the request was rejected unprocessed.
+    """
+
+    def __init__(self, max_retries=RETRY_MAX, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF,
+                 budget=RETRY_BUDGET, jitter=True, statuses=(429, 500, 502, 503, 504),
+                 idempotent_methods=('GET', 'HEAD')):
+        """
+        max_retries: retries after the first attempt, 0 disables retrying
+        backoff: delay before the first retry, doubled for each retry up to max_backoff
+        budget: seconds after which no more retries are started
+        jitter: wait a random delay between 0 and the backoff
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.jitter = jitter
+        self.statuses = statuses
+        self.idempotent_methods = idempotent_methods
+        self.lock = threading.Lock()
+        self.counters = {
+            'retries': 0,
+            'connect_errors': 0,
+            'errors': 0,
+            'statuses': 0,
+            'gave_up': 0
+        }
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def backoff_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def retry_after(self, response):
+        """
+        Seconds from a Retry-After header, in seconds or as an HTTP date
+        """
+        value = response is not None and response.getheader('retry-after')
+        if not value:
+            return 0
+        try:
+            return max(0, int(value))
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return 0
+            return max(0, email.utils.mktime_tz(date) - time.time())
+
+    def delay(self, method, attempt, started, sent=True, response=None):
+        """
+        Seconds to wait before retrying, or None to give up
+
+        attempt: number of retries done so far
+        started: time of the first attempt
+        sent: False when the failure happened before anything was sent
+        response: the response for a failure status, None for connection errors
+        """
+        if response is not None:
+            if response.status not in self.statuses:
+                return None
+            if method not in self.idempotent_methods and response.status != 429:
+                return None
+            counter = 'statuses'
+        elif not sent:
+            counter = 'connect_errors'
+        elif method in self.idempotent_methods:
+            counter = 'errors'
+        else:
+            return None
+        self.count(counter)
+
+        delay = max(self.backoff_delay(attempt), self.retry_after(response))
+        if attempt >= self.max_retries or time.time() - started + delay > self.budget:
+            self.count('gave_up')
+            return None
+        self.count('retries')
+        return delay
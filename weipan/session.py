@@ -4,18 +4,32 @@ from . import request
 from .config import *
 
 class WeipanSession:
+    auth_url = AUTH_URL
 
-    def __init__(self, appkey, appsecret, callback, access_type='sandbox'):
+    def __init__(self, appkey, appsecret, callback, access_type='sandbox', rate_limiter=None, hooks=None,
+                 transport=None):
+        """
+        rate_limiter: ratelimit.RateLimiter for the auth host
+        hooks: request.RequestHook objects called for each request
+        transport: request.Transport for this session, request.Request.IMPL by default
+        """
         self.APP_KEY = appkey
         self.APP_SECRET = appsecret
         assert access_type in ['basic', 'sandbox'], "expected access_type of 'basic' or 'sandbox'"
         self.callback = callback
         self.root = access_type
         self.token = None
-
+        self.rate_limiter = rate_limiter
+        self.hooks = list(hooks or [])
+        self.transport = transport
 
     def build_oauth2_url(self, path, params=None):
-        return request.append_url(AUTH_URL+path, params)
+        return request.append_url(self.auth_url+path, params)
+
+    def post(self, url, params):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(url, 'auth')
+        return (self.transport or request.Request.IMPL).post(url, params, format='json', hooks=self.hooks)
 
     def build_authorize_url(self, response_type='code', state='', display='default'):
         params = {
@@ -35,7 +49,7 @@ class WeipanSession:
             'redirect_uri': self.callback,
             'code': code
         }
-        return request.Request.post(self.build_oauth2_url('access_token'), params, format='json')
+        return self.post(self.build_oauth2_url('access_token'), params)
 
     def access_token_with_password(self, username, password):
         params = {
@@ -46,7 +60,7 @@ class WeipanSession:
             'password': password
         }
 
-        return request.Request.post(self.build_oauth2_url('access_token'), params, format='json')
+        return self.post(self.build_oauth2_url('access_token'), params)
 
     def refresh_token(self, refresh_token):
         params = {
@@ -56,7 +70,7 @@ class WeipanSession:
             'refresh_token': refresh_token
         }
 
-        return request.Request.post(self.build_oauth2_url('access_token'), params, format='json')
+        return self.post(self.build_oauth2_url('access_token'), params)
 
     def set_token(self, token):
         self.token = token
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+Upload a local directory, skipping unchanged files
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+from . import request, walk, hashing, dedup
+from .client import format_path
+from .fileops import BatchResult
+from .config import *
+
+class SyncPlan:
+    """
+    Changes needed to make a remote folder match a local directory
+    """
+
+    def __init__(self):
+        self.create_folders = []
+        # (local_path, remote_path)
+        self.uploads = []
+        self.deletes = []
+        self.unchanged = 0
+        self.results = None
+
+    def __len__(self):
+        return len(self.create_folders) + len(self.uploads) + len(self.deletes)
+
+    def __str__(self):
+        lines = ['mkdir  %s' % path for path in self.create_folders]
+        lines += ['upload %s -> %s' % upload for upload in self.uploads]
+        lines += ['delete %s' % path for path in self.deletes]
+        lines.append('%d to create, %d to upload, %d to delete, %d unchanged' % (
+            len(self.create_folders), len(self.uploads), len(self.deletes), self.unchanged))
+        return '\n'.join(lines)
+
+class SyncUp:
+    """
+    Make a remote folder a copy of a local directory
+
+    Local files are compared with the size, md5 and sha1 from metadata and
+    only files which differ are uploaded. Missing folders are created, and
+    remote entries without a local counterpart are deleted when asked.
+    The files whose size matches are hashed together with a
+    hashing.Hasher, the client's one if it has a hasher, else one without
+    cache.
+
+    With a dedup.ContentMap, the remote files listed are added to it and
+    uploads copy a remote file with the same content when there is one.
+    """
+
+    def __init__(self, client, local_dir, remote_dir, delete=False, workers=SYNC_WORKERS, hasher=None,
+                 content_map=None):
+        self.client = client
+        self.local_dir = os.path.abspath(local_dir)
+        self.remote_dir = format_path(remote_dir) or '/'
+        self.delete = delete
+        self.workers = workers
+        self.hasher = hasher or getattr(client, 'hasher', None) or hashing.Hasher()
+        self.content_map = content_map
+
+    def remote_path(self, relative):
+        relative = os.path.normpath(relative).replace(os.sep, '/')
+        return format_path(self.remote_dir + '/' + relative)
+
+    def list_remote(self):
+        """
+        Return {lowercased path: metadata} of everything below remote_dir, None if it does not exist
+        """
+        try:
+            self.client.metadata(self.remote_dir, list=False)
+        except request.ErrorResponse, e:
+            if e.status == 404:
+                return None
+            raise
+        entries = {}
+        for entry in walk.walk(self.client, self.remote_dir, filter=lambda entry: not entry.get('is_deleted'), workers=self.workers):
+            entries[format_path(entry['path']).lower()] = entry
+        if self.content_map is not None:
+            self.content_map.add_all(entries.values())
+        return entries
+
+    def may_be_same(self, local_path, meta):
+        """
+        Whether a local file needs hashing to compare with its remote counterpart
+        """
+        if meta.get('is_dir') or int(meta.get('bytes', -1)) != os.path.getsize(local_path):
+            return False
+        return bool(meta.get('md5') or meta.get('sha1'))
+
+    def is_same(self, hashes, meta):
+        md5, sha1 = hashes
+        return (not meta.get('md5') or meta['md5'].lower() == md5) and \
+               (not meta.get('sha1') or meta['sha1'].lower() == sha1)
+
+    def plan(self):
+        plan = SyncPlan()
+        remote = self.list_remote()
+        if remote is None:
+            remote = {}
+            if self.remote_dir != '/':
+                plan.create_folders.append(self.remote_dir)
+
+        local_keys = set()
+        # (local_path, path, meta) of the local files
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.local_dir):
+            dirnames.sort()
+            relative_dir = os.path.relpath(dirpath, self.local_dir)
+            if relative_dir != '.':
+                path = self.remote_path(relative_dir)
+                local_keys.add(path.lower())
+                meta = remote.get(path.lower())
+                if meta is None or not meta.get('is_dir'):
+                    if meta is not None:
+                        plan.deletes.append(meta['path'])
+                    plan.create_folders.append(path)
+            for filename in sorted(filenames):
+                local_path = os.path.join(dirpath, filename)
+                path = self.remote_path(os.path.join(relative_dir, filename))
+                local_keys.add(path.lower())
+                files.append((local_path, path, remote.get(path.lower())))
+
+        hashes = self.hasher.hash_many([local_path for local_path, path, meta in files
+                                        if meta is not None and self.may_be_same(local_path, meta)])
+        for local_path, path, meta in files:
+            if local_path in hashes and self.is_same(hashes[local_path], meta):
+                plan.unchanged += 1
+                continue
+            if meta is not None and meta.get('is_dir'):
+                plan.deletes.append(meta['path'])
+            plan.uploads.append((local_path, path))
+
+        if self.delete:
+            deleted = set(format_path(path).lower() for path in plan.deletes)
+            for key in sorted(remote):
+                if key in local_keys:
+                    continue
+                # deleting a folder deletes what is below it
+                parts = key.split('/')
+                if any('/'.join(parts[:i]) in deleted for i in range(2, len(parts))):
+                    continue
+                deleted.add(key)
+                plan.deletes.append(remote[key]['path'])
+        return plan
+
+    def upload(self, upload):
+        local_path, path = upload
+        try:
+            if self.content_map is not None:
+                return BatchResult(('put_file', path, local_path),
+                                   result=dedup.DedupUpload(self.client, path, local_path, self.content_map).run())
+            return BatchResult(('put_file', path, local_path), result=self.client.put_file(path, local_path))
+        except Exception, e:
+            return BatchResult(('put_file', path, local_path), error=e)
+
+    def run(self, plan=None):
+        """
+        Execute a plan, made from the current state by default
+
+        Returns the plan with results set to a fileops.BatchResult for each change.
+        """
+        if plan is None:
+            plan = self.plan()
+        results = self.client.batch([('delete', path) for path in plan.deletes] +
+                                    [('create_folder', path) for path in plan.create_folders], self.workers)
+        if self.content_map is not None:
+            for path in plan.deletes:
+                self.content_map.discard_below(path)
+        if plan.uploads:
+            pool = ThreadPool(min(self.workers, len(plan.uploads)))
+            try:
+                results += pool.map(self.upload, plan.uploads)
+            finally:
+                pool.close()
+        plan.results = results
+        return plan
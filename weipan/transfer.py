@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+Large file transfers
+"""
+
+import os
+import time
+import httplib
+import socket
+from multiprocessing.pool import ThreadPool
+
+from . import request, hashing
+from .config import *
+
+class TransferError(Exception):
+    pass
+
+class ChecksumError(TransferError):
+    pass
+
+def file_hashes(file_path, hasher=None):
+    """
+    Return (md5, sha1) hex digests of a local file
+
+    hasher: hashing.Hasher, whose cache is used and filled
+    """
+    if hasher is not None:
+        return hasher.hash(file_path)
+    return hashing.hash_file(file_path)
+
+def copy_file(source, fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Copy between file objects in chunks, return bytes copied
+    """
+    copied = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return copied
+        fileobj.write(chunk)
+        copied += len(chunk)
+
+def write_to(to, copy):
+    """
+    Call copy(fileobj) with `to` if it is a file object, else with `to` opened for writing
+
+    A partially written path is removed on error.
+    """
+    if not isinstance(to, basestring):
+        return copy(to)
+    try:
+        with open(to, 'wb') as fh:
+            return copy(fh)
+    except:
+        if os.path.exists(to):
+            os.remove(to)
+        raise
+
+def verify_file(file_path, meta, hasher=None):
+    """
+    Compare a local file with the md5/sha1 from metadata, raise ChecksumError on mismatch
+    """
+    if not meta.get('md5') and not meta.get('sha1'):
+        return
+    md5, sha1 = file_hashes(file_path, hasher)
+    if meta.get('md5') and meta['md5'].lower() != md5:
+        raise ChecksumError("md5 mismatch for %s: %s != %s" % (file_path, md5, meta['md5']))
+    if meta.get('sha1') and meta['sha1'].lower() != sha1:
+        raise ChecksumError("sha1 mismatch for %s: %s != %s" % (file_path, sha1, meta['sha1']))
+
+class SegmentedDownload:
+    """
+    Download a file with parallel HTTP Range requests
+
+    The redirect to the storage host is resolved once, then each segment is
+    fetched on a thread pool and written at its offset in a preallocated
+    output file. A failed segment is retried from the last byte written.
+    """
+
+    def __init__(self, client, from_path, to_path, rev=None, workers=SEGMENT_WORKERS,
+                 segment_size=SEGMENT_SIZE, retries=SEGMENT_RETRIES, chunk_size=CHUNK_SIZE):
+        self.client = client
+        self.from_path = from_path
+        self.to_path = to_path
+        self.rev = rev
+        self.workers = workers
+        self.segment_size = segment_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.url = None
+        self.size = None
+        # the client's transport, the default one for stand-ins
+        self.transport = hasattr(client, 'get_transport') and client.get_transport() or request.Request.IMPL
+
+    def segments(self):
+        return [(start, min(start + self.segment_size, self.size) - 1)
+                for start in xrange(0, self.size, self.segment_size)]
+
+    def fetch(self, segment):
+        """
+        Fetch bytes start..end (inclusive) into the output file
+        """
+        start, end = segment
+        offset = start
+        attempt = 0
+        error = None
+        with open(self.to_path, 'r+b') as fh:
+            while True:
+                try:
+                    response = self.transport.get(self.url, headers={
+                        'Range': 'bytes=%d-%d' % (offset, end)
+                    }, format='response', hooks=getattr(self.client, 'hooks', None))
+                    if response.status == 200 and (offset != 0 or end + 1 != self.size):
+                        # the whole body was sent instead of the range
+                        request.release_response(response)
+                        raise TransferError("Range requests are not supported by %s" % self.url)
+                    fh.seek(offset)
+                    for chunk in request.iter_response(response, self.chunk_size):
+                        fh.write(chunk)
+                        offset += len(chunk)
+                    if offset == end + 1:
+                        return end + 1 - start
+                except (socket.error, request.ErrorResponse, httplib.HTTPException), e:
+                    error = e
+                attempt += 1
+                if attempt > self.retries:
+                    raise TransferError("Segment %d-%d failed after %d retries: %s" % (start, end, self.retries, error or 'incomplete body'))
+
+    def rev_metadata(self):
+        """
+        Metadata of the revision to download, older ones are found in the revisions
+        """
+        meta = self.client.metadata(self.from_path, list=False)
+        if self.rev is None or self.rev == meta.get('rev'):
+            return meta
+        for meta in self.client.revisions(self.from_path, SEGMENT_REV_LIMIT):
+            if meta.get('rev') == self.rev:
+                return meta
+        raise TransferError("Revision %s of %s not found" % (self.rev, self.from_path))
+
+    def run(self):
+        """
+        Download and verify, return bytes written
+        """
+        meta = self.rev_metadata()
+        self.size = int(meta['bytes'])
+        self.url = self.client.get_file_url(self.from_path, self.rev)
+
+        with open(self.to_path, 'wb') as fh:
+            fh.truncate(self.size)
+
+        segments = self.segments()
+        if not segments:
+            return 0
+        pool = ThreadPool(min(self.workers, len(segments)))
+        try:
+            written = sum(pool.map(self.fetch, segments))
+        finally:
+            pool.terminate()
+
+        verify_file(self.to_path, meta, getattr(self.client, 'hasher', None))
+        return written
+
+class VerifiedUpload:
+    """
+    Upload a file with retries, skipped when the remote file already matches
+
+    The API has no chunked, append or concatenate upload: a file is stored
+    by a single files_put, and parts uploaded apart can not be joined on
+    the server. A failed upload is therefore retried as a whole. Before
+    sending, the remote file is looked up and the upload is skipped when it
+    already has the sha1 of the source, e.g. when an earlier run crashed
+    after its upload went through. The stored sha1 is checked afterwards.
+    """
+
+    def __init__(self, client, path, file_path, overwrite=True, retries=UPLOAD_RETRIES,
+                 retry_delay=UPLOAD_RETRY_DELAY):
+        self.client = client
+        self.path = path
+        self.file_path = file_path
+        self.overwrite = overwrite
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def remote_metadata(self):
+        try:
+            meta = self.client.metadata(self.path, list=False)
+        except request.ErrorResponse, e:
+            if e.status == 404:
+                return None
+            raise
+        if meta.get('is_deleted'):
+            return None
+        return meta
+
+    def upload(self):
+        attempt = 0
+        while True:
+            try:
+                return self.client.put_file(self.path, self.file_path, self.overwrite)
+            except request.ErrorResponse, e:
+                if e.status < 500 or attempt >= self.retries:
+                    raise
+            except (socket.error, httplib.HTTPException), e:
+                if attempt >= self.retries:
+                    raise
+            attempt += 1
+            time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def run(self):
+        """
+        Upload unless the remote file matches, verify, return the file metadata
+        """
+        md5, sha1 = file_hashes(self.file_path, getattr(self.client, 'hasher', None))
+        meta = self.remote_metadata()
+        if meta is None or (meta.get('sha1') or '').lower() != sha1:
+            meta = self.upload()
+        if meta.get('sha1') and meta['sha1'].lower() != sha1:
+            raise ChecksumError("sha1 mismatch for %s: %s != %s" % (self.path, meta['sha1'], sha1))
+        return meta
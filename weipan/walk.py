@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent recursive listing
+"""
+
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from .config import *
+
+def walk(client, root, max_depth=None, filter=None, onerror=None, workers=WALK_WORKERS):
+    """
+    Yield the metadata of every entry below root, breadth first
+
+    Folder listings are fetched by up to `workers` concurrent metadata
+    calls, entries are yielded as soon as their listing arrives.
+    max_depth: 1 lists root only, None for no limit
+    filter: called with each entry, entries it returns false for are not
+        yielded nor descended into
+    onerror: called with the exception when a listing fails, the walk goes
+        on without that folder. By default the exception is raised.
+    """
+    done = Queue.Queue()
+    frontier = deque([(root, 0)])
+    in_flight = 0
+
+    def fetch(path, depth):
+        try:
+            done.put((depth, client.metadata(path), None))
+        except Exception, e:
+            done.put((depth, None, e))
+
+    pool = ThreadPool(workers)
+    try:
+        while frontier or in_flight:
+            while frontier and in_flight < workers:
+                pool.apply_async(fetch, frontier.popleft())
+                in_flight += 1
+            depth, meta, error = done.get()
+            in_flight -= 1
+            if error is not None:
+                if onerror is None:
+                    raise error
+                onerror(error)
+                continue
+            for entry in meta.get('contents', []):
+                if filter is not None and not filter(entry):
+                    continue
+                yield entry
+                if entry.get('is_dir') and (max_depth is None or depth + 1 < max_depth):
+                    frontier.append((entry['path'], depth + 1))
+    finally:
+        # running listings finish in the background when the walk is abandoned
+        pool.close()